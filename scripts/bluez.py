@@ -1,109 +1,775 @@
 # Copyright (c) 2021 Martin Roesch
 # SPDX-License-Identifier: Apache-2.0
 
+import collections
+import concurrent.futures
+import itertools
 import logging
 import threading
 import time
+import weakref
 from contextlib import contextmanager
-from queue import SimpleQueue
+from queue import Empty, SimpleQueue
 import os
 import select
-from gi.repository import Gio, GLib
+import socket
 
 __logger__ = logging.getLogger('bluez')
 
+# The GObject bindings are imported by the first Manager, importing them takes longer than the rest of the module
+Gio = None
+GLib = None
+
+def _import_gi():
+    global Gio, GLib
+    if Gio is None:
+        from gi.repository import Gio as _Gio, GLib as _GLib
+        Gio, GLib = _Gio, _GLib
+
+# asyncio is only needed by the AsyncManager and is imported by the first one
+asyncio = None
+
+def _import_asyncio():
+    global asyncio
+    if asyncio is None:
+        import asyncio as _asyncio
+        asyncio = _asyncio
+
 DBUS_OBJECT_MANAGER_INTERFACE = 'org.freedesktop.DBus.ObjectManager'
 DBUS_PROPERTIES_INTERFACE = 'org.freedesktop.DBus.Properties'
 
 BLUEZ_BUS_NAME = 'org.bluez'
+BLUEZ_DBUS_ADDRESS_ENV = 'BLUEZ_DBUS_ADDRESS'
 BLUEZ_ADAPTER_INTERFACE = BLUEZ_BUS_NAME + '.Adapter1'
 BLUEZ_DEVICE_INTERFACE = BLUEZ_BUS_NAME + '.Device1'
 BLUEZ_GATTSERVICE_INTERFACE = BLUEZ_BUS_NAME + '.GattService1'
 BLUEZ_GATTCHARACTERISTIC_INTERFACE = BLUEZ_BUS_NAME + '.GattCharacteristic1'
 
+class LatencyHistogram:
+    """Histogram of durations with 8 buckets per power of two microseconds, i.e. a relative error below 12.5 %.
+    
+    Durations are recorded in seconds; `percentile` returns the center of the bucket in seconds.
+    
+    This is deliberately not `throughput_stats.Histogram`: bluez.py is used on its own, without the throughput
+    scripts, and stays free of NumPy so that it is cheap to import.
+    """
+    __slots__ = ('count', 'total', 'max', 'buckets')
+    
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = collections.Counter()
+    
+    @staticmethod
+    def _bucket(us):
+        if us < 16:
+            return us
+        e = us.bit_length() - 4
+        return 16 + (e - 1) * 8 + (us >> e) - 8
+    
+    @staticmethod
+    def _bounds(bucket):
+        if bucket < 16:
+            return bucket, bucket + 1
+        e, m = divmod(bucket - 16, 8)
+        return (m + 8) << (e + 1), (m + 9) << (e + 1)
+    
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[self._bucket(int(seconds * 1e6))] += 1
+    
+    def merge(self, other):
+        """Add the durations recorded by `other`."""
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.buckets.update(other.buckets)
+    
+    def percentile(self, p):
+        """Returns the `p` percentile (0-100) in seconds or `None` if nothing was recorded."""
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                low, high = self._bounds(bucket)
+                return min((low + high) / 2e6, self.max)
+        return self.max
+    
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+class Instrumentation:
+    """Counters and latency histograms of the bluez module.
+    
+    Instrumentation is disabled by default and the hooks of the module only check a global for `None` then.
+    `enable_instrumentation()` installs an instance, which collects:
+    - `calls`: a `LatencyHistogram` per D-Bus method call, e.g. StartDiscovery, Connect, ReadValue, WriteValue
+      and AcquireNotify, of the blocking and the non-blocking variants
+    - `signals`: the number of D-Bus signals received per object path and signal name
+    - `readers`: per characteristic the wakeups of the notification readers, the notifications they read and the
+      depth of the notification queue after each wakeup
+    
+    The hooks are called from the threads of the module, e.g. the GLib main loop and the reader threads.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.start = time.monotonic()
+        self.calls = {}
+        self.signals = collections.Counter()
+        self.readers = {}
+    
+    def record_call(self, method, seconds):
+        with self._lock:
+            histogram = self.calls.get(method)
+            if histogram is None:
+                histogram = self.calls[method] = LatencyHistogram()
+            histogram.record(seconds)
+    
+    def record_signal(self, path, signal):
+        with self._lock:
+            self.signals[(path, signal)] += 1
+    
+    def record_wakeup(self, path, notifications, depth=None):
+        """Record a wakeup of the reader of the characteristic `path` that read `notifications` notifications and
+        left `depth` items in its queue, `None` if it has no queue."""
+        with self._lock:
+            reader = self.readers.get(path)
+            if reader is None:
+                reader = self.readers[path] = [0, 0, 0, 0]
+            reader[0] += 1
+            reader[1] += notifications
+            if depth is not None:
+                reader[2] += depth
+                reader[3] = max(reader[3], depth)
+    
+    def snapshot(self):
+        """Returns the collected data as JSON serializable `dict`."""
+        with self._lock:
+            signals = {}
+            for (path, signal), count in self.signals.items():
+                signals.setdefault(path, {})[signal] = count
+            return {
+                'duration': time.monotonic() - self.start,
+                'calls': {method: h.as_dict() for method, h in self.calls.items()},
+                'signals': signals,
+                'readers': {path: {'wakeups': r[0], 'notifications': r[1],
+                                   'mean_queue_depth': r[2] / r[0] if r[0] else 0, 'max_queue_depth': r[3]}
+                            for path, r in self.readers.items()},
+            }
+    
+    def report(self):
+        """Returns the collected data as list of printable lines."""
+        snapshot = self.snapshot()
+        lines = [f'Instrumentation after {snapshot["duration"]:.1f} s']
+        for method, c in sorted(snapshot['calls'].items()):
+            lines.append(f'  {method}: {c["count"]} calls, mean: {c["mean"] * 1000:.3f} ms, '
+                         f'p50: {c["p50"] * 1000:.3f} ms, p99: {c["p99"] * 1000:.3f} ms, max: {c["max"] * 1000:.3f} ms')
+        for path, signals in sorted(snapshot['signals'].items()):
+            counts = ', '.join(f'{signal}: {count}' for signal, count in sorted(signals.items()))
+            lines.append(f'  {path}: {counts}')
+        for path, r in sorted(snapshot['readers'].items()):
+            per_wakeup = r['notifications'] / r['wakeups'] if r['wakeups'] else 0
+            lines.append(f'  {path}: {r["wakeups"]} wakeups, {r["notifications"]} notifications '
+                         f'({per_wakeup:.1f} per wakeup), queue depth mean: {r["mean_queue_depth"]:.1f}, '
+                         f'max: {r["max_queue_depth"]}')
+        return lines
+    
+    @contextmanager
+    def reporting(self, interval_s=1.0, output=print):
+        """Get a context manager that passes the lines of `report()` to `output` every `interval_s` seconds."""
+        stop = threading.Event()
+        def run():
+            while not stop.wait(interval_s):
+                for line in self.report():
+                    output(line)
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        try:
+            yield self
+        finally:
+            stop.set()
+            thread.join()
+
+_instrumentation = None
+
+def enable_instrumentation():
+    """Install a new `Instrumentation` for the hooks of the module and return it."""
+    global _instrumentation
+    _instrumentation = Instrumentation()
+    return _instrumentation
+
+def disable_instrumentation():
+    """Remove the `Instrumentation` and return it, `None` if instrumentation was not enabled."""
+    global _instrumentation
+    instrumentation, _instrumentation = _instrumentation, None
+    return instrumentation
+
+def get_instrumentation():
+    return _instrumentation
+
+def _traced(method, fn, *args):
+    """Returns `fn(*args)`, recording its duration as call of `method` if instrumentation is enabled."""
+    instrumentation = _instrumentation
+    if instrumentation is None:
+        return fn(*args)
+    start = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        instrumentation.record_call(method, time.perf_counter() - start)
+
+class _Waiter:
+    """A pending wait for `check(*args)` to return a true value.
+    `done` is called with the result of the passed check from the thread that evaluated it. As the check is
+    evaluated by the GLib main loop thread and by the waiting thread, `done` has to be idempotent.
+    """
+    __slots__ = ('check', 'done', 'result', 'event')
+    
+    def __init__(self, check, done):
+        self.check = check
+        self.done = done
+        self.result = None
+        self.event = None
+    
+    def evaluate(self, *args):
+        if self.result is not None:
+            return
+        try:
+            result = self.check(*args)
+        except BaseException as e:
+            __logger__.error(f'Wait condition {self.check} failed: {e}')
+            return
+        if result and self.result is None:
+            self.result = result
+            self.done(result)
+    
+    def wait(self, timeout_ms, *args):
+        """Evaluate the check with `args` and block until it passed. Only for waiters created by `_WaiterRegistry.wait`."""
+        self.evaluate(*args)
+        if not self.event.wait(timeout_ms / 1000):
+            raise Exception('Timeout')
+        return self.result
+
+class _WaiterRegistry:
+    """Registry of `_Waiter`s keyed by the object they are waiting on.
+    
+    Any number of waiters can be registered for the same key. Waiters are registered before the D-Bus call
+    that triggers the awaited change is issued, so signals arriving before the caller blocks are not lost.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = {}
+    
+    def add(self, key, check, done):
+        waiter = _Waiter(check, done)
+        with self._lock:
+            self._waiters.setdefault(key, []).append(waiter)
+        return waiter
+    
+    def remove(self, key, waiter):
+        with self._lock:
+            waiters = self._waiters.get(key)
+            if waiters is None:
+                return
+            waiters.remove(waiter)
+            if not waiters:
+                del self._waiters[key]
+    
+    def notify(self, key, *args):
+        with self._lock:
+            waiters = self._waiters.get(key)
+            if not waiters:
+                return
+            waiters = tuple(waiters)
+        for waiter in waiters:
+            waiter.evaluate(*args)
+    
+    @contextmanager
+    def wait(self, key, check):
+        """Register a waiter and return it as context. `waiter.wait(timeout_ms)` blocks until the check passed."""
+        event = threading.Event()
+        waiter = self.add(key, check, lambda result: event.set())
+        waiter.event = event
+        try:
+            yield waiter
+        finally:
+            self.remove(key, waiter)
+
+class _ObjectIndex:
+    """Incrementally maintained index of the BlueZ object tree.
+    
+    Keeps the interfaces and properties of each object path, a parent to children tree, the object paths per
+    interface and lookups of the `Address` of adapters and devices and the `UUID(s)` of devices, GATT services
+    and GATT characteristics. The properties of an interface are kept as the `a{sv}` `GLib.Variant` received
+    from BlueZ and only converted to a `dict` when they change for the first time. UUID and address lookups are
+    keyed by the parent object path, e.g. the devices of an adapter advertising a service UUID are found with
+    `by_key(adapter_path, uuid)`.
+    
+    Property values are unpacked once, on their first read through `value` or `values`, and kept until the
+    property changes, so repeated reads and filters over many objects do not convert any `GLib.Variant`.
+    """
+    _KEY_PROPERTIES = {
+        BLUEZ_ADAPTER_INTERFACE: ('Address',),
+        BLUEZ_DEVICE_INTERFACE: ('Address', 'UUIDs'),
+        BLUEZ_GATTSERVICE_INTERFACE: ('UUID',),
+        BLUEZ_GATTCHARACTERISTIC_INTERFACE: ('UUID',),
+    }
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.objects = {}
+        self._properties = {}
+        self._children = {}
+        self._interfaces = {}
+        self._keys = {}
+        self._paths_by_key = {}
+        self._decoded = {}
+    
+    @staticmethod
+    def parent(path):
+        return path.rpartition('/')[0]
+    
+    def add(self, path, interfaces):
+        """Add an object or add interfaces to an existing object.
+        
+        :Parameters:
+            `path` : str
+                The object path
+            `interfaces` : { str: GLib.Variant }
+                The properties of the added interfaces as `a{sv}` variants
+        
+        :Returns: `[ str ]` all interface names of the object
+        """
+        with self._lock:
+            names = self.objects.setdefault(path, [])
+            for name, properties in interfaces.items():
+                if name not in names:
+                    names.append(name)
+                self._interfaces.setdefault(name, set()).add(path)
+                self._properties[(path, name)] = properties
+                self._decoded.pop((path, name), None)
+                self._set_keys(path, name, self._read_keys(name, properties))
+            self._children.setdefault(self.parent(path), set()).add(path)
+            return names
+    
+    def remove(self, path, interface_names=None):
+        """Remove some interfaces of an object or the whole object if `interface_names` is `None`."""
+        with self._lock:
+            names = self.objects.get(path)
+            if names is None:
+                return
+            for name in list(names) if interface_names is None else interface_names:
+                if name in names:
+                    names.remove(name)
+                paths = self._interfaces.get(name)
+                if paths is not None:
+                    paths.discard(path)
+                self._properties.pop((path, name), None)
+                self._decoded.pop((path, name), None)
+                self._set_keys(path, name, ())
+            if names:
+                return
+            del self.objects[path]
+            parent = self.parent(path)
+            siblings = self._children.get(parent)
+            if siblings is not None:
+                siblings.discard(path)
+                if not siblings:
+                    del self._children[parent]
+    
+    def update(self, path, name, changed, invalidated=()):
+        """Apply a PropertiesChanged signal of the interface `name` of an object.
+        
+        :Parameters:
+            `changed` : GLib.Variant
+                The changed properties as `a{sv}` variant
+            `invalidated` : [ str ]
+                Names of the invalidated properties
+        
+        :Returns: `False` if the object is not in the index
+        """
+        with self._lock:
+            properties = self._properties.get((path, name))
+            if properties is None:
+                return False
+            if not isinstance(properties, dict):
+                properties = self._properties[(path, name)] = _variant_dict(properties)
+            changed = _variant_dict(changed)
+            properties.update(changed)
+            for prop in invalidated:
+                properties.pop(prop, None)
+            decoded = self._decoded.get((path, name))
+            if decoded is not None:
+                for prop in itertools.chain(changed, invalidated):
+                    decoded.pop(prop, None)
+            if name in self._KEY_PROPERTIES:
+                self._set_keys(path, name, self._read_keys(name, properties))
+            return True
+    
+    def get(self, path, name, prop):
+        """Returns the value of the property `prop` of the interface `name` of an object as `GLib.Variant` or
+        `None`."""
+        with self._lock:
+            properties = self._properties.get((path, name))
+            return None if properties is None else self._lookup(properties, prop)
+    
+    def value(self, path, name, prop):
+        """Returns the unpacked value of the property `prop` of the interface `name` of an object or `None`.
+        
+        Lists are returned as copies, so the cached value cannot be modified by the caller.
+        """
+        with self._lock:
+            value = self._value(path, name, prop)
+        return list(value) if type(value) is list else value
+    
+    def values(self, paths, name, props):
+        """Returns the unpacked values of the properties `props` of the interface `name` of the objects `paths`.
+        
+        All values are read under a single lock acquisition, so they are consistent with each other.
+        
+        :Returns: `[ (path, [ value ]) ]` with `None` for missing properties, objects not in the index are skipped
+        """
+        result = []
+        cache = self._decoded
+        with self._lock:
+            for path in paths:
+                try:
+                    decoded = cache[(path, name)]
+                    values = [decoded[prop] for prop in props]
+                except KeyError:
+                    if (path, name) not in self._properties:
+                        continue
+                    values = [self._value(path, name, prop) for prop in props]
+                result.append((path, [list(v) if type(v) is list else v for v in values]))
+        return result
+    
+    def _value(self, path, name, prop):
+        key = (path, name)
+        decoded = self._decoded.get(key)
+        if decoded is not None and prop in decoded:
+            return decoded[prop]
+        properties = self._properties.get(key)
+        if properties is None:
+            return None
+        variant = self._lookup(properties, prop)
+        value = None if variant is None else _unpack(variant)
+        if decoded is None:
+            decoded = self._decoded[key] = {}
+        decoded[prop] = value
+        return value
+    
+    def children(self, path, interface_name):
+        """Returns the direct children of `path` that implement `interface_name`."""
+        with self._lock:
+            children = self._children.get(path, ())
+            paths = self._interfaces.get(interface_name, ())
+            if len(children) > len(paths):
+                return [p for p in paths if p in children]
+            return [p for p in children if p in paths]
+    
+    def has(self, path, name):
+        """Returns `True` if the object `path` implements the interface `name`."""
+        with self._lock:
+            return (path, name) in self._properties
+    
+    def with_interface(self, interface_name):
+        with self._lock:
+            return list(self._interfaces.get(interface_name, ()))
+    
+    def has_key(self, path, key, interface_name):
+        """Returns `True` if the object `path` has the address or UUID `key` on `interface_name`."""
+        with self._lock:
+            return key.lower() in self._keys.get((path, interface_name), ())
+    
+    def by_key(self, parent, key, interface_name):
+        """Returns the children of `parent` implementing `interface_name` with the address or UUID `key`."""
+        with self._lock:
+            return list(self._paths_by_key.get((parent, interface_name, key.lower()), ()))
+    
+    @staticmethod
+    def _lookup(properties, prop):
+        if isinstance(properties, dict):
+            return properties.get(prop)
+        return properties.lookup_value(prop, None)
+    
+    def _read_keys(self, name, properties):
+        keys = []
+        for prop in self._KEY_PROPERTIES.get(name, ()):
+            value = self._lookup(properties, prop)
+            if value is None:
+                continue
+            # get_string/get_strv avoid the generic unpack() of the GObject overrides on the startup path
+            if value.get_type_string() == 's':
+                keys.append(value.get_string().lower())
+            else:
+                keys.extend(v.lower() for v in value.get_strv())
+        return keys
+    
+    def _set_keys(self, path, name, keys):
+        parent = self.parent(path)
+        for key in self._keys.pop((path, name), ()):
+            paths = self._paths_by_key.get((parent, name, key))
+            if paths is not None:
+                paths.discard(path)
+                if not paths:
+                    del self._paths_by_key[(parent, name, key)]
+        if keys:
+            self._keys[(path, name)] = keys
+        for key in keys:
+            self._paths_by_key.setdefault((parent, name, key), set()).add(path)
+
+_DISCOVERY_FILTER_TYPES = {
+    'UUIDs': 'as',
+    'RSSI': 'n',
+    'Pathloss': 'q',
+    'Transport': 's',
+    'DuplicateData': 'b',
+    'Discoverable': 'b',
+    'Pattern': 's',
+}
+
+def _discovery_filter_variant(discovery_filter):
+    """Returns the `(a{sv})` arguments of SetDiscoveryFilter."""
+    entries = {}
+    for k, v in (discovery_filter or {}).items():
+        if k not in _DISCOVERY_FILTER_TYPES:
+            raise Exception(f'Unknown discovery filter: {k}')
+        entries[k] = GLib.Variant(_DISCOVERY_FILTER_TYPES[k], v)
+    return GLib.Variant.new_tuple(GLib.Variant('a{sv}', entries))
+
+# Unpacking the common basic types directly avoids the generic unpack() of the GObject overrides
+_UNPACK = {
+    's': lambda v: v.get_string(),
+    'o': lambda v: v.get_string(),
+    'b': lambda v: v.get_boolean(),
+    'n': lambda v: v.get_int16(),
+    'q': lambda v: v.get_uint16(),
+    'y': lambda v: v.get_byte(),
+    'as': lambda v: v.get_strv(),
+}
+
+def _unpack(variant):
+    """Returns the Python value of a `GLib.Variant`."""
+    unpack = _UNPACK.get(variant.get_type_string())
+    return variant.unpack() if unpack is None else unpack(variant)
+
+def _variant_dict(variant):
+    """Returns an `a{sv}` `GLib.Variant` as `{ str: GLib.Variant }` without unpacking the values."""
+    result = {}
+    for i in range(variant.n_children()):
+        entry = variant.get_child_value(i)
+        result[entry.get_child_value(0).get_string()] = entry.get_child_value(1).get_variant()
+    return result
+
+class _LazyVariant:
+    """Class attribute holding a `GLib.Variant` that is parsed on first access."""
+    def __init__(self, text):
+        self._text = text
+        self._value = None
+    
+    def __get__(self, obj, cls):
+        if self._value is None:
+            _import_gi()
+            self._value = GLib.Variant.parse(None, self._text)
+        return self._value
+
 class _BaseObject:
+    """Base class of the wrappers of BlueZ objects.
+    
+    Wrappers are created through `Manager._wrap`, which returns the same wrapper for an object path and
+    interface as long as it is referenced. Properties are read from the object index of the `Manager`; the
+    `Gio.DBusProxy` used for method calls and signals is only created on first use. Signal handlers connected
+    with `_connect` must not reference the wrapper, they are disconnected when the wrapper is collected or when
+    BlueZ removes the object.
+    """
     def __init__(self, bluez, object_path, interface_name):
         self._bluez = bluez
-        self._proxy = bluez._om.get_interface(object_path, interface_name)
-        self.__wait_condition = None
-        self._proxy.connect('g-properties-changed', self.__properties_changed_log)
+        self._path = object_path
+        self._interface = interface_name
+        self.__proxy = None
+        self._handlers = []
+        self._finalizer = weakref.finalize(self, self._disconnect, self._handlers)
     
     def __repr__(self):
-        return f'{self.__class__.__name__}(\'Bluez()\', {self._proxy.get_object_path()!r}, {self._proxy.get_interface_name()!r})'
+        return f'{self.__class__.__name__}(\'Bluez()\', {self._path!r}, {self._interface!r})'
     
     def __str__(self):
-        return f'{self.__class__.__name__} ({self._proxy.get_object_path()}, {self._proxy.get_interface_name()})'
-    
-    def __properties_changed_log(self, proxy, changed, invalidated):
-        __logger__.debug(f'{proxy.get_object_path()}: Properties changed: {changed.print_(True)}')
-    
-    def __wait_property_changed(self, proxy, changed, invalidated):
-        if self.__wait_condition:
-            if self.__wait_condition['check'](changed):
-                cv = self.__wait_condition['cv']
-                with cv:
-                    cv.notifyAll()
-    
-    def __wait_property_timeout(self):
-        if self.__wait_condition:
-            self.__wait_condition['timeout'] = True
-            cv = self.__wait_condition['cv']
-            with cv:
-                cv.notifyAll()
-        return False
+        return f'{self.__class__.__name__} ({self._path}, {self._interface})'
     
-    def _wait_property_change(self, check_fn, timeout_ms=1000):
-        cv = threading.Condition()
-        assert self.__wait_condition is None
-        self.__wait_condition = {'cv': cv, 'timeout': False, 'check': check_fn}
-        pc = self._proxy.connect('g-properties-changed', self.__wait_property_changed)
-        tmo = GLib.timeout_add(timeout_ms, self.__wait_property_timeout)
-        with cv:
-            cv.wait()
-        self._proxy.disconnect(pc)
-        timeout = self.__wait_condition['timeout']
-        self.__wait_condition = None
-        if timeout:
-            raise Exception('Timeout')
-        GLib.source_remove(tmo)
-    
-    def __wait_object_added(self, om, object):
-        if self.__wait_condition:
-            ifname = self.__wait_condition['interface']
-            iface = None
-            for i in object.get_interfaces():
-                if i.get_interface_name() == ifname:
-                    iface = i
-            if iface and self.__wait_condition['check'](iface):
-                cv = self.__wait_condition['cv']
-                with cv:
-                    cv.notifyAll()
-    
-    def __wait_object_timeout(self):
-        if self.__wait_condition:
-            self.__wait_condition['timeout'] = True
-            cv = self.__wait_condition['cv']
-            with cv:
-                cv.notifyAll()
-        return False
+    @property
+    def path(self):
+        """D-Bus object path of the wrapped object."""
+        return self._path
     
-    def _wait_object_added(self, interface_name, check_fn, timeout_ms=10000):
-        cv = threading.Condition()
-        assert self.__wait_condition is None
-        self.__wait_condition = {'cv': cv, 'timeout': False, 'interface': interface_name, 'check': check_fn}
-        oa = self._bluez._om.connect('object-added', self.__wait_object_added)
-        tmo = GLib.timeout_add(timeout_ms, self.__wait_object_timeout)
-        with cv:
-            cv.wait()
-        self._bluez._om.disconnect(oa)
-        timeout = self.__wait_condition['timeout']
-        self.__wait_condition = None
-        if timeout:
-            raise Exception('Timeout')
-        GLib.source_remove(tmo)
+    @property
+    def _proxy(self):
+        if self.__proxy is None:
+            self.__proxy = self._bluez._get_proxy(self._path, self._interface)
+        return self.__proxy
+    
+    def _connect(self, signal, handler):
+        proxy = self._proxy
+        self._handlers.append((proxy, proxy.connect(signal, handler)))
+    
+    @staticmethod
+    def _disconnect(handlers):
+        for proxy, hid in handlers:
+            proxy.disconnect(hid)
+        handlers.clear()
+    
+    def _release(self):
+        """Disconnect all signal handlers of the wrapper."""
+        self._finalizer()
+    
+    def _wait_property_change(self, check_fn, timeout_ms=1000, action=None):
+        """Call `action` and wait until `check_fn(self)` returns `True`.
+        
+        The check is evaluated on the cached properties once `action` returned and again whenever BlueZ reports
+        a property change of this object.
+        
+        :Raises `Exception`: on timeout
+        """
+        with self._bluez._waiters.wait(self._path, lambda: check_fn(self)) as w:
+            if action:
+                action()
+            w.wait(timeout_ms)
     
     def _get_property(self, name):
-        return self._proxy.get_cached_property(name)
+        return self._bluez._index.get(self._path, self._interface, name)
+    
+    def _get_value(self, name):
+        """Returns the unpacked value of the property `name` or `None` if the object does not have it."""
+        return self._bluez._index.value(self._path, self._interface, name)
+    
+    def _call_future(self, method, args=None, timeout_ms=-1, fd_list=None, finish=None):
+        """Issue the D-Bus method call `method` without blocking.
+        
+        The call completes in the GLib main loop thread of the `Manager`. Cancelling the returned future cancels
+        the D-Bus call through a `Gio.Cancellable`.
+        
+        :Parameters:
+            `timeout_ms` : int
+                Timeout of the call, -1 for the default D-Bus timeout
+            `fd_list` : Gio.UnixFDList
+                Issue the call with a file descriptor list, the result is `(GLib.Variant, Gio.UnixFDList)`
+            `finish` : callable
+                Converts the result before the future is resolved
+        
+        :Returns: `concurrent.futures.Future`
+        """
+        future = concurrent.futures.Future()
+        cancellable = Gio.Cancellable()
+        future.add_done_callback(lambda f: f.cancelled() and cancellable.cancel())
+        start = time.perf_counter() if _instrumentation is not None else None
+        def done(proxy, res, data):
+            instrumentation = _instrumentation
+            if start is not None and instrumentation is not None:
+                instrumentation.record_call(method, time.perf_counter() - start)
+            try:
+                if fd_list is None:
+                    result = proxy.call_finish(res)
+                else:
+                    result = proxy.call_with_unix_fd_list_finish(res)
+                if finish is not None:
+                    result = finish(result)
+            except Exception as e:
+                self._resolve_future(future, exception=e)
+            else:
+                self._resolve_future(future, result)
+        if fd_list is None:
+            self._proxy.call(method, args, Gio.DBusCallFlags.NONE, timeout_ms, cancellable, done, None)
+        else:
+            self._proxy.call_with_unix_fd_list(method, args, Gio.DBusCallFlags.NONE, timeout_ms, fd_list,
+                                               cancellable, done, None)
+        return future
+    
+    @staticmethod
+    def _resolve_future(future, result=None, exception=None):
+        try:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+        except concurrent.futures.InvalidStateError:
+            # Cancelled while the call was in flight
+            pass
+
+class CallBatch:
+    """Non-blocking D-Bus calls that are issued together and collected together.
+    
+    All calls of a batch are in flight at the same time, so waiting for the batch takes as long as the slowest
+    call instead of the sum of all calls.
+    
+    Example:
+    batch = CallBatch(timeout_ms=2000)
+    for c in config_chars:
+        batch.write(c, config)
+    batch.read(other_char)
+    results = batch.wait()
+    
+    :Parameters:
+        `timeout_ms` : int
+            Timeout of every call of the batch, -1 for the default D-Bus timeout
+    """
+    def __init__(self, timeout_ms=-1):
+        self.timeout_ms = timeout_ms
+        self._futures = []
+    
+    def __len__(self):
+        return len(self._futures)
+    
+    def add(self, future):
+        """Add a `concurrent.futures.Future` of a call issued elsewhere."""
+        self._futures.append(future)
+        return future
+    
+    def read(self, characteristic):
+        """Issue ReadValue on a `bluez.GattCharacteristic`."""
+        return self.add(characteristic.submit_read(self.timeout_ms))
+    
+    def write(self, characteristic, data):
+        """Issue WriteValue on a `bluez.GattCharacteristic`."""
+        return self.add(characteristic.submit_write(data, self.timeout_ms))
+    
+    def cancel(self):
+        """Cancel all calls that did not complete yet."""
+        for f in self._futures:
+            f.cancel()
+    
+    def wait(self, return_exceptions=False):
+        """Wait for all calls of the batch.
+        
+        :Parameters:
+            `return_exceptions` : bool
+                Return the exception of a failed call as its result instead of raising it
+        
+        :Returns: `[ object ]` the results in the order the calls were added
+        :Raises `Exception`: the error of the first failed call; the remaining calls are cancelled
+        """
+        results = []
+        for f in self._futures:
+            try:
+                results.append(f.result())
+            except Exception as e:
+                if not return_exceptions:
+                    self.cancel()
+                    raise
+                results.append(e)
+        return results
 
 class Manager:
     class _MainLoop(threading.Thread):
@@ -117,34 +783,201 @@ class Manager:
         def stop(self):
             self.loop.quit()
 
-    def __init__(self):
+    def __init__(self, bus_address=None, scope=None):
+        """
+        :Parameters:
+            `bus_address` : str
+                D-Bus address of the bus to find BlueZ on, e.g. the private bus of `bluez_mock.MockBluez`.
+                Defaults to the `BLUEZ_DBUS_ADDRESS` environment variable or, if not set, the system bus.
+            `scope` : str
+                Only index the objects of this adapter (e.g. hci0) or object path (e.g. the path of a device),
+                its ancestors and its descendants. Defaults to all objects.
+        
+        :Raises `GLib.Error`: if the objects of BlueZ cannot be fetched
+        """
+        _import_gi()
         self._mainloop = self._MainLoop()
         self._mainloop.daemon = True
         self._mainloop.start()
-        # https://lazka.github.io/pgi-docs/Gio-2.0/classes/DBusObjectManager.html
-        self._om = Gio.DBusObjectManagerClient.new_for_bus_sync(bus_type=Gio.BusType.SYSTEM,
-                                                                flags=Gio.DBusObjectManagerClientFlags.NONE,
-                                                                name=BLUEZ_BUS_NAME,
-                                                                object_path='/',
-                                                                get_proxy_type_func=None,
-                                                                get_proxy_type_user_data=None,
-                                                                cancellable=None)
-        self._om.connect('object-added', self.__object_added)
-        self._om.connect('object-removed', self.__object_removed)
-        self._objects = {}
-        for o in self._om.get_objects():
-            self._objects[o.get_object_path()] = [i.get_interface_name() for i in o.get_interfaces()]
-    
-    def __object_added(self, om, object):
-        p = object.get_object_path()
-        ifs = [i.get_interface_name() for i in object.get_interfaces()]
-        self._objects[p] = ifs
-        __logger__.debug(f'Object added: {p}: {ifs}')
-    
-    def __object_removed(self, om,  object):
-        p = object.get_object_path()
-        self._objects.pop(p, None)
-        __logger__.debug(f'Object removed: {p}')
+        bus_address = bus_address or os.environ.get(BLUEZ_DBUS_ADDRESS_ENV)
+        if bus_address:
+            self._bus = Gio.DBusConnection.new_for_address_sync(
+                bus_address,
+                Gio.DBusConnectionFlags.AUTHENTICATION_CLIENT | Gio.DBusConnectionFlags.MESSAGE_BUS_CONNECTION,
+                None, None)
+        else:
+            self._bus = Gio.bus_get_sync(Gio.BusType.SYSTEM, None)
+        if scope and not scope.startswith('/'):
+            scope = f'/org/bluez/{scope}'
+        self._scope = scope.rstrip('/') if scope else None
+        self._waiters = _WaiterRegistry()
+        self._wrappers = {}
+        self._wrappers_lock = threading.Lock()
+        self._proxies = {}
+        self._index = _ObjectIndex()
+        self._objects = self._index.objects
+        self._dispatcher = _NotificationDispatcher(self)
+        # Subscribe and fetch the objects in the main loop thread, so no signal is applied before the snapshot
+        try:
+            self._call_in_loop(self.__load)
+        except Exception:
+            self._mainloop.stop()
+            raise
+    
+    def _call_in_loop(self, fn):
+        """Calls `fn` in the GLib main loop thread, waits for it to return and returns its result."""
+        if threading.current_thread() is self._mainloop:
+            return fn()
+        done = threading.Event()
+        result = [None, None]
+        def call():
+            try:
+                result[0] = fn()
+            except Exception as e:
+                result[1] = e
+            finally:
+                done.set()
+            return False
+        GLib.idle_add(call, priority=GLib.PRIORITY_HIGH)
+        done.wait()
+        if result[1] is not None:
+            raise result[1]
+        return result[0]
+    
+    def __load(self):
+        bus = self._bus
+        # https://lazka.github.io/pgi-docs/Gio-2.0/classes/DBusConnection.html#Gio.DBusConnection.signal_subscribe
+        self._subscriptions = [
+            bus.signal_subscribe(BLUEZ_BUS_NAME, DBUS_OBJECT_MANAGER_INTERFACE, 'InterfacesAdded', '/', None,
+                                 Gio.DBusSignalFlags.NONE, self.__interfaces_added, None),
+            bus.signal_subscribe(BLUEZ_BUS_NAME, DBUS_OBJECT_MANAGER_INTERFACE, 'InterfacesRemoved', '/', None,
+                                 Gio.DBusSignalFlags.NONE, self.__interfaces_removed, None),
+            bus.signal_subscribe(BLUEZ_BUS_NAME, DBUS_PROPERTIES_INTERFACE, 'PropertiesChanged', None, None,
+                                 Gio.DBusSignalFlags.NONE, self.__properties_changed, None),
+        ]
+        try:
+            objects = bus.call_sync(BLUEZ_BUS_NAME, '/', DBUS_OBJECT_MANAGER_INTERFACE, 'GetManagedObjects', None,
+                                    GLib.VariantType('(a{oa{sa{sv}}})'), Gio.DBusCallFlags.NONE, -1, None)
+        except GLib.Error as e:
+            __logger__.error(f'GetManagedObjects failed: {e}')
+            for sid in self._subscriptions:
+                bus.signal_unsubscribe(sid)
+            raise
+        objects = objects.get_child_value(0)
+        for i in range(objects.n_children()):
+            entry = objects.get_child_value(i)
+            path = entry.get_child_value(0).get_string()
+            if self._in_scope(path):
+                self._index.add(path, self.__interfaces(entry.get_child_value(1)))
+    
+    def _in_scope(self, path):
+        scope = self._scope
+        if scope is None or path == scope:
+            return True
+        if path.startswith(scope):
+            return path[len(scope)] == '/'
+        return scope.startswith(path) and scope[len(path)] == '/'
+    
+    @staticmethod
+    def __interfaces(variant):
+        """Returns an `a{sa{sv}}` variant as `{ str: GLib.Variant }`."""
+        interfaces = {}
+        for i in range(variant.n_children()):
+            entry = variant.get_child_value(i)
+            interfaces[entry.get_child_value(0).get_string()] = entry.get_child_value(1)
+        return interfaces
+    
+    def __interfaces_added(self, bus, sender, object_path, interface_name, signal_name, parameters, data):
+        p = parameters.get_child_value(0).get_string()
+        if not self._in_scope(p):
+            return
+        if _instrumentation is not None:
+            _instrumentation.record_signal(p, signal_name)
+        ifs = self.__interfaces(parameters.get_child_value(1))
+        self._index.add(p, ifs)
+        __logger__.debug(f'Interfaces added: {p}: {list(ifs)}')
+        parent = _ObjectIndex.parent(p)
+        for i in ifs:
+            self._waiters.notify((parent, i), p)
+    
+    def __interfaces_removed(self, bus, sender, object_path, interface_name, signal_name, parameters, data):
+        p, names = parameters.unpack()
+        if not self._in_scope(p):
+            return
+        if _instrumentation is not None:
+            _instrumentation.record_signal(p, signal_name)
+        self._index.remove(p, names)
+        if p not in self._objects:
+            self.__evict(p)
+        else:
+            for name in names:
+                self.__evict(p, name)
+        __logger__.debug(f'Interfaces removed: {p}: {names}')
+        self._waiters.notify(p)
+    
+    def __properties_changed(self, bus, sender, object_path, interface_name, signal_name, parameters, data):
+        name = parameters.get_child_value(0).get_string()
+        changed = parameters.get_child_value(1)
+        if not self._index.update(object_path, name, changed, parameters.get_child_value(2).unpack()):
+            return
+        if _instrumentation is not None:
+            _instrumentation.record_signal(object_path, signal_name)
+        if __logger__.isEnabledFor(logging.DEBUG):
+            __logger__.debug(f'{object_path}: Properties changed: {changed.print_(True)}')
+        self._waiters.notify(object_path)
+        # Children are checked again when their properties change, e.g. devices whose UUIDs arrive after they were added
+        self._waiters.notify((_ObjectIndex.parent(object_path), name), object_path)
+    
+    def _get_proxy(self, path, interface_name):
+        """Returns the `Gio.DBusProxy` of an interface of an object, created on first use.
+        
+        The proxy does not load the properties, they are read from the object index.
+        """
+        key = (path, interface_name)
+        with self._wrappers_lock:
+            proxy = self._proxies.get(key)
+        if proxy is None:
+            proxy = Gio.DBusProxy.new_sync(self._bus, Gio.DBusProxyFlags.DO_NOT_LOAD_PROPERTIES, None,
+                                           BLUEZ_BUS_NAME, path, interface_name, None)
+            with self._wrappers_lock:
+                proxy = self._proxies.setdefault(key, proxy)
+        return proxy
+    
+    def __evict(self, path, interface_name=None):
+        with self._wrappers_lock:
+            for key in [k for k in self._proxies if k[0] == path and interface_name in (None, k[1])]:
+                del self._proxies[key]
+            wrappers = self._wrappers.get(path)
+            if wrappers is None:
+                return
+            if interface_name is None:
+                del self._wrappers[path]
+                evicted = list(wrappers.values())
+            else:
+                evicted = [wrappers.pop(k) for k in list(wrappers.keys()) if k[0] == interface_name]
+        for w in evicted:
+            w._release()
+    
+    def _wrap(self, cls, path, interface_name):
+        """Returns the `cls` wrapper of an interface of an object.
+        
+        Wrappers are held weakly: the same wrapper is returned for the same object path and interface as long as
+        it is referenced somewhere. The wrapper is evicted and its signal handlers are disconnected when BlueZ
+        removes the object.
+        """
+        key = (interface_name, cls)
+        with self._wrappers_lock:
+            wrappers = self._wrappers.get(path)
+            if wrappers is None:
+                wrappers = self._wrappers[path] = weakref.WeakValueDictionary()
+            wrapper = wrappers.get(key)
+            if wrapper is None:
+                wrapper = wrappers[key] = cls(self, path, interface_name)
+            return wrapper
+    
+    def _children(self, path, interface_name):
+        """Returns the object paths of the children of `path` that implement `interface_name`."""
+        return self._index.children(path, interface_name)
     
     def get_adapter(self, pattern=None):
         """Returns the first bluetooth adapter found.
@@ -156,13 +989,44 @@ class Manager:
         :Returns: a `bluez.Adapter`
         :Raises `Exception`: if there are no bluetooth adapters available or none matched the `pattern`
         """
-        for path, ifaces in self._objects.items():
-            if BLUEZ_ADAPTER_INTERFACE not in ifaces:
-                continue
-            adapter = Adapter(self, path, BLUEZ_ADAPTER_INTERFACE)
-            if not pattern or path.endswith(pattern) or pattern == adapter.Address:
-                return adapter
+        paths = sorted(self._index.with_interface(BLUEZ_ADAPTER_INTERFACE))
+        if pattern:
+            paths = [p for p in paths if p.endswith(pattern)] or \
+                    [p for p in paths if p in self._index.by_key(_ObjectIndex.parent(p), pattern, BLUEZ_ADAPTER_INTERFACE)]
+        if paths:
+            return self._adapter(paths[0])
         raise Exception('No bluetooth adapter found')
+    
+    def get_adapters(self):
+        """Returns all bluetooth adapters, ordered by object path.
+        
+        :Returns: `[ bluez.Adapter ]`
+        """
+        return [self._adapter(p) for p in sorted(self._index.with_interface(BLUEZ_ADAPTER_INTERFACE))]
+    
+    def _adapter(self, path):
+        return self._wrap(Adapter, path, BLUEZ_ADAPTER_INTERFACE)
+
+class DeviceRecord:
+    """Plain snapshot of the properties of a device, returned by `Adapter.snapshot`.
+    
+    The record does not change when BlueZ reports property changes, take a new snapshot instead. Missing
+    properties, e.g. the `Name` or `RSSI` of a device that was not seen advertising, are `None`.
+    """
+    PROPERTIES = ('Address', 'Name', 'RSSI', 'Connected', 'UUIDs')
+    __slots__ = ('path', 'address', 'name', 'rssi', 'connected', 'uuids')
+    
+    def __init__(self, path, address, name, rssi, connected, uuids):
+        self.path = path
+        self.address = address
+        self.name = name
+        self.rssi = rssi
+        self.connected = connected
+        self.uuids = uuids or []
+    
+    def __repr__(self):
+        return (f'DeviceRecord({self.path!r}, {self.address!r}, {self.name!r}, {self.rssi!r}, {self.connected!r}, '
+                f'{self.uuids!r})')
 
 class Adapter(_BaseObject):
     def __init__(self, bluez, object_path, interface_name):
@@ -170,15 +1034,15 @@ class Adapter(_BaseObject):
     
     @property
     def Address(self):
-        return self._get_property('Address').unpack()
+        return self._get_value('Address')
      
     @property
     def Name(self):
-        return self._get_property('Name').unpack()
+        return self._get_value('Name')
      
     @property
     def Discovering(self):
-        return self._get_property('Discovering').unpack()
+        return self._get_value('Discovering')
     
     def start_discovery(self):
         """Start device discovery.
@@ -186,18 +1050,13 @@ class Adapter(_BaseObject):
         :Returns: `None`
         """
         if self.Discovering:
-            __logger__.info(f'{self._proxy.get_object_path()}: Already discovering.')
+            __logger__.info(f'{self._path}: Already discovering.')
             return
         try:
-            def check(properties):
-                value = properties.lookup_value('Discovering')
-                if value is None:
-                    return False
-                return value.get_boolean()
-            self._proxy.StartDiscovery()
-            self._wait_property_change(check)
+            self._wait_property_change(lambda a: a.Discovering,
+                                       action=lambda: _traced('StartDiscovery', self._proxy.StartDiscovery))
         except BaseException as e:
-            __logger__.error(f'{self._proxy.get_object_path()}: StartDiscovery failed: {e}')
+            __logger__.error(f'{self._path}: StartDiscovery failed: {e}')
     
     def stop_discovery(self):
         """Stop device discovery.
@@ -205,50 +1064,189 @@ class Adapter(_BaseObject):
         :Returns: `None`
         """
         if not self.Discovering:
-            __logger__.info(f'{self._proxy.get_object_path()}: Not discovering.')
+            __logger__.info(f'{self._path}: Not discovering.')
             return
         try:
-            def check(properties):
-                value = properties.lookup_value('Discovering')
-                if value is None:
-                    return False
-                return not value.get_boolean()
-            self._proxy.StopDiscovery()
-            self._wait_property_change(check)
+            self._wait_property_change(lambda a: not a.Discovering,
+                                       action=lambda: _traced('StopDiscovery', self._proxy.StopDiscovery))
         except BaseException as e:
-            __logger__.error(f'{self._proxy.get_object_path()}: StopDiscovery failed: {e}')
+            __logger__.error(f'{self._path}: StopDiscovery failed: {e}')
     
     def get_devices(self, serviceUUID=None):
         """Get all devices associated with the adapter.
          
         :Returns: `[ bluez.Device ]`
         """
-        devices = [Device(self._bluez, path, BLUEZ_DEVICE_INTERFACE) for path, ifaces in self._bluez._objects.items()
-                   if path.startswith(self._proxy.get_object_path()) and BLUEZ_DEVICE_INTERFACE in ifaces]
-        if not serviceUUID:
-            return devices
-        return [d for d in devices if serviceUUID in d.UUIDs]
+        path = self._path
+        if serviceUUID:
+            paths = self._bluez._index.by_key(path, serviceUUID, BLUEZ_DEVICE_INTERFACE)
+        else:
+            paths = self._bluez._children(path, BLUEZ_DEVICE_INTERFACE)
+        return [self._device(p) for p in paths]
     
-    def discover_device(self, check_fn, timeout_ms=10000):
-        for device in self.get_devices():
-            if check_fn(device):
-                return device
-        __logger__.debug(f'{self._proxy.get_object_path()}: Start discovering.')
-        self.start_discovery()
+    def snapshot(self, serviceUUID=None):
+        """Get a snapshot of the properties of all devices associated with the adapter.
+        
+        The records are plain Python objects read from the decoded property cache in one pass, no wrapper is
+        created, so filtering large device lists is cheap:
+        
+        Example:
+        near = [r.address for r in adapter.snapshot(uuid) if r.rssi is not None and r.rssi > -70]
+        
+        :Parameters:
+            `serviceUUID` : str
+                Only include the devices advertising this service UUID
+        
+        :Returns: `[ bluez.DeviceRecord ]`
+        """
+        path = self._path
+        index = self._bluez._index
+        if serviceUUID:
+            paths = index.by_key(path, serviceUUID, BLUEZ_DEVICE_INTERFACE)
+        else:
+            paths = self._bluez._children(path, BLUEZ_DEVICE_INTERFACE)
+        return [DeviceRecord(p, *values) for p, values in index.values(paths, BLUEZ_DEVICE_INTERFACE,
+                                                                        DeviceRecord.PROPERTIES)]
+    
+    def device(self, record):
+        """Returns the `bluez.Device` of a `bluez.DeviceRecord`."""
+        return self._device(record.path)
+    
+    def get_device(self, address):
+        """Get the device with the given address.
+         
+        :Returns: a `bluez.Device` or `None` if the adapter does not know the device
+        """
+        paths = self._bluez._index.by_key(self._path, address, BLUEZ_DEVICE_INTERFACE)
+        return self._device(paths[0]) if paths else None
+    
+    def set_discovery_filter(self, discovery_filter=None):
+        """Set the discovery filter of this client, `None` or an empty dict to clear it.
+        
+        :Parameters:
+            `discovery_filter` : dict
+                Filter as defined by the BlueZ adapter API, e.g.
+                `{'UUIDs': [uuid], 'RSSI': -80, 'Transport': 'le', 'DuplicateData': False}`
+        
+        :Raises `Exception`: on an unknown filter key
+        """
+        self._proxy.call_sync('SetDiscoveryFilter', _discovery_filter_variant(discovery_filter),
+                              Gio.DBusCallFlags.NONE, -1, None)
+    
+    def remove_device(self, device, timeout_ms=10000):
+        """Remove `device` and its GATT objects from BlueZ, e.g. to discover it again from scratch.
+        
+        :Raises `Exception`: on timeout
+        """
+        index = self._bluez._index
+        path = device.path
+        with self._bluez._waiters.wait(path, lambda: not index.has(path, BLUEZ_DEVICE_INTERFACE)) as w:
+            _traced('RemoveDevice', self._proxy.RemoveDevice, '(o)', path)
+            w.wait(timeout_ms)
+    
+    def discover_device(self, check_fn=None, timeout_ms=10000, discovery_filter=None):
+        """Discover the first device for which `check_fn(device)` returns `True`.
+        
+        :Returns: a `bluez.Device` or `None` if no device matched within `timeout_ms`
+        """
+        for device in self.scan(check_fn, timeout_ms, discovery_filter):
+            return device
+        return None
+    
+    def discover_devices(self, check_fn, count, timeout_ms=10000, discovery_filter=None):
+        """Discover up to `count` devices for which `check_fn(device)` returns `True`.
+        
+        Discovery is only started if the adapter does not know enough matching devices already and it is
+        stopped as soon as `count` devices matched or `timeout_ms` elapsed.
+        
+        :Returns: `[ bluez.Device ]` the matching devices, fewer than `count` on timeout
+        """
+        return list(itertools.islice(self.scan(check_fn, timeout_ms, discovery_filter), count))
+    
+    def scan(self, check_fn=None, timeout_ms=None, discovery_filter=None):
+        """Iterate over the devices for which `check_fn(device)` returns `True` as they are found.
+        
+        Matching devices the adapter already knows are yielded first, discovery is only started once they are
+        exhausted. Each device is yielded once; a device that did not match is checked again when its properties
+        change, e.g. when its UUIDs become known. Discovery keeps running until the iteration is stopped or
+        `timeout_ms` elapsed.
+        
+        The `discovery_filter` (see `set_discovery_filter`) is set in BlueZ while discovering, so non-matching
+        devices do not cause any D-Bus traffic. Its `UUIDs` and `RSSI` are checked on the known devices as well,
+        before `check_fn` is called.
+        
+        Example:
+        for device in adapter.scan(discovery_filter={'UUIDs': [uuid], 'Transport': 'le'}):
+            print('Found', device)
+        
+        :Parameters:
+            `timeout_ms` : int
+                Stop after this time, `None` to scan until the iteration is stopped
+        
+        :Returns: a generator of `bluez.Device`
+        """
+        path = self._path
+        key = (path, BLUEZ_DEVICE_INTERFACE)
+        found = SimpleQueue()
+        check = self._scan_check(check_fn, discovery_filter, found.put)
+        waiter = self._bluez._waiters.add(key, check, lambda result: None)
+        deadline = None if timeout_ms is None else time.monotonic() + timeout_ms / 1000
+        discovering = False
         try:
-            def check_object(device):
-                return check_fn(Device(self._bluez, device.get_object_path(), BLUEZ_DEVICE_INTERFACE))
-            self._wait_object_added(BLUEZ_DEVICE_INTERFACE, check_object, timeout_ms)
-        except BaseException as e:
-            __logger__.debug(f'{self._proxy.get_object_path()}: discover_device: Caught exception: {e}')
-            return None
+            check()
+            while True:
+                if found.empty() and not discovering:
+                    __logger__.debug(f'{path}: Start discovering.')
+                    if discovery_filter:
+                        self.set_discovery_filter(discovery_filter)
+                    self.start_discovery()
+                    discovering = True
+                try:
+                    timeout = None if deadline is None else max(0, deadline - time.monotonic())
+                    child = found.get(timeout=timeout)
+                except Empty:
+                    return
+                yield self._device(child)
         finally:
-            __logger__.debug(f'{self._proxy.get_object_path()}: Stop discovering.')
-            self.stop_discovery()
-        for device in self.get_devices():
-            if check_fn(device):
-                return device
-        return None
+            self._bluez._waiters.remove(key, waiter)
+            if discovering:
+                __logger__.debug(f'{path}: Stop discovering.')
+                self.stop_discovery()
+                if discovery_filter:
+                    self.set_discovery_filter(None)
+    
+    def _scan_check(self, check_fn, discovery_filter, put):
+        """Returns a waiter check that passes every new matching device path to `put` and never completes."""
+        path = self._path
+        index = self._bluez._index
+        uuids = (discovery_filter or {}).get('UUIDs')
+        rssi = (discovery_filter or {}).get('RSSI')
+        seen = set()
+        lock = threading.Lock()
+        def check(child=None):
+            children = [child] if child is not None else self._bluez._children(path, BLUEZ_DEVICE_INTERFACE)
+            for c in children:
+                if c in seen:
+                    continue
+                if uuids and not any(index.has_key(c, u, BLUEZ_DEVICE_INTERFACE) for u in uuids):
+                    continue
+                if rssi is not None:
+                    value = index.value(c, BLUEZ_DEVICE_INTERFACE, 'RSSI')
+                    if value is None or value < rssi:
+                        continue
+                device = self._device(c)
+                if check_fn is not None and not check_fn(device):
+                    continue
+                with lock:
+                    if c in seen:
+                        continue
+                    seen.add(c)
+                put(c)
+            return None
+        return check
+    
+    def _device(self, path):
+        return self._bluez._wrap(Device, path, BLUEZ_DEVICE_INTERFACE)
 
 class Device(_BaseObject):
     def __init__(self, bluez, object_path, interface_name):
@@ -256,67 +1254,70 @@ class Device(_BaseObject):
 
     @property
     def Address(self):
-        return self._get_property('Address').unpack()
+        return self._get_value('Address')
      
     @property
     def Name(self):
-        return self._get_property('Name').unpack()
+        return self._get_value('Name')
      
     @property
     def RSSI(self):
-        return self._get_property('RSSI').unpack()
+        return self._get_value('RSSI')
      
     @property
     def Connected(self):
-        return self._get_property('Connected').unpack()
+        return self._get_value('Connected')
      
     @property
     def UUIDs(self):
-        return self._get_property('UUIDs').unpack()
+        return self._get_value('UUIDs')
      
     @property
     def ServicesResolved(self):
-        return self._get_property('ServicesResolved')
+        return self._get_value('ServicesResolved')
      
     def connect(self, wait_for_services=True, timeout_ms=10000):
         if self.Connected:
-            __logger__.info(f'{self._proxy.get_object_path()}: Already connected.')
+            __logger__.info(f'{self._path}: Already connected.')
             return
-        self._proxy.Connect()
-        if self.Connected:
-            if not wait_for_services:
-                return
-        def check(properties):
-            value = None
-            if wait_for_services:
-                value = properties.lookup_value('ServicesResolved')
-            else:
-                value = properties.lookup_value('Connected')
-            if value is None:
-                return False
-            return value.get_boolean()
-        self._wait_property_change(check, timeout_ms)
+        if wait_for_services:
+            check = lambda d: d.ServicesResolved
+        else:
+            check = lambda d: d.Connected
+        self._wait_property_change(check, timeout_ms, lambda: _traced('Connect', self._proxy.Connect))
+     
+    def wait_services_resolved(self, timeout_ms=10000):
+        """Wait until BlueZ resolved the GATT services of the connected device.
+        
+        :Raises `Exception`: on timeout
+        """
+        self._wait_property_change(lambda d: d.ServicesResolved, timeout_ms)
      
     def disconnect(self, timeout_ms=10000):
         if not self.Connected:
-            __logger__.info(f'{self._proxy.get_object_path()}: Not connected.')
+            __logger__.info(f'{self._path}: Not connected.')
             return
-        def check(properties):
-            value = properties.lookup_value('Connected')
-            if value is None:
-                return False
-            return not value.get_boolean()
-        self._proxy.Disconnect()
-        self._wait_property_change(check, timeout_ms)
+        self._wait_property_change(lambda d: not d.Connected, timeout_ms,
+                                   lambda: _traced('Disconnect', self._proxy.Disconnect))
     
     def get_gattservices(self):
         """Get all GATT services associated with the device.
          
         :Returns: `{ str: bluez.GattService }`
         """
-        services = [GattService(self._bluez, path, BLUEZ_GATTSERVICE_INTERFACE) for path, ifaces in self._bluez._objects.items()
-                   if path.startswith(self._proxy.get_object_path()) and BLUEZ_GATTSERVICE_INTERFACE in ifaces]
+        services = [self._gattservice(path) for path in self._bluez._children(self._path, BLUEZ_GATTSERVICE_INTERFACE)]
         return {s.UUID: s for s in services}
+    
+    def get_gattservice(self, uuid):
+        """Get the GATT service with the given UUID.
+         
+        :Returns: a `bluez.GattService` or `None` if the device has no such service (yet)
+        """
+        paths = self._bluez._index.by_key(self._path, uuid, BLUEZ_GATTSERVICE_INTERFACE)
+        return self._gattservice(paths[0]) if paths else None
+    
+    def _gattservice(self, path):
+        return self._bluez._wrap(GattService, path, BLUEZ_GATTSERVICE_INTERFACE)
 
 class GattService(_BaseObject):
     def __init__(self, bluez, object_path, interface_name):
@@ -324,76 +1325,111 @@ class GattService(_BaseObject):
     
     @property
     def Primary(self):
-        return self._get_property('Primary').unpack()
+        return self._get_value('Primary')
     
     @property
     def UUID(self):
-        return self._get_property('UUID').unpack()
+        return self._get_value('UUID')
     
     def get_gattcharacteristics(self):
         """Get all GATT characteristics associated with the gatt service.
          
         :Returns: `{ str: bluez.GattCharacteristic }`
         """
-        characteristics = [GattCharacteristic(self._bluez, path, BLUEZ_GATTCHARACTERISTIC_INTERFACE) for path, ifaces in self._bluez._objects.items()
-                           if path.startswith(self._proxy.get_object_path()) and BLUEZ_GATTCHARACTERISTIC_INTERFACE in ifaces]
+        characteristics = [self._gattcharacteristic(path) for path in self._bluez._children(self._path, BLUEZ_GATTCHARACTERISTIC_INTERFACE)]
         return {c.UUID: c for c in characteristics}
+    
+    def get_gattcharacteristic(self, uuid):
+        """Get the GATT characteristic with the given UUID.
+         
+        :Returns: a `bluez.GattCharacteristic` or `None` if the service has no such characteristic
+        """
+        paths = self._bluez._index.by_key(self._path, uuid, BLUEZ_GATTCHARACTERISTIC_INTERFACE)
+        return self._gattcharacteristic(paths[0]) if paths else None
+    
+    def _gattcharacteristic(self, path):
+        return self._bluez._wrap(GattCharacteristic, path, BLUEZ_GATTCHARACTERISTIC_INTERFACE)
 
 class GattCharacteristic(_BaseObject):
-    OPTION_REQUEST = GLib.Variant.parse(None, "{'type': <'request'>}")
+    OPTION_REQUEST = _LazyVariant("{'type': <'request'>}")
     def __init__(self, bluez, object_path, interface_name):
         super().__init__(bluez, object_path, interface_name)
     
     @property
     def UUID(self):
-        return self._get_property('UUID').unpack()
+        return self._get_value('UUID')
     
     @property
     def Flags(self):
-        return self._get_property('Flags').unpack()
+        return self._get_value('Flags')
     
     @property
     def Notifying(self):
-        return self._get_property('Notifying').unpack()
+        return self._get_value('Notifying')
     
     @property
     def NotifyAcquired(self):
-        return self._get_property('NotifyAcquired').unpack()
+        return self._get_value('NotifyAcquired')
     
     @property
     def WriteAcquired(self):
-        return self._get_property('WriteAcquired').unpack()
+        return self._get_value('WriteAcquired')
     
     @property
     def Value(self):
-        return self._get_property('Value').unpack()
+        return self._get_value('Value')
     
     def StartNotify(self):
-        return self._proxy.StartNotify()
+        return _traced('StartNotify', self._proxy.StartNotify)
     
     def StopNotify(self):
-        return self._proxy.StopNotify()
+        return _traced('StopNotify', self._proxy.StopNotify)
     
     def AcquireNotify(self):
         fdl = Gio.UnixFDList()
-        v, fdl = self._proxy.call_with_unix_fd_list_sync('AcquireNotify', GLib.Variant.new_tuple(self.OPTION_REQUEST), Gio.DBusCallFlags.NONE, -1, fdl, None)
+        v, fdl = _traced('AcquireNotify', self._proxy.call_with_unix_fd_list_sync, 'AcquireNotify', GLib.Variant.new_tuple(self.OPTION_REQUEST), Gio.DBusCallFlags.NONE, -1, fdl, None)
         fdl_index, mtu = v.unpack()
         fd = fdl.get(fdl_index)
         return (fd, mtu)
     
-    def ReadValue(self):
-        value = self._proxy.call_sync('ReadValue', GLib.Variant.new_tuple(self.OPTION_REQUEST), Gio.DBusCallFlags.NONE, -1, None)
+    def AcquireWrite(self):
+        fdl = Gio.UnixFDList()
+        v, fdl = _traced('AcquireWrite', self._proxy.call_with_unix_fd_list_sync, 'AcquireWrite', GLib.Variant.new_tuple(self.OPTION_REQUEST), Gio.DBusCallFlags.NONE, -1, fdl, None)
+        fdl_index, mtu = v.unpack()
+        fd = fdl.get(fdl_index)
+        return (fd, mtu)
+    
+    def ReadValue(self, timeout_ms=-1):
+        value = _traced('ReadValue', self._proxy.call_sync, 'ReadValue', GLib.Variant.new_tuple(self.OPTION_REQUEST), Gio.DBusCallFlags.NONE, timeout_ms, None)
         return bytearray(value[0])
     
-    def WriteValue(self, data):
+    def WriteValue(self, data, timeout_ms=-1):
+        v = GLib.Variant('ay', bytearray(data))
+        return _traced('WriteValue', self._proxy.call_sync, 'WriteValue', GLib.Variant.new_tuple(v, self.OPTION_REQUEST), Gio.DBusCallFlags.NONE, timeout_ms, None)
+    
+    def submit_read(self, timeout_ms=-1):
+        """Issue ReadValue without blocking.
+        
+        :Returns: `concurrent.futures.Future` resolved with the value as `bytearray`
+        """
+        return self._call_future('ReadValue', GLib.Variant.new_tuple(self.OPTION_REQUEST), timeout_ms,
+                                 finish=lambda v: bytearray(v[0]))
+    
+    def submit_write(self, data, timeout_ms=-1):
+        """Issue WriteValue without blocking.
+        
+        :Returns: `concurrent.futures.Future` resolved once the write is acknowledged
+        """
         v = GLib.Variant('ay', bytearray(data))
-        return self._proxy.call_sync('WriteValue', GLib.Variant.new_tuple(v, self.OPTION_REQUEST), Gio.DBusCallFlags.NONE, -1, None)
+        return self._call_future('WriteValue', GLib.Variant.new_tuple(v, self.OPTION_REQUEST), timeout_ms)
     
     @contextmanager
-    def dbus_signal_notify(self):
+    def dbus_signal_notify(self, tap=None):
         """Get a context manager to receive notifications through a `queue.SimpleQueue` as `bytearray` items.
         Uses the PropertiesChanged DBus signal to receive the notifications.
         The contextmanager takes care of starting and stopping the notification emission.
+        Every notification is passed to `tap.record(data, timestamp)` before it is queued, if a `tap` such as a
+        `throughput_capture.CaptureWriter` is given.
         
         Example:
         with gatt_char.dbus_signal_notify() as q:
@@ -403,21 +1439,30 @@ class GattCharacteristic(_BaseObject):
                 print('Notification', i+1, ':', n)
         """
         sq = SimpleQueue()
-        def value_changed(proxy, changed, invalidated):
-            key = 'Value'
-            if key in changed.keys():
-                sq.put(bytearray(changed[key]))
-        hid = self._proxy.connect('g-properties-changed', value_changed)
+        def value_changed(bus, sender, path, interface, signal, parameters, data):
+            value = parameters.get_child_value(1).lookup_value('Value', None)
+            if value is not None:
+                n = bytearray(value.get_data_as_bytes().get_data())
+                if tap is not None:
+                    tap.record(n, time.monotonic())
+                sq.put(n)
+                if _instrumentation is not None:
+                    _instrumentation.record_wakeup(path, 1, sq.qsize())
+        bus = self._bluez._bus
+        sid = bus.signal_subscribe(BLUEZ_BUS_NAME, DBUS_PROPERTIES_INTERFACE, 'PropertiesChanged', self._path,
+                                   self._interface, Gio.DBusSignalFlags.NONE, value_changed, None)
         self.StartNotify()
         yield sq
         self.StopNotify()
-        self._proxy.disconnect(hid)
+        bus.signal_unsubscribe(sid)
     
     @contextmanager
-    def fd_notify(self):
-        """Get a context manager to receive notifications through a `queue.SimpleQueue` as `bytearray` items.
+    def fd_notify(self, tap=None):
+        """Get a context manager to receive notifications through a `queue.SimpleQueue` as `bytes` items.
         Uses the file descriptor returned by AcquireNotify to receive the notifications.
         The contextmanager takes care of acquiring and closing the file descriptor.
+        Every notification is passed to `tap.record(data, timestamp)` in the reader thread, if a `tap` such as
+        a `throughput_capture.CaptureWriter` is given.
         
         Example:
         with gatt_char.fd_notify() as q:
@@ -428,26 +1473,859 @@ class GattCharacteristic(_BaseObject):
         """
         sq = SimpleQueue()
         fd, mtu = self.AcquireNotify()
-        class ReadFd(threading.Thread):
-            def __init__(self):
-                super().__init__()
-                self._run = True
-            
-            def run(self):
-                with select.epoll() as ep:
-                    ep.register(fd, select.EPOLLIN)
-                    while self._run:
-                        events = ep.poll(timeout=0.1, maxevents=10)
-                        for pollfd, _ in events:
-                            if pollfd == fd:
-                                n = os.read(fd, mtu)
-                                sq.put(n)
-            
-            def stop(self):
-                self._run = False
-        rdt = ReadFd()
+        path = self._path
+        def drain():
+            count = 0
+            while True:
+                try:
+                    n = os.read(fd, mtu)
+                except BlockingIOError:
+                    alive = True
+                    break
+                if not n:
+                    alive = False
+                    break
+                if tap is not None:
+                    tap.record(n, time.monotonic())
+                sq.put(n)
+                count += 1
+            instrumentation = _instrumentation
+            if instrumentation is not None:
+                instrumentation.record_wakeup(path, count, sq.qsize())
+            return alive
+        os.set_blocking(fd, False)
+        rdt = _FdReader(fd, drain)
         rdt.start()
-        yield sq
-        rdt.stop()
-        rdt.join()
-        os.close(fd)
+        try:
+            yield sq
+        finally:
+            rdt.stop()
+            os.close(fd)
+    
+    @contextmanager
+    def fd_notify_batched(self, slabs=16, slots=32, tap=None):
+        """Get a context manager to receive notifications through a `queue.SimpleQueue` as `bluez.NotificationBatch` items.
+        Uses the file descriptor returned by AcquireNotify to receive the notifications.
+        
+        Every wakeup of the reader thread drains all pending notifications into a preallocated slab of
+        `slots` buffers with `socket.recv_into`, so no memory is allocated per notification.
+        A batch has to be released (`NotificationBatch.release()` or a `with` block) to give its slab back to
+        the reader. When all `slabs` are in use, the reader stops reading and the notifications are buffered by
+        the kernel socket. A `None` item is put into the queue when BlueZ closes the file descriptor, e.g. on
+        disconnection.
+        
+        Example:
+        with gatt_char.fd_notify_batched() as q:
+            with q.get() as batch:
+                for n in batch:
+                    print('Notification:', bytes(n))
+        
+        :Parameters:
+            `slabs` : int
+                Number of preallocated slabs
+            `slots` : int
+                Number of notification buffers per slab
+            `tap` : object
+                Gets every batch passed to `tap.record_batch(batch)` in the reader thread before it is queued,
+                e.g. a `throughput_capture.CaptureWriter`
+        """
+        sq = SimpleQueue()
+        fd, mtu = self.AcquireNotify()
+        sock = socket.socket(fileno=fd)
+        sock.setblocking(False)
+        pool = _SlabPool(slabs, slots, mtu)
+        path = self._path
+        def drain():
+            slab = pool.acquire()
+            if slab is None:
+                return True
+            lengths = []
+            alive = True
+            for view in slab.slots:
+                try:
+                    n = sock.recv_into(view, mtu)
+                except BlockingIOError:
+                    break
+                except OSError as e:
+                    __logger__.error(f'{self._path}: Receive failed: {e}')
+                    n = 0
+                if not n:
+                    alive = False
+                    break
+                lengths.append(n)
+            if lengths:
+                batch = NotificationBatch(pool, slab, lengths, time.monotonic())
+                if tap is not None:
+                    tap.record_batch(batch)
+                sq.put(batch)
+            else:
+                pool.release(slab)
+            instrumentation = _instrumentation
+            if instrumentation is not None:
+                instrumentation.record_wakeup(path, len(lengths), sq.qsize())
+            if not alive:
+                sq.put(None)
+            return alive
+        rdt = _FdReader(fd, drain, pool.close)
+        rdt.start()
+        try:
+            yield sq
+        finally:
+            rdt.stop()
+            sock.close()
+    
+    @contextmanager
+    def fd_notify_callback(self, callback, slots=32, tap=None):
+        """Get a context manager to receive notifications through `callback(batch)` calls in the GLib main loop
+        thread of the `Manager`.
+        Uses the file descriptor returned by AcquireNotify to receive the notifications.
+        
+        The file descriptor is watched by the main loop, which already dispatches the D-Bus signals; no reader
+        thread is started and no queue is involved. Every wakeup drains up to `slots` pending notifications into
+        a preallocated slab and passes them as `bluez.NotificationBatch` to `callback`. The slab is reused by the
+        next wakeup, so the batch is only valid until `callback` returns. `callback(None)` is called when BlueZ
+        closes the file descriptor, e.g. on disconnection.
+        
+        The callback must not block: it delays the notifications of all other subscriptions and the D-Bus
+        signals, and must not wait for property changes or method calls of the `Manager`. Exceptions raised by
+        it are logged.
+        
+        Example:
+        def on_batch(batch):
+            if batch is not None:
+                for n in batch:
+                    print('Notification:', bytes(n))
+        
+        with gatt_char.fd_notify_callback(on_batch):
+            time.sleep(5)
+        
+        :Parameters:
+            `callback` : callable
+                Called with every `bluez.NotificationBatch`
+            `slots` : int
+                Maximum number of notifications per batch
+            `tap` : object
+                Gets every batch passed to `tap.record_batch(batch)` before `callback` is called, e.g. a
+                `throughput_capture.CaptureWriter`
+        """
+        fd, mtu = self.AcquireNotify()
+        sock = socket.socket(fileno=fd)
+        sock.setblocking(False)
+        self._bluez._dispatcher.add(self._path, sock, mtu, callback, slots, tap)
+        try:
+            yield
+        finally:
+            self._bluez._dispatcher.remove(sock)
+            sock.close()
+    
+    @contextmanager
+    def fd_write(self, timeout_ms=1000):
+        """Get a context manager to write without response through a `bluez.FdWriter`.
+        Uses the file descriptor returned by AcquireWrite, every packet written to it is sent as one ATT Write
+        Command. The contextmanager takes care of acquiring and closing the file descriptor.
+        
+        Example:
+        with gatt_char.fd_write() as w:
+            w.write(b'\\x00' * 1000)
+        
+        :Parameters:
+            `timeout_ms` : int
+                Time to wait for the socket to become writable again when it is full
+        """
+        fd, mtu = self.AcquireWrite()
+        writer = FdWriter(fd, mtu, timeout_ms)
+        try:
+            yield writer
+        finally:
+            writer.close()
+
+class FdWriter:
+    """Writer to the file descriptor returned by AcquireWrite.
+    
+    Data is split into packets of at most `mtu - 3` bytes (the ATT MTU minus the Write Command header). The socket
+    is non-blocking: when the kernel socket buffer is full, i.e. the controller does not keep up, the writer
+    waits until it becomes writable again and counts a stall.
+    """
+    def __init__(self, fd, mtu, timeout_ms=1000):
+        self.mtu = mtu
+        self.max_payload = mtu - 3
+        self.bytes = 0
+        self.writes = 0
+        self.stalls = 0
+        self._timeout_ms = timeout_ms
+        self._sock = socket.socket(fileno=fd)
+        self._sock.setblocking(False)
+        self._poll = select.poll()
+        self._poll.register(self._sock, select.POLLOUT)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def write(self, data):
+        """Write `data`, split into packets of at most `max_payload` bytes.
+        
+        :Raises `Exception`: if the socket does not become writable within the timeout or got closed
+        """
+        view = memoryview(data)
+        for offset in range(0, len(view), self.max_payload):
+            self._send(view[offset:offset + self.max_payload])
+    
+    def write_many(self, packets):
+        """Write each item of `packets` as a separate packet, e.g. one notification sized payload per item."""
+        for p in packets:
+            self.write(p)
+    
+    def _send(self, packet):
+        while True:
+            try:
+                self._sock.send(packet)
+            except BlockingIOError:
+                self.stalls += 1
+                events = self._poll.poll(self._timeout_ms)
+                if not events:
+                    raise Exception('Timeout')
+                if events[0][1] & (select.POLLHUP | select.POLLERR):
+                    raise Exception('Closed')
+                continue
+            self.bytes += len(packet)
+            self.writes += 1
+            return
+    
+    def close(self):
+        self._sock.close()
+
+class GattSession:
+    """Remembers the GATT objects of a device to reconnect to it quickly.
+    
+    The first `connect` waits for `ServicesResolved` and remembers the object paths and flags of the services
+    and characteristics of the device, respectively only of the characteristics with the given `uuids`. BlueZ
+    keeps the GATT objects of devices whose GATT database it caches when they disconnect; if all remembered
+    objects are still exported on a later `connect`, the session only waits for `Connected` and returns the
+    characteristics without scanning the object tree again, so notifications can be acquired right away.
+    Otherwise the services are resolved again.
+    
+    The time from the start of `connect` to the first notification received through `notify_tap` is recorded
+    in `latency`, a `bluez.LatencyHistogram` over all connections, and in `last_latency`.
+    
+    Example:
+    session = GattSession(device, [data_uuid])
+    for i in range(100):
+        chars = session.connect()
+        with chars[data_uuid].fd_notify_batched(tap=session.notify_tap()) as q:
+            q.get().release()
+        device.disconnect()
+    print(session.latency.percentile(50))
+    """
+    def __init__(self, device, uuids=None):
+        """
+        :Parameters:
+            `device` : bluez.Device
+            `uuids` : [ str ]
+                UUIDs of the characteristics to remember, all characteristics of the device if `None`
+        """
+        self.device = device
+        self.address = device.Address
+        self.uuids = None if uuids is None else {u.lower() for u in uuids}
+        self.connects = 0
+        self.fast_connects = 0
+        self.latency = LatencyHistogram()
+        self.last_latency = None
+        self._characteristics = {}
+        self._started = None
+        self._first = threading.Event()
+    
+    @property
+    def cached(self):
+        """`True` if characteristics are remembered and BlueZ still exports all of them."""
+        index = self.device._bluez._index
+        return bool(self._characteristics) and all(
+            index.has(path, BLUEZ_GATTSERVICE_INTERFACE) and index.has(char_path, BLUEZ_GATTCHARACTERISTIC_INTERFACE)
+            for path, char_path, flags in self._characteristics.values())
+    
+    def flags(self, uuid):
+        """Returns the remembered `Flags` of the characteristic `uuid` or `None`."""
+        entry = self._characteristics.get(uuid.lower())
+        return None if entry is None else list(entry[2])
+    
+    def connect(self, timeout_ms=10000):
+        """Connect to the device and return its remembered characteristics.
+        
+        :Returns: `{ str: bluez.GattCharacteristic }`
+        :Raises `Exception`: on timeout
+        """
+        self._started = time.monotonic()
+        self._first.clear()
+        fast = self.cached
+        self.device.connect(wait_for_services=not fast, timeout_ms=timeout_ms)
+        if fast and not self.cached:
+            # The objects were removed while connecting, e.g. because the GATT database of the device changed
+            __logger__.info(f'{self.device.path}: GATT cache invalidated, resolve services.')
+            self.device._wait_property_change(lambda d: d.ServicesResolved or not d.Connected, timeout_ms)
+            fast = False
+        if not fast:
+            self._resolve()
+        self.connects += 1
+        self.fast_connects += fast
+        return self.characteristics()
+    
+    def characteristics(self):
+        """Returns the remembered characteristics, without checking that BlueZ still exports them.
+        
+        :Returns: `{ str: bluez.GattCharacteristic }`
+        """
+        return {uuid: self.device._gattservice(path)._gattcharacteristic(char_path)
+                for uuid, (path, char_path, flags) in self._characteristics.items()}
+    
+    def invalidate(self):
+        """Forget the remembered objects, the next `connect` resolves the services again."""
+        self._characteristics = {}
+    
+    def notify_tap(self, tap=None):
+        """Returns a tap for `GattCharacteristic.fd_notify`, `fd_notify_batched` or `fd_notify_callback`, which
+        records the latency of the first notification after `connect` and passes all notifications on to `tap`."""
+        return _FirstNotificationTap(self, tap)
+    
+    def wait_first_notification(self, timeout=None):
+        """Wait for the first notification after `connect`.
+        
+        :Returns: the latency in seconds or `None` on timeout
+        """
+        return self.last_latency if self._first.wait(timeout) else None
+    
+    def _first_notification(self, timestamp):
+        if self._started is None or self._first.is_set():
+            return
+        self.last_latency = timestamp - self._started
+        self.latency.record(self.last_latency)
+        self._first.set()
+    
+    def _resolve(self):
+        characteristics = {}
+        for service in self.device.get_gattservices().values():
+            for uuid, c in service.get_gattcharacteristics().items():
+                if self.uuids is None or uuid.lower() in self.uuids:
+                    characteristics[uuid.lower()] = (service.path, c.path, c.Flags or [])
+        self._characteristics = characteristics
+
+class _FirstNotificationTap:
+    """Tap of a `GattSession`, see `GattSession.notify_tap`."""
+    __slots__ = ('_session', '_tap')
+    
+    def __init__(self, session, tap):
+        self._session = session
+        self._tap = tap
+    
+    def record(self, data, timestamp):
+        self._session._first_notification(timestamp)
+        if self._tap is not None:
+            self._tap.record(data, timestamp)
+    
+    def record_batch(self, batch):
+        self._session._first_notification(batch.timestamp)
+        if self._tap is not None:
+            self._tap.record_batch(batch)
+
+class NotificationBatch:
+    """Notifications drained by one wakeup of a `GattCharacteristic.fd_notify_batched` reader or the
+    `GattCharacteristic.fd_notify_callback` dispatcher.
+    
+    Iterating a batch yields a `memoryview` per notification. The views point into a preallocated slab and
+    are only valid until the batch is released, respectively until the callback returned.
+    
+    The raw slab is available through `buffer`: notification `i` starts at `i * stride` and is
+    `lengths[i]` bytes long.
+    """
+    __slots__ = ('_pool', '_slab', 'lengths', 'timestamp')
+    
+    def __init__(self, pool, slab, lengths, timestamp):
+        self._pool = pool
+        self._slab = slab
+        self.lengths = lengths
+        self.timestamp = timestamp
+    
+    def __len__(self):
+        return len(self.lengths)
+    
+    def __getitem__(self, index):
+        return self._slab.slots[index][:self.lengths[index]]
+    
+    def __iter__(self):
+        slots = self._slab.slots
+        for i, n in enumerate(self.lengths):
+            yield slots[i][:n]
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.release()
+    
+    @property
+    def buffer(self):
+        return self._slab.buffer
+    
+    @property
+    def stride(self):
+        return self._slab.stride
+    
+    @property
+    def nbytes(self):
+        return sum(self.lengths)
+    
+    def release(self):
+        """Give the slab back to the reader. The batch must not be used afterwards."""
+        if self._slab is not None:
+            self._pool.release(self._slab)
+            self._slab = None
+
+class _Slab:
+    __slots__ = ('buffer', 'stride', 'slots')
+    
+    def __init__(self, slots, stride):
+        self.buffer = memoryview(bytearray(slots * stride))
+        self.stride = stride
+        self.slots = [self.buffer[i*stride:(i+1)*stride] for i in range(slots)]
+
+class _SlabPool:
+    def __init__(self, slabs, slots, stride):
+        self._free = SimpleQueue()
+        for _ in range(slabs):
+            self._free.put(_Slab(slots, stride))
+    
+    def acquire(self):
+        """Returns a free slab, blocks until one is released or `None` if the pool got closed."""
+        return self._free.get()
+    
+    def release(self, slab):
+        self._free.put(slab)
+    
+    def close(self):
+        # Wake up a reader blocked in acquire()
+        self._free.put(None)
+
+class _Subscription:
+    """Notification subscription of a `_NotificationDispatcher`, acts as slab pool of its batches."""
+    __slots__ = ('path', 'sock', 'mtu', 'slab', 'callback', 'tap', 'source')
+    
+    def __init__(self, path, sock, mtu, slots, callback, tap):
+        self.path = path
+        self.sock = sock
+        self.mtu = mtu
+        self.slab = _Slab(slots, mtu)
+        self.callback = callback
+        self.tap = tap
+        self.source = None
+    
+    def release(self, slab):
+        # The slab is reused by the next wakeup
+        pass
+
+class _NotificationDispatcher:
+    """Reads the notify sockets of all `GattCharacteristic.fd_notify_callback` subscriptions of a `Manager` in
+    its GLib main loop thread.
+    
+    The sockets are watched by unix fd sources of the main loop's context. They are added and removed in the
+    main loop thread, so once `remove` returned the callback of the subscription is not running and will not be
+    called again.
+    """
+    def __init__(self, manager):
+        self._manager = manager
+        self._subscriptions = {}
+    
+    def add(self, path, sock, mtu, callback, slots, tap=None):
+        sub = _Subscription(path, sock, mtu, slots, callback, tap)
+        def add():
+            sub.source = GLib.unix_fd_add_full(GLib.PRIORITY_HIGH, sock.fileno(),
+                                               GLib.IOCondition.IN | GLib.IOCondition.HUP | GLib.IOCondition.ERR,
+                                               self._readable, sub)
+            self._subscriptions[sock.fileno()] = sub
+        self._manager._call_in_loop(add)
+    
+    def remove(self, sock):
+        def remove():
+            sub = self._subscriptions.pop(sock.fileno(), None)
+            if sub is not None and sub.source is not None:
+                GLib.source_remove(sub.source)
+                sub.source = None
+        self._manager._call_in_loop(remove)
+    
+    def _readable(self, fd, condition, sub):
+        lengths = []
+        alive = True
+        mtu = sub.mtu
+        for view in sub.slab.slots:
+            try:
+                n = sub.sock.recv_into(view, mtu)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                __logger__.error(f'fd {fd}: Receive failed: {e}')
+                n = 0
+            if not n:
+                alive = False
+                break
+            lengths.append(n)
+        if lengths:
+            batch = NotificationBatch(sub, sub.slab, lengths, time.monotonic())
+            try:
+                if sub.tap is not None:
+                    sub.tap.record_batch(batch)
+                sub.callback(batch)
+            except Exception:
+                __logger__.exception(f'fd {fd}: Notification callback failed')
+        instrumentation = _instrumentation
+        if instrumentation is not None:
+            instrumentation.record_wakeup(sub.path, len(lengths))
+        if alive:
+            return True
+        __logger__.debug(f'fd {fd}: Closed by remote.')
+        self._subscriptions.pop(fd, None)
+        sub.source = None
+        try:
+            sub.callback(None)
+        except Exception:
+            __logger__.exception(f'fd {fd}: Notification callback failed')
+        return False
+
+class _FdReader(threading.Thread):
+    """Thread calling `drain` whenever `fd` is readable.
+    
+    `drain` has to read everything that is pending and return `False` once the file descriptor got closed by
+    the remote side. `stop()` wakes the thread through a pipe, so it terminates immediately.
+    """
+    def __init__(self, fd, drain, wakeup=None):
+        super().__init__(daemon=True)
+        self._fd = fd
+        self._drain = drain
+        self._wakeup = wakeup
+        self._run = True
+        self._wake_r, self._wake_w = os.pipe()
+    
+    def run(self):
+        with select.epoll() as ep:
+            ep.register(self._fd, select.EPOLLIN)
+            ep.register(self._wake_r, select.EPOLLIN)
+            while self._run:
+                for pollfd, event in ep.poll():
+                    if pollfd != self._fd or not self._run:
+                        continue
+                    try:
+                        alive = self._drain()
+                    except OSError as e:
+                        __logger__.error(f'fd {self._fd}: Read failed: {e}')
+                        alive = False
+                    if not alive:
+                        __logger__.debug(f'fd {self._fd}: Closed by remote.')
+                        ep.unregister(self._fd)
+    
+    def stop(self):
+        self._run = False
+        if self._wakeup:
+            self._wakeup()
+        os.write(self._wake_w, b'\0')
+        self.join()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+class _AsyncMixin:
+    """Helpers bridging Gio callbacks, which run in the GLib main loop thread of the `Manager`, to asyncio futures."""
+    @staticmethod
+    def _resolve(loop, fut, result=None, exception=None):
+        def resolve():
+            if fut.done():
+                return
+            if exception is not None:
+                fut.set_exception(exception)
+            else:
+                fut.set_result(result)
+        loop.call_soon_threadsafe(resolve)
+    
+    async def _call(self, method, args=None, timeout_ms=-1):
+        # Cancelling the awaiting task cancels the D-Bus call
+        return await asyncio.wrap_future(self._call_future(method, args, timeout_ms))
+    
+    async def _call_with_unix_fd_list(self, method, args=None, timeout_ms=-1):
+        return await asyncio.wrap_future(self._call_future(method, args, timeout_ms, Gio.UnixFDList()))
+    
+    async def _wait_async(self, key, check, timeout_ms, action=None):
+        """Register `check` with the waiter registry of the `Manager`, await `action` and wait until the check
+        passed. The check is evaluated once `action` completed as well.
+        
+        :Returns: the result of the check
+        :Raises `Exception`: on timeout
+        """
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        waiters = self._bluez._waiters
+        waiter = waiters.add(key, check, lambda result: self._resolve(loop, fut, result))
+        try:
+            if action:
+                await action()
+            waiter.evaluate()
+            return await asyncio.wait_for(fut, timeout_ms / 1000)
+        except asyncio.TimeoutError:
+            raise Exception('Timeout')
+        finally:
+            waiters.remove(key, waiter)
+    
+    async def _wait_property_change_async(self, check_fn, timeout_ms, action=None):
+        await self._wait_async(self._path, lambda: check_fn(self), timeout_ms, action)
+
+class AsyncManager(Manager):
+    """asyncio front end of the bluez module.
+    
+    D-Bus calls are issued asynchronously and their results are delivered to the running event loop, so one
+    event loop can drive many devices without a thread per operation. The objects returned by this manager
+    are `AsyncAdapter`, `AsyncDevice`, `AsyncGattService` and `AsyncGattCharacteristic` instances.
+    
+    Example:
+    async def main():
+        mgr = AsyncManager()
+        a = mgr.get_adapter()
+        device = await a.discover_device(lambda d: uuid in d.UUIDs)
+        await device.connect()
+    """
+    def __init__(self, *args, **kwargs):
+        _import_asyncio()
+        super().__init__(*args, **kwargs)
+    
+    def _adapter(self, path):
+        return self._wrap(AsyncAdapter, path, BLUEZ_ADAPTER_INTERFACE)
+
+class AsyncAdapter(_AsyncMixin, Adapter):
+    async def start_discovery(self, timeout_ms=1000):
+        """Start device discovery.
+        
+        :Returns: `None`
+        """
+        if self.Discovering:
+            __logger__.info(f'{self._path}: Already discovering.')
+            return
+        await self._wait_property_change_async(lambda a: a.Discovering, timeout_ms, lambda: self._call('StartDiscovery'))
+    
+    async def stop_discovery(self, timeout_ms=1000):
+        """Stop device discovery.
+        
+        :Returns: `None`
+        """
+        if not self.Discovering:
+            __logger__.info(f'{self._path}: Not discovering.')
+            return
+        await self._wait_property_change_async(lambda a: not a.Discovering, timeout_ms, lambda: self._call('StopDiscovery'))
+    
+    async def set_discovery_filter(self, discovery_filter=None):
+        """Set the discovery filter of this client, see `Adapter.set_discovery_filter`."""
+        await self._call('SetDiscoveryFilter', _discovery_filter_variant(discovery_filter))
+    
+    async def discover_device(self, check_fn=None, timeout_ms=10000, discovery_filter=None):
+        """Discover the first device for which `check_fn(device)` returns `True`.
+        
+        :Returns: a `bluez.AsyncDevice` or `None` if no device matched within `timeout_ms`
+        """
+        scan = self.scan(check_fn, timeout_ms, discovery_filter)
+        try:
+            async for device in scan:
+                return device
+            return None
+        finally:
+            await scan.aclose()
+    
+    async def scan(self, check_fn=None, timeout_ms=None, discovery_filter=None):
+        """Asynchronously iterate over the devices for which `check_fn(device)` returns `True` as they are found.
+        See `Adapter.scan`. Discovery is stopped when the generator is closed, so close it with `aclose()` when
+        leaving the iteration early.
+        
+        Example:
+        scan = adapter.scan(discovery_filter={'UUIDs': [uuid], 'Transport': 'le'})
+        async for device in scan:
+            print('Found', device)
+            break
+        await scan.aclose()
+        """
+        loop = asyncio.get_running_loop()
+        path = self._path
+        key = (path, BLUEZ_DEVICE_INTERFACE)
+        found = asyncio.Queue()
+        check = self._scan_check(check_fn, discovery_filter, lambda c: loop.call_soon_threadsafe(found.put_nowait, c))
+        waiter = self._bluez._waiters.add(key, check, lambda result: None)
+        deadline = None if timeout_ms is None else loop.time() + timeout_ms / 1000
+        discovering = False
+        try:
+            check()
+            await asyncio.sleep(0)
+            while True:
+                if found.empty() and not discovering:
+                    if discovery_filter:
+                        await self.set_discovery_filter(discovery_filter)
+                    await self.start_discovery()
+                    discovering = True
+                try:
+                    timeout = None if deadline is None else max(0, deadline - loop.time())
+                    child = await asyncio.wait_for(found.get(), timeout)
+                except asyncio.TimeoutError:
+                    return
+                yield self._device(child)
+        finally:
+            self._bluez._waiters.remove(key, waiter)
+            if discovering:
+                await self.stop_discovery()
+                if discovery_filter:
+                    await self.set_discovery_filter(None)
+    
+    def _device(self, path):
+        return self._bluez._wrap(AsyncDevice, path, BLUEZ_DEVICE_INTERFACE)
+
+class AsyncDevice(_AsyncMixin, Device):
+    async def connect(self, wait_for_services=True, timeout_ms=10000):
+        if self.Connected:
+            __logger__.info(f'{self._path}: Already connected.')
+            return
+        if wait_for_services:
+            check = lambda d: d.ServicesResolved
+        else:
+            check = lambda d: d.Connected
+        await self._wait_property_change_async(check, timeout_ms, lambda: self._call('Connect', None, timeout_ms))
+    
+    async def disconnect(self, timeout_ms=10000):
+        if not self.Connected:
+            __logger__.info(f'{self._path}: Not connected.')
+            return
+        await self._wait_property_change_async(lambda d: not d.Connected, timeout_ms,
+                                               lambda: self._call('Disconnect', None, timeout_ms))
+    
+    def _gattservice(self, path):
+        return self._bluez._wrap(AsyncGattService, path, BLUEZ_GATTSERVICE_INTERFACE)
+
+class AsyncGattService(GattService):
+    def _gattcharacteristic(self, path):
+        return self._bluez._wrap(AsyncGattCharacteristic, path, BLUEZ_GATTCHARACTERISTIC_INTERFACE)
+
+class AsyncGattCharacteristic(_AsyncMixin, GattCharacteristic):
+    async def StartNotify(self):
+        return await self._call('StartNotify')
+    
+    async def StopNotify(self):
+        return await self._call('StopNotify')
+    
+    async def AcquireNotify(self, timeout_ms=-1):
+        v, fdl = await self._call_with_unix_fd_list('AcquireNotify', GLib.Variant.new_tuple(self.OPTION_REQUEST), timeout_ms)
+        fdl_index, mtu = v.unpack()
+        fd = fdl.get(fdl_index)
+        return (fd, mtu)
+    
+    async def ReadValue(self, timeout_ms=-1):
+        value = await self._call('ReadValue', GLib.Variant.new_tuple(self.OPTION_REQUEST), timeout_ms)
+        return bytearray(value[0])
+    
+    async def WriteValue(self, data, timeout_ms=-1):
+        v = GLib.Variant('ay', bytearray(data))
+        return await self._call('WriteValue', GLib.Variant.new_tuple(v, self.OPTION_REQUEST), timeout_ms)
+    
+    def fd_notify(self, max_pending=1024, max_reads=64):
+        """Get an asynchronous context manager to receive notifications through an async iterator of `bytes` items.
+        Uses the file descriptor returned by AcquireNotify, which is watched with `loop.add_reader`.
+        The iteration ends when BlueZ closes the file descriptor, e.g. on disconnection.
+        
+        Every wakeup reads at most `max_reads` notifications, so a fast link does not hold the event loop. When
+        `max_pending` notifications are not consumed yet, the file descriptor is not watched until half of them
+        are consumed and the notifications are buffered by the kernel socket, like with the blocking readers.
+        
+        Example:
+        async with gatt_char.fd_notify() as notifications:
+            async for n in notifications:
+                print('Notification:', n)
+        
+        :Parameters:
+            `max_pending` : int
+                Number of received notifications not consumed yet at which reading pauses
+            `max_reads` : int
+                Maximum number of notifications read per wakeup
+        """
+        return _AsyncNotificationStream(self, max_pending, max_reads)
+
+class _AsyncNotificationStream:
+    def __init__(self, characteristic, max_pending, max_reads):
+        self._characteristic = characteristic
+        self._max_pending = max_pending
+        self._max_reads = max_reads
+        self._sock = None
+        self._mtu = 0
+        self._pending = collections.deque()
+        self._waiter = None
+        self._reading = False
+        self._closed = False
+    
+    async def __aenter__(self):
+        self._loop = asyncio.get_running_loop()
+        fd, self._mtu = await self._characteristic.AcquireNotify()
+        self._sock = socket.socket(fileno=fd)
+        self._sock.setblocking(False)
+        self._resume()
+        return self
+    
+    async def __aexit__(self, *exc):
+        self.close()
+    
+    def __aiter__(self):
+        return self
+    
+    async def __anext__(self):
+        while not self._pending:
+            if self._closed:
+                raise StopAsyncIteration
+            self._waiter = self._loop.create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        n = self._pending.popleft()
+        if not self._reading and not self._closed and len(self._pending) <= self._max_pending // 2:
+            self._resume()
+        return n
+    
+    def _resume(self):
+        self._loop.add_reader(self._sock.fileno(), self._readable)
+        self._reading = True
+    
+    def _pause(self):
+        self._loop.remove_reader(self._sock.fileno())
+        self._reading = False
+    
+    def _readable(self):
+        count = 0
+        while count < self._max_reads:
+            try:
+                n = self._sock.recv(self._mtu)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                __logger__.error(f'{self._characteristic._path}: Receive failed: {e}')
+                n = b''
+            if not n:
+                self._pause()
+                self._closed = True
+                break
+            self._pending.append(n)
+            count += 1
+        if self._reading and len(self._pending) >= self._max_pending:
+            # Leave the notifications in the socket until the consumer caught up
+            self._pause()
+        instrumentation = _instrumentation
+        if instrumentation is not None:
+            instrumentation.record_wakeup(self._characteristic._path, count, len(self._pending))
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+    
+    def close(self):
+        if self._sock is None:
+            return
+        if self._reading:
+            self._pause()
+        self._closed = True
+        self._sock.close()
+        self._sock = None
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
@@ -0,0 +1,863 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2021 Martin Roesch
+# SPDX-License-Identifier: Apache-2.0
+
+"""Mock BlueZ D-Bus service for offline benchmarking and testing of the host side.
+
+`MockBluez` starts a private `dbus-daemon`, owns the name `org.bluez` on it and exports an adapter
+(`/org/bluez/hci0`) with peripherals hosting the throughput GATT service. The peripherals appear when discovery
+is started; connecting resolves their GATT service with the Config, Data, Statistics and Sink characteristics.
+Notifications of the Data characteristic are sent over the socket returned by AcquireNotify (or as
+PropertiesChanged signals after StartNotify) at the interval and size written to the Config characteristic, which
+accepts the legacy and the extended layout with bursts, MTU sized notifications and limits.
+An interval of 0 sends notifications as fast as the socket accepts them, like the saturation mode of the firmware.
+Packets written to the socket returned by AcquireWrite of the Sink characteristic are counted like the firmware
+does; reading the Sink characteristic returns the byte and packet counters. The Statistics characteristic counts
+the attempted and sent Data notifications like the firmware, notifications dropped on a full socket count as out
+of buffers.
+
+`bluez.Manager` connects to the mock when its `bus_address` argument or the `BLUEZ_DBUS_ADDRESS` environment
+variable is set to the address of the private bus:
+
+$ ./bluez_mock.py serve --devices 2
+BLUEZ_DBUS_ADDRESS=unix:abstract=/tmp/dbus-...
+$ BLUEZ_DBUS_ADDRESS=unix:abstract=/tmp/dbus-... ./throughput_test.py -i 1 -l 244 -n 10000
+"""
+
+import argparse
+import logging
+import os
+import select
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from gi.repository import Gio, GLib
+
+__logger__ = logging.getLogger('bluez_mock')
+
+SERVICE_UUID = 'abcdef00-f5bf-58d5-9d17-172177d1316a'
+CONFIG_UUID = 'abcdef01-f5bf-58d5-9d17-172177d1316a'
+DATA_UUID = 'abcdef02-f5bf-58d5-9d17-172177d1316a'
+STATISTICS_UUID = 'abcdef03-f5bf-58d5-9d17-172177d1316a'
+SINK_UUID = 'abcdef04-f5bf-58d5-9d17-172177d1316a'
+
+ADAPTER_PATH = '/org/bluez/hci0'
+
+STATISTICS_FORMAT = struct.Struct('<6IHHBB')
+CONFIG_LEGACY_FORMAT = struct.Struct('<HB')
+CONFIG_FORMAT = struct.Struct('<HBBBBII')
+CONFIG_VERSION = 1
+CONFIG_FLAG_MTU_FIT = 0x01
+
+INTROSPECTION_XML = '''
+<node>
+  <interface name="org.freedesktop.DBus.ObjectManager">
+    <method name="GetManagedObjects">
+      <arg name="objects" type="a{oa{sa{sv}}}" direction="out"/>
+    </method>
+    <signal name="InterfacesAdded">
+      <arg name="object" type="o"/>
+      <arg name="interfaces" type="a{sa{sv}}"/>
+    </signal>
+    <signal name="InterfacesRemoved">
+      <arg name="object" type="o"/>
+      <arg name="interfaces" type="as"/>
+    </signal>
+  </interface>
+  <interface name="org.bluez.Adapter1">
+    <method name="StartDiscovery"/>
+    <method name="StopDiscovery"/>
+    <method name="SetDiscoveryFilter">
+      <arg name="filter" type="a{sv}" direction="in"/>
+    </method>
+    <method name="RemoveDevice">
+      <arg name="device" type="o" direction="in"/>
+    </method>
+    <property name="Address" type="s" access="read"/>
+    <property name="Name" type="s" access="read"/>
+    <property name="Alias" type="s" access="read"/>
+    <property name="Powered" type="b" access="read"/>
+    <property name="Discovering" type="b" access="read"/>
+    <property name="UUIDs" type="as" access="read"/>
+  </interface>
+  <interface name="org.bluez.Device1">
+    <method name="Connect"/>
+    <method name="Disconnect"/>
+    <property name="Address" type="s" access="read"/>
+    <property name="Name" type="s" access="read"/>
+    <property name="Alias" type="s" access="read"/>
+    <property name="Adapter" type="o" access="read"/>
+    <property name="RSSI" type="n" access="read"/>
+    <property name="Connected" type="b" access="read"/>
+    <property name="ServicesResolved" type="b" access="read"/>
+    <property name="Paired" type="b" access="read"/>
+    <property name="UUIDs" type="as" access="read"/>
+  </interface>
+  <interface name="org.bluez.GattService1">
+    <property name="UUID" type="s" access="read"/>
+    <property name="Primary" type="b" access="read"/>
+    <property name="Device" type="o" access="read"/>
+  </interface>
+  <interface name="org.bluez.GattCharacteristic1">
+    <method name="ReadValue">
+      <arg name="options" type="a{sv}" direction="in"/>
+      <arg name="value" type="ay" direction="out"/>
+    </method>
+    <method name="WriteValue">
+      <arg name="value" type="ay" direction="in"/>
+      <arg name="options" type="a{sv}" direction="in"/>
+    </method>
+    <method name="StartNotify"/>
+    <method name="StopNotify"/>
+    <method name="AcquireNotify">
+      <arg name="options" type="a{sv}" direction="in"/>
+      <arg name="fd" type="h" direction="out"/>
+      <arg name="mtu" type="q" direction="out"/>
+    </method>
+    <method name="AcquireWrite">
+      <arg name="options" type="a{sv}" direction="in"/>
+      <arg name="fd" type="h" direction="out"/>
+      <arg name="mtu" type="q" direction="out"/>
+    </method>
+    <property name="UUID" type="s" access="read"/>
+    <property name="Service" type="o" access="read"/>
+    <property name="Flags" type="as" access="read"/>
+    <property name="Notifying" type="b" access="read"/>
+    <property name="NotifyAcquired" type="b" access="read"/>
+    <property name="WriteAcquired" type="b" access="read"/>
+    <property name="Value" type="ay" access="read"/>
+  </interface>
+</node>
+'''
+
+_PROPERTY_TYPES = {i.name: {p.name: p.signature for p in i.properties}
+                   for i in Gio.DBusNodeInfo.new_for_xml(INTROSPECTION_XML).interfaces}
+
+class DBusError(Exception):
+    def __init__(self, name, message):
+        super().__init__(message)
+        self.name = name
+
+class _Object:
+    """An exported object: its interfaces with their properties and an optional method handler."""
+    def __init__(self, path, interfaces):
+        self.path = path
+        self.interfaces = {name: {k: GLib.Variant(_PROPERTY_TYPES[name][k], v) for k, v in props.items()}
+                           for name, props in interfaces.items()}
+        self.registrations = []
+        self._variant = None
+
+    @property
+    def variant(self):
+        """The interfaces as `a{sa{sv}}`, cached until a property changes."""
+        if self._variant is None:
+            self._variant = GLib.Variant('a{sa{sv}}', self.interfaces)
+        return self._variant
+
+class _Peripheral:
+    """State of a mocked throughput peripheral."""
+    def __init__(self, mock, index, interval, data_len, mtu, adapter=ADAPTER_PATH):
+        self.mock = mock
+        self.adapter = adapter
+        self.address = f'C0:FF:EE:00:{index >> 8:02X}:{index & 0xFF:02X}'
+        self.path = f'{adapter}/dev_{self.address.replace(":", "_")}'
+        self.service_path = self.path + '/service000a'
+        self.config_path = self.service_path + '/char000b'
+        self.data_path = self.service_path + '/char000d'
+        self.statistics_path = self.service_path + '/char0010'
+        self.sink_path = self.service_path + '/char0013'
+        self.interval = interval
+        self.data_len = data_len
+        self.burst = 1
+        self.flags = 0
+        self.max_notifications = 0
+        self.duration_ms = 0
+        self.config_extended = False
+        self.mtu = mtu
+        self.notifier = None
+        self.sink = None
+        self.sink_bytes = 0
+        self.sink_writes = 0
+        self.statistics_source = None
+        self.unreachable_until = 0.0
+        self.reset_statistics()
+
+    @property
+    def data(self):
+        n = self.mtu - 3 if self.flags & CONFIG_FLAG_MTU_FIT else self.data_len
+        return bytes(i & 0xFF for i in range(n))
+
+    @property
+    def config(self):
+        """Value of the Config characteristic in the layout of the last write."""
+        if not self.config_extended:
+            return CONFIG_LEGACY_FORMAT.pack(self.interval, self.data_len)
+        return CONFIG_FORMAT.pack(self.interval, self.data_len, CONFIG_VERSION, self.burst, self.flags,
+                                  self.max_notifications, self.duration_ms)
+
+    def write_config(self, value):
+        """:Returns: `False` if `value` has neither the legacy nor the extended layout"""
+        if len(value) == CONFIG_LEGACY_FORMAT.size:
+            self.interval, self.data_len = CONFIG_LEGACY_FORMAT.unpack(value)
+            self.burst, self.flags, self.max_notifications, self.duration_ms = 1, 0, 0, 0
+            self.config_extended = False
+            return True
+        if len(value) != CONFIG_FORMAT.size or value[3] != CONFIG_VERSION:
+            return False
+        (self.interval, self.data_len, _, burst, self.flags, self.max_notifications,
+         self.duration_ms) = CONFIG_FORMAT.unpack(value)
+        self.burst = max(1, burst)
+        self.config_extended = True
+        return True
+
+    def reset_statistics(self):
+        self.attempted = 0
+        self.sent = 0
+        self.sent_bytes = 0
+        self.err_nomem = 0
+        self.err_notconn = 0
+
+    @property
+    def statistics(self):
+        """Value of the Statistics characteristic: a 7.5 ms connection interval on the 2M PHY."""
+        return STATISTICS_FORMAT.pack(self.attempted, self.sent, self.sent_bytes, self.err_nomem, self.err_notconn, 0,
+                                      self.mtu, 6, 2, 2)
+
+class _Notifier(threading.Thread):
+    """Sends the Data notifications of a peripheral, either to an acquired socket or as Value property changes."""
+    def __init__(self, peripheral, sock=None):
+        super().__init__(daemon=True)
+        self.peripheral = peripheral
+        self.sock = sock
+        self.sent = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        p = self.peripheral
+        data = p.data
+        interval = p.interval / 1000
+        burst = p.burst if interval > 0 else 1
+        start = time.monotonic()
+        end = start + p.duration_ms / 1000 if p.duration_ms else None
+        next_time = start + interval
+        try:
+            while not self._stop_event.is_set() and not self._limit_reached(end):
+                if interval > 0:
+                    delay = next_time - time.monotonic()
+                    if delay > 0 and self._stop_event.wait(delay):
+                        break
+                    next_time += interval
+                elif self.sock is not None and not select.select([], [self.sock], [], 0.01)[1]:
+                    # Saturation mode waits for a free TX buffer instead of failing
+                    continue
+                for i in range(burst):
+                    if self._limit_reached(end) or not self._notify(data):
+                        break
+            # Like the firmware, stay subscribed after a limit was reached until the host unsubscribes
+            while not self._stop_event.is_set():
+                if self.sock is None:
+                    self._stop_event.wait()
+                elif select.select([self.sock], [], [], 0.1)[0]:
+                    break
+        except OSError as e:
+            __logger__.debug(f'{p.data_path}: Notification socket closed: {e}')
+        finally:
+            if self.sock is not None:
+                self.sock.close()
+                p.mock._set_property(p.data_path, 'org.bluez.GattCharacteristic1', 'NotifyAcquired', False)
+            p.mock._set_property(p.data_path, 'org.bluez.GattCharacteristic1', 'Notifying', False)
+
+    def released(self):
+        """`True` if the host closed the acquired socket."""
+        try:
+            return self.sock is not None and bool(select.select([self.sock], [], [], 0)[0])
+        except (OSError, ValueError):
+            return True
+
+    def _limit_reached(self, end):
+        p = self.peripheral
+        return (p.max_notifications and self.sent >= p.max_notifications) or (end and time.monotonic() >= end)
+
+    def _notify(self, data):
+        """:Returns: `False` if the notification was dropped"""
+        p = self.peripheral
+        p.attempted += 1
+        if self.sock is None:
+            p.mock._set_property(p.data_path, 'org.bluez.GattCharacteristic1', 'Value', data)
+            self._sent(len(data))
+            return True
+        try:
+            self.sock.send(data)
+        except BlockingIOError:
+            # The host is not reading fast enough, like a full controller TX queue
+            p.err_nomem += 1
+            self._stop_event.wait(0.0005)
+            return False
+        except OSError:
+            # Like a notification after the host unsubscribed
+            p.err_notconn += 1
+            raise
+        self._sent(len(data))
+        return True
+
+    def _sent(self, n):
+        self.sent += 1
+        self.peripheral.sent += 1
+        self.peripheral.sent_bytes += n
+
+    def stop(self):
+        self._stop_event.set()
+
+class _Sink(threading.Thread):
+    """Counts the bytes and packets written to the socket returned by AcquireWrite of the Sink characteristic."""
+    def __init__(self, peripheral, sock):
+        super().__init__(daemon=True)
+        self.peripheral = peripheral
+        self.sock = sock
+
+    def run(self):
+        p = self.peripheral
+        buf = bytearray(p.mtu)
+        try:
+            while True:
+                n = self.sock.recv_into(buf)
+                if not n:
+                    break
+                p.sink_bytes += n
+                p.sink_writes += 1
+        except OSError:
+            pass
+        finally:
+            self.sock.close()
+            p.mock._set_property(p.sink_path, 'org.bluez.GattCharacteristic1', 'WriteAcquired', False)
+
+    def drain(self, timeout=1.0):
+        """Wait until the pending packets are counted, as a read on the peripheral is queued behind them."""
+        deadline = time.monotonic() + timeout
+        while self.is_alive() and time.monotonic() < deadline:
+            try:
+                if not select.select([self.sock], [], [], 0)[0]:
+                    return
+            except (OSError, ValueError):
+                return
+            time.sleep(0.001)
+
+    def stop(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+class MockBluez:
+    """Mock `org.bluez` service on a private bus.
+
+    :Parameters:
+        `devices` : int
+            Number of throughput peripherals that appear on discovery
+        `adapters` : int
+            Number of adapters, hci0 to hciN. Every adapter discovers the same `devices` peripherals, which are
+            mocked independently per adapter
+        `cached_devices` : int
+            Number of devices without the throughput service that are known from the start, to populate the
+            object tree like a BlueZ cache
+        `interval` : int
+            Initial `interval_ms` of the Config characteristic
+        `data_len` : int
+            Initial `data_length` of the Config characteristic
+        `mtu` : int
+            MTU returned by AcquireNotify
+        `discovery_delay_ms` : int
+            Delay after StartDiscovery until the peripherals appear
+        `connect_delay_ms` : int
+            Delay of Connect until the device is connected
+        `resolve_delay_ms` : int
+            Delay after the connection until the services are resolved
+        `gatt_delay_ms` : int
+            Delay of the replies to ReadValue and WriteValue, like the round trip to the peripheral
+        `keep_gatt_cache` : bool
+            Keep the GATT objects on disconnection, like BlueZ does for devices with a GATT cache
+        `statistics_interval_ms` : int
+            Interval of the Statistics characteristic notifications
+    """
+    def __init__(self, devices=1, cached_devices=0, interval=100, data_len=10, mtu=247, discovery_delay_ms=100,
+                 connect_delay_ms=20, resolve_delay_ms=50, gatt_delay_ms=0, keep_gatt_cache=False,
+                 statistics_interval_ms=1000, adapters=1):
+        self._adapters = [f'/org/bluez/hci{i}' for i in range(adapters)]
+        self._peripherals = [_Peripheral(self, i + 1, interval, data_len, mtu, adapter)
+                             for adapter in self._adapters for i in range(devices)]
+        self._by_path = {}
+        for p in self._peripherals:
+            for path in (p.path, p.config_path, p.data_path, p.statistics_path, p.sink_path):
+                self._by_path[path] = p
+        self._cached_devices = cached_devices
+        self._discovery_delay_ms = discovery_delay_ms
+        self._connect_delay_ms = connect_delay_ms
+        self._resolve_delay_ms = resolve_delay_ms
+        self.gatt_delay_ms = gatt_delay_ms
+        self._keep_gatt_cache = keep_gatt_cache
+        self.statistics_interval_ms = statistics_interval_ms
+        self._objects = {}
+        self._lock = threading.RLock()
+        self._daemon = None
+        self._conn = None
+        self._thread = None
+        self.address = None
+        self.discovery_filter = {}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        """Start the private bus and the mock service.
+
+        :Returns: the address of the private bus
+        """
+        dbus_daemon = shutil.which('dbus-daemon')
+        if dbus_daemon is None:
+            raise Exception('dbus-daemon not found')
+        self._daemon = subprocess.Popen([dbus_daemon, '--session', '--nofork', '--print-address=1'],
+                                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        self.address = self._daemon.stdout.readline().strip()
+        started = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(started,), daemon=True)
+        self._thread.start()
+        started.wait()
+        return self.address
+
+    def stop(self):
+        for p in self._peripherals:
+            if p.notifier:
+                p.notifier.stop()
+        if self._thread:
+            self._context.invoke_full(GLib.PRIORITY_DEFAULT, lambda: self._loop.quit() and False)
+            self._thread.join()
+            self._thread = None
+        if self._daemon:
+            self._daemon.terminate()
+            self._daemon.wait()
+            self._daemon.stdout.close()
+            self._daemon = None
+
+    def drop_link(self, index=0, outage_ms=0):
+        """Simulate the loss of the link to a peripheral, e.g. by a supervision timeout.
+
+        The peripheral is disconnected as if the remote side went away and Connect fails for `outage_ms`.
+
+        :Parameters:
+            `index` : int
+                Index of the peripheral
+        """
+        p = self._peripherals[index]
+        p.unreachable_until = time.monotonic() + outage_ms / 1000
+        self._context.invoke_full(GLib.PRIORITY_DEFAULT, lambda: self._Device1_Disconnect(p.path) and False)
+
+    def _run(self, started):
+        self._context = GLib.MainContext()
+        self._context.push_thread_default()
+        self._loop = GLib.MainLoop(self._context)
+        self._conn = Gio.DBusConnection.new_for_address_sync(
+            self.address,
+            Gio.DBusConnectionFlags.AUTHENTICATION_CLIENT | Gio.DBusConnectionFlags.MESSAGE_BUS_CONNECTION,
+            None, None)
+        self._node_info = Gio.DBusNodeInfo.new_for_xml(INTROSPECTION_XML)
+        self._register('/', {'org.freedesktop.DBus.ObjectManager': {}}, announce=False)
+        for i, adapter in enumerate(self._adapters):
+            self._register(adapter, {'org.bluez.Adapter1': {
+                'Address': f'00:1A:7D:DA:71:{0x13 + i:02X}', 'Name': 'mock', 'Alias': 'mock', 'Powered': True,
+                'Discovering': False, 'UUIDs': []}})
+        for i in range(self._cached_devices):
+            address = f'CA:CE:00:00:{i >> 8 & 0xFF:02X}:{i & 0xFF:02X}'
+            self._register(f'{ADAPTER_PATH}/dev_{address.replace(":", "_")}',
+                           {'org.bluez.Device1': self._device_properties(address, f'cached{i}', [])})
+        self._conn.call_sync('org.freedesktop.DBus', '/org/freedesktop/DBus', 'org.freedesktop.DBus', 'RequestName',
+                             GLib.Variant('(su)', ('org.bluez', 4)), GLib.VariantType('(u)'),
+                             Gio.DBusCallFlags.NONE, -1, None)
+        started.set()
+        self._loop.run()
+        self._context.pop_thread_default()
+
+    def _timeout(self, delay_ms, fn):
+        source = GLib.timeout_source_new(delay_ms)
+        source.set_callback(lambda *args: fn() and False)
+        source.attach(self._context)
+
+    @staticmethod
+    def _device_properties(address, name, uuids, adapter=ADAPTER_PATH):
+        return {'Address': address, 'Name': name, 'Alias': name, 'Adapter': adapter, 'RSSI': -42,
+                'Connected': False, 'ServicesResolved': False, 'Paired': False, 'UUIDs': uuids}
+
+    def _register(self, path, interfaces, announce=True):
+        obj = _Object(path, interfaces)
+        for name in interfaces:
+            info = self._node_info.lookup_interface(name)
+            obj.registrations.append(self._conn.register_object(path, info, self._method_call, self._get_property, None))
+        with self._lock:
+            self._objects[path] = obj
+        if announce:
+            self._conn.emit_signal(None, '/', 'org.freedesktop.DBus.ObjectManager', 'InterfacesAdded',
+                                   GLib.Variant.new_tuple(GLib.Variant('o', path), self._interfaces_variant(obj)))
+
+    def _unregister(self, path):
+        with self._lock:
+            obj = self._objects.pop(path, None)
+        if obj is None:
+            return
+        for r in obj.registrations:
+            self._conn.unregister_object(r)
+        self._conn.emit_signal(None, '/', 'org.freedesktop.DBus.ObjectManager', 'InterfacesRemoved',
+                               GLib.Variant('(oas)', (path, list(obj.interfaces))))
+
+    @staticmethod
+    def _interfaces_variant(obj):
+        return obj.variant
+
+    def _set_property(self, path, interface, name, value):
+        with self._lock:
+            obj = self._objects.get(path)
+            if obj is None:
+                return
+            variant = GLib.Variant(_PROPERTY_TYPES[interface][name], value)
+            obj.interfaces[interface][name] = variant
+            obj._variant = None
+        self._conn.emit_signal(None, path, 'org.freedesktop.DBus.Properties', 'PropertiesChanged',
+                               GLib.Variant.new_tuple(GLib.Variant('s', interface), GLib.Variant('a{sv}', {name: variant}),
+                                                      GLib.Variant('as', [])))
+
+    def _get(self, path, interface, name):
+        with self._lock:
+            return self._objects[path].interfaces[interface][name].unpack()
+
+    def _get_property(self, conn, sender, path, interface, name):
+        with self._lock:
+            return self._objects[path].interfaces[interface][name]
+
+    def _method_call(self, conn, sender, path, interface, method, parameters, invocation):
+        handler = getattr(self, f'_{interface.rpartition(".")[2]}_{method}', None)
+        try:
+            if handler is None:
+                raise DBusError('org.bluez.Error.NotSupported', f'{interface}.{method} not supported')
+            result = handler(path, *parameters.unpack())
+        except DBusError as e:
+            result = e
+        def reply():
+            if isinstance(result, DBusError):
+                invocation.return_dbus_error(result.name, str(result))
+            elif isinstance(result, tuple):
+                invocation.return_value_with_unix_fd_list(*result)
+            elif result is not None:
+                invocation.return_value(result)
+        if self.gatt_delay_ms and method in ('ReadValue', 'WriteValue'):
+            self._timeout(self.gatt_delay_ms, reply)
+        else:
+            reply()
+
+    # org.freedesktop.DBus.ObjectManager
+    def _ObjectManager_GetManagedObjects(self, path):
+        with self._lock:
+            entries = [GLib.Variant.new_dict_entry(GLib.Variant.new_object_path(p), o.variant)
+                       for p, o in self._objects.items() if p != '/']
+        return GLib.Variant.new_tuple(GLib.Variant.new_array(GLib.VariantType('{oa{sa{sv}}}'), entries))
+
+    # org.bluez.Adapter1
+    def _Adapter1_StartDiscovery(self, path):
+        if self._get(path, 'org.bluez.Adapter1', 'Discovering'):
+            raise DBusError('org.bluez.Error.InProgress', 'Operation already in progress')
+        self._set_property(path, 'org.bluez.Adapter1', 'Discovering', True)
+        def discovered():
+            uuids = [u.lower() for u in self.discovery_filter.get('UUIDs', [])]
+            if uuids and SERVICE_UUID not in uuids:
+                return
+            if self.discovery_filter.get('RSSI', -127) > -42:
+                return
+            for p in self._peripherals:
+                if p.adapter == path and p.path not in self._objects and \
+                        self._get(path, 'org.bluez.Adapter1', 'Discovering'):
+                    self._register(p.path, {'org.bluez.Device1': self._device_properties(p.address, 'TP', [SERVICE_UUID],
+                                                                                         path)})
+        self._timeout(self._discovery_delay_ms, discovered)
+        return GLib.Variant('()', ())
+
+    def _Adapter1_StopDiscovery(self, path):
+        if not self._get(path, 'org.bluez.Adapter1', 'Discovering'):
+            raise DBusError('org.bluez.Error.Failed', 'No discovery started')
+        self._set_property(path, 'org.bluez.Adapter1', 'Discovering', False)
+        return GLib.Variant('()', ())
+
+    def _Adapter1_SetDiscoveryFilter(self, path, filter):
+        self.discovery_filter = filter
+        return GLib.Variant('()', ())
+
+    def _Adapter1_RemoveDevice(self, path, device):
+        p = self._by_path.get(device)
+        if p is not None:
+            self._remove_gatt(p)
+        self._unregister(device)
+        return GLib.Variant('()', ())
+
+    # org.bluez.Device1
+    def _Device1_Connect(self, path):
+        p = self._by_path.get(path)
+        if p is None:
+            raise DBusError('org.bluez.Error.Failed', 'Software caused connection abort')
+        if self._get(path, 'org.bluez.Device1', 'Connected'):
+            return GLib.Variant('()', ())
+        if time.monotonic() < p.unreachable_until:
+            raise DBusError('org.bluez.Error.Failed', 'le-connection-abort-by-local')
+        def connected():
+            p.sink_bytes = p.sink_writes = 0
+            p.reset_statistics()
+            p.config_extended = False
+            self._set_property(path, 'org.bluez.Device1', 'Connected', True)
+            self._timeout(self._resolve_delay_ms, resolved)
+        def resolved():
+            if not self._get(path, 'org.bluez.Device1', 'Connected'):
+                return
+            if p.service_path not in self._objects:
+                self._add_gatt(p)
+            self._set_property(path, 'org.bluez.Device1', 'ServicesResolved', True)
+        self._timeout(self._connect_delay_ms, connected)
+        return GLib.Variant('()', ())
+
+    def _Device1_Disconnect(self, path):
+        p = self._by_path.get(path)
+        if p is not None and p.notifier:
+            p.notifier.stop()
+        if p is not None and p.sink:
+            p.sink.stop()
+        if p is not None:
+            self._stop_statistics(p)
+        if self._get(path, 'org.bluez.Device1', 'Connected'):
+            self._set_property(path, 'org.bluez.Device1', 'ServicesResolved', False)
+            self._set_property(path, 'org.bluez.Device1', 'Connected', False)
+            if p is not None and not self._keep_gatt_cache:
+                self._remove_gatt(p)
+        return GLib.Variant('()', ())
+
+    def _add_gatt(self, p):
+        self._register(p.service_path, {'org.bluez.GattService1': {
+            'UUID': SERVICE_UUID, 'Primary': True, 'Device': p.path}})
+        for path, uuid, flags in ((p.config_path, CONFIG_UUID, ['read', 'write']),
+                                  (p.data_path, DATA_UUID, ['notify']),
+                                  (p.statistics_path, STATISTICS_UUID, ['read', 'notify']),
+                                  (p.sink_path, SINK_UUID, ['read', 'write-without-response'])):
+            self._register(path, {'org.bluez.GattCharacteristic1': {
+                'UUID': uuid, 'Service': p.service_path, 'Flags': flags, 'Notifying': False,
+                'NotifyAcquired': False, 'WriteAcquired': False, 'Value': b''}})
+
+    def _remove_gatt(self, p):
+        for path in (p.config_path, p.data_path, p.statistics_path, p.sink_path, p.service_path):
+            self._unregister(path)
+
+    # org.bluez.GattCharacteristic1
+    def _connected_peripheral(self, path):
+        p = self._by_path.get(path)
+        if p is None or not self._get(p.path, 'org.bluez.Device1', 'Connected'):
+            raise DBusError('org.bluez.Error.Failed', 'Not connected')
+        return p
+
+    def _GattCharacteristic1_ReadValue(self, path, options):
+        p = self._connected_peripheral(path)
+        if path == p.config_path:
+            value = p.config
+        elif path == p.statistics_path:
+            value = p.statistics
+        elif path == p.sink_path:
+            if p.sink:
+                p.sink.drain()
+            value = struct.pack('<II', p.sink_bytes, p.sink_writes)
+        else:
+            raise DBusError('org.bluez.Error.NotPermitted', 'Read not permitted')
+        return GLib.Variant('(ay)', (value,))
+
+    def _GattCharacteristic1_WriteValue(self, path, value, options):
+        p = self._connected_peripheral(path)
+        if path != p.config_path:
+            raise DBusError('org.bluez.Error.NotPermitted', 'Write not permitted')
+        if not p.write_config(bytes(value)):
+            raise DBusError('org.bluez.Error.InvalidValueLength', 'Invalid value length')
+        return GLib.Variant('()', ())
+
+    def _start_notifier(self, p, sock=None):
+        if p.notifier and p.notifier.is_alive():
+            if not p.notifier.released():
+                raise DBusError('org.bluez.Error.InProgress', 'Notify already enabled')
+            # The host closed the socket before the notifier noticed
+            p.notifier.stop()
+            p.notifier.join()
+        p.notifier = _Notifier(p, sock)
+        self._set_property(p.data_path, 'org.bluez.GattCharacteristic1', 'Notifying', True)
+        p.notifier.start()
+
+    def _start_statistics(self, p):
+        if p.statistics_source is not None:
+            raise DBusError('org.bluez.Error.InProgress', 'Notify already enabled')
+        def notify():
+            self._set_property(p.statistics_path, 'org.bluez.GattCharacteristic1', 'Value', p.statistics)
+            return True
+        p.statistics_source = GLib.timeout_source_new(self.statistics_interval_ms)
+        p.statistics_source.set_callback(lambda *args: notify())
+        p.statistics_source.attach(self._context)
+        self._set_property(p.statistics_path, 'org.bluez.GattCharacteristic1', 'Notifying', True)
+
+    def _stop_statistics(self, p):
+        if p.statistics_source is None:
+            return
+        p.statistics_source.destroy()
+        p.statistics_source = None
+        self._set_property(p.statistics_path, 'org.bluez.GattCharacteristic1', 'Notifying', False)
+
+    def _GattCharacteristic1_StartNotify(self, path):
+        p = self._connected_peripheral(path)
+        if path == p.statistics_path:
+            self._start_statistics(p)
+        elif path == p.data_path:
+            self._start_notifier(p)
+        else:
+            raise DBusError('org.bluez.Error.NotSupported', 'Notify not supported')
+        return GLib.Variant('()', ())
+
+    def _GattCharacteristic1_StopNotify(self, path):
+        p = self._by_path.get(path)
+        if p is not None and path == p.statistics_path:
+            self._stop_statistics(p)
+        elif p is not None and p.notifier:
+            p.notifier.stop()
+        return GLib.Variant('()', ())
+
+    def _GattCharacteristic1_AcquireNotify(self, path, options):
+        p = self._connected_peripheral(path)
+        if path != p.data_path:
+            raise DBusError('org.bluez.Error.NotSupported', 'Notify not supported')
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        ours.setblocking(False)
+        fd_list = Gio.UnixFDList()
+        index = fd_list.append(theirs.fileno())
+        theirs.close()
+        self._set_property(path, 'org.bluez.GattCharacteristic1', 'NotifyAcquired', True)
+        self._start_notifier(p, ours)
+        return (GLib.Variant('(hq)', (index, p.mtu)), fd_list)
+
+    def _GattCharacteristic1_AcquireWrite(self, path, options):
+        p = self._connected_peripheral(path)
+        if path != p.sink_path:
+            raise DBusError('org.bluez.Error.NotSupported', 'Write without response not supported')
+        if p.sink and p.sink.is_alive():
+            raise DBusError('org.bluez.Error.NotPermitted', 'Write acquired')
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        fd_list = Gio.UnixFDList()
+        index = fd_list.append(theirs.fileno())
+        theirs.close()
+        self._set_property(path, 'org.bluez.GattCharacteristic1', 'WriteAcquired', True)
+        p.sink = _Sink(p, ours)
+        p.sink.start()
+        return (GLib.Variant('(hq)', (index, p.mtu)), fd_list)
+
+def _serve(args):
+    mock = MockBluez(args.devices, args.cached, args.interval, args.length, keep_gatt_cache=args.keep_gatt_cache,
+                     adapters=args.adapters)
+    address = mock.start()
+    print(f'BLUEZ_DBUS_ADDRESS={address}', flush=True)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *a: stop.set())
+    try:
+        stop.wait()
+    except KeyboardInterrupt:
+        pass
+    mock.stop()
+
+def _benchmark(args):
+    """Measure discovery, connection and fd notification throughput of the bluez module against a mock
+    running in a separate process."""
+    import bluez
+    from throughput_stats import NotificationStats, format_summary
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'serve', '--devices', '1',
+                               '--cached', str(args.cached), '--interval', str(args.interval), '--length',
+                               str(args.length)], stdout=subprocess.PIPE, text=True)
+    try:
+        address = server.stdout.readline().strip().partition('=')[2]
+        t0 = time.monotonic()
+        mgr = bluez.Manager(bus_address=address)
+        a = mgr.get_adapter()
+        t1 = time.monotonic()
+        device = a.discover_device(lambda d: SERVICE_UUID in d.UUIDs)
+        t2 = time.monotonic()
+        device.connect()
+        t3 = time.monotonic()
+        print(f'Manager: {(t1 - t0) * 1000:.3f} ms, discovery: {(t2 - t1) * 1000:.3f} ms, '
+              f'connect: {(t3 - t2) * 1000:.3f} ms')
+        data_char = device.get_gattservice(SERVICE_UUID).get_gattcharacteristic(DATA_UUID)
+        stats = NotificationStats()
+        # Time from the wakeup of the reader to the batch reaching the consumer
+        delays = []
+        cpu = time.process_time()
+        if args.mode == 'callback':
+            done = threading.Event()
+            def on_batch(batch):
+                if batch is None or done.is_set():
+                    done.set()
+                    return
+                stats.record_batch(batch.lengths[:args.num - len(stats)], batch.timestamp)
+                delays.append(time.monotonic() - batch.timestamp)
+                if len(stats) >= args.num:
+                    done.set()
+            with data_char.fd_notify_callback(on_batch):
+                done.wait()
+        else:
+            with data_char.fd_notify_batched() as q:
+                while len(stats) < args.num:
+                    batch = q.get()
+                    if batch is None:
+                        break
+                    with batch:
+                        delays.append(time.monotonic() - batch.timestamp)
+                        stats.record_batch(batch.lengths[:args.num - len(stats)], batch.timestamp)
+        cpu = time.process_time() - cpu
+        if stats:
+            for line in format_summary(stats.summary()):
+                print(line)
+            delays.sort()
+            print(f'{args.mode}: {cpu:.3f} s CPU, {cpu / len(stats) * 1e6:.2f} us per notification, '
+                  f'{len(delays)} batches, delivery delay p50: {delays[len(delays) // 2] * 1e6:.1f} us, '
+                  f'p99: {delays[len(delays) * 99 // 100] * 1e6:.1f} us')
+        else:
+            print(f'{args.mode}: notifications stopped before the first one was received')
+        device.disconnect()
+    finally:
+        server.terminate()
+        server.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock BlueZ service.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    serve = sub.add_parser('serve', help='Run the mock and print the address of its bus')
+    serve.add_argument('--devices', type=int, default=1, help='Number of throughput peripherals')
+    serve.add_argument('--keep-gatt-cache', action='store_true', help='Keep GATT objects on disconnection')
+    serve.add_argument('--adapters', type=int, default=1, help='Number of adapters')
+    bench = sub.add_parser('benchmark', help='Benchmark the bluez module against the mock')
+    bench.add_argument('-n', '--num', type=int, default=100000, help='Number of notifications to receive')
+    bench.add_argument('-m', '--mode', choices=('batched', 'callback'), default='batched',
+                       help='Receive through fd_notify_batched or fd_notify_callback')
+    for p in (serve, bench):
+        p.add_argument('--cached', type=int, default=0, help='Number of additional cached devices')
+        p.add_argument('-i', '--interval', type=int, default=0, help='Initial notification interval in ms, 0: unpaced')
+        p.add_argument('-l', '--length', type=int, default=244, help='Initial notification size in bytes')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'serve':
+        _serve(args)
+    else:
+        _benchmark(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,693 @@
+# Copyright (c) 2021 Martin Roesch
+# SPDX-License-Identifier: Apache-2.0
+
+import asyncio
+import contextlib
+import io
+import shutil
+import subprocess
+import unittest
+import struct
+import threading
+import time
+from queue import Empty
+
+from gi.repository import GLib
+
+import bluez
+import connection_benchmark
+from bluez_mock import MockBluez, SERVICE_UUID, CONFIG_UUID, DATA_UUID, STATISTICS_UUID, SINK_UUID
+from throughput_integrity import DeliveryReport, PeripheralStatistics
+import throughput_test
+from throughput_test import ThroughputConfig, negotiate_config, write_config
+
+class TestCase01_MockBluez(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.mock = MockBluez(devices=2, cached_devices=3, interval=1, data_len=20)
+        cls.mock.start()
+        cls.manager = bluez.Manager(bus_address=cls.mock.address)
+        cls.adapter = cls.manager.get_adapter('hci0')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.mock.stop()
+
+    def test_01_CachedDevices(self):
+        # When
+        devices = self.adapter.get_devices()
+
+        # Then
+        self.assertGreaterEqual(len(devices), 3)
+
+    def test_02_Discovery(self):
+        # When
+        devices = self.adapter.discover_devices(lambda d: SERVICE_UUID in d.UUIDs, 2, 5000)
+
+        # Then
+        self.assertEqual(len(devices), 2)
+        self.assertEqual(len(self.adapter.get_devices(SERVICE_UUID)), 2)
+
+    def test_03_ConnectConfigureNotify(self):
+        # Given
+        device = self.adapter.discover_device(lambda d: SERVICE_UUID in d.UUIDs, 5000)
+
+        # When
+        device.connect()
+        try:
+            service = device.get_gattservice(SERVICE_UUID)
+            configChar = service.get_gattcharacteristic(CONFIG_UUID)
+            dataChar = service.get_gattcharacteristic(DATA_UUID)
+            configChar.WriteValue(struct.pack('HB', 0, 100))
+            config = struct.unpack('HB', bytes(configChar.ReadValue()))
+            lengths = []
+            with dataChar.fd_notify_batched() as q:
+                while len(lengths) < 1000:
+                    with q.get(timeout=5) as batch:
+                        lengths.extend(batch.lengths)
+                        data = bytes(batch[0])
+        finally:
+            device.disconnect()
+
+        # Then
+        self.assertEqual(config, (0, 100))
+        self.assertEqual(set(lengths), {100})
+        self.assertEqual(data, bytes(range(100)))
+        self.assertFalse(device.Connected)
+
+    def test_04_WriteWithoutResponse(self):
+        # Given
+        device = self.adapter.discover_device(lambda d: SERVICE_UUID in d.UUIDs, 5000)
+        device.connect()
+
+        # When
+        try:
+            sinkChar = device.get_gattservice(SERVICE_UUID).get_gattcharacteristic(SINK_UUID)
+            with sinkChar.fd_write() as w:
+                w.write_many([bytes(100)] * 1000)
+                w.write(bytes(w.max_payload + 1))
+            counter = struct.unpack('<II', bytes(sinkChar.ReadValue()))
+        finally:
+            device.disconnect()
+
+        # Then
+        self.assertEqual(w.writes, 1002)
+        self.assertEqual(w.bytes, 100000 + w.max_payload + 1)
+        self.assertEqual(counter, (w.bytes, w.writes))
+
+    def test_05_CallBatch(self):
+        # Given
+        device = self.adapter.discover_device(lambda d: SERVICE_UUID in d.UUIDs, 5000)
+        device.connect()
+        self.mock.gatt_delay_ms = 100
+
+        # When
+        try:
+            configChar = device.get_gattservice(SERVICE_UUID).get_gattcharacteristic(CONFIG_UUID)
+            batch = bluez.CallBatch(timeout_ms=2000)
+            start = time.monotonic()
+            batch.write(configChar, struct.pack('HB', 20, 30))
+            for i in range(10):
+                batch.read(configChar)
+            results = batch.wait()
+            duration = time.monotonic() - start
+            with self.assertRaises(Exception):
+                configChar.submit_read(timeout_ms=10).result()
+        finally:
+            self.mock.gatt_delay_ms = 0
+            device.disconnect()
+
+        # Then
+        self.assertEqual(len(results), 11)
+        self.assertEqual({bytes(r) for r in results[1:]}, {struct.pack('HB', 20, 30)})
+        self.assertLess(duration, 0.5)
+
+    def test_06_FilteredScan(self):
+        # Given
+        for d in self.adapter.get_devices(SERVICE_UUID):
+            self.adapter._proxy.RemoveDevice('(o)', d._proxy.get_object_path())
+
+        # When
+        rejected = self.adapter.discover_device(timeout_ms=500, discovery_filter={'RSSI': -20})
+        devices = []
+        for d in self.adapter.scan(timeout_ms=5000, discovery_filter={'UUIDs': [SERVICE_UUID], 'Transport': 'le'}):
+            devices.append(d)
+            if len(devices) == 2:
+                break
+
+        # Then
+        self.assertIsNone(rejected)
+        self.assertEqual(len(devices), 2)
+        self.assertFalse(self.adapter.Discovering)
+        self.assertEqual(self.mock.discovery_filter, {})
+
+    def test_07_Statistics(self):
+        # Given
+        device = self.adapter.discover_device(lambda d: SERVICE_UUID in d.UUIDs, 5000)
+        device.connect()
+
+        # When
+        try:
+            service = device.get_gattservice(SERVICE_UUID)
+            service.get_gattcharacteristic(CONFIG_UUID).WriteValue(struct.pack('HB', 1, 20))
+            statsChar = service.get_gattcharacteristic(STATISTICS_UUID)
+            before = PeripheralStatistics.unpack(bytes(statsChar.ReadValue()))
+            received = 0
+            with service.get_gattcharacteristic(DATA_UUID).fd_notify_batched() as q:
+                while received < 200:
+                    with q.get(timeout=5) as batch:
+                        received += len(batch)
+            after = PeripheralStatistics.unpack(bytes(statsChar.ReadValue()))
+        finally:
+            device.disconnect()
+        report = DeliveryReport(before, after, received)
+
+        # Then
+        self.assertGreaterEqual(report.attempted, received)
+        self.assertEqual(report.peripheral.sent - report.host_dropped, received)
+        self.assertEqual(report.peripheral.mtu, 247)
+
+    def test_08_ExtendedConfig(self):
+        # Given
+        device = self.adapter.discover_device(lambda d: SERVICE_UUID in d.UUIDs, 5000)
+        device.connect()
+
+        # When
+        try:
+            service = device.get_gattservice(SERVICE_UUID)
+            configChar = service.get_gattcharacteristic(CONFIG_UUID)
+            legacy = len(configChar.ReadValue())
+            version = negotiate_config(configChar).version
+            write_config(configChar, 10, 20, version, burst=5, flags=ThroughputConfig.FLAG_MTU_FIT,
+                         max_notifications=50)
+            config = ThroughputConfig.unpack(configChar.ReadValue())
+            lengths = []
+            with service.get_gattcharacteristic(DATA_UUID).fd_notify_batched() as q:
+                try:
+                    while True:
+                        with q.get(timeout=0.5) as batch:
+                            lengths.extend(batch.lengths)
+                except Empty:
+                    pass
+            write_config(configChar, 1, 20)
+            restored = len(configChar.ReadValue())
+        finally:
+            device.disconnect()
+
+        # Then
+        self.assertEqual((legacy, version, restored), (3, 1, 3))
+        self.assertEqual((config.interval, config.burst, config.max_notifications), (10, 5, 50))
+        self.assertEqual(lengths, [244] * 50)
+
+    def test_09_NotificationCallback(self):
+        # Given
+        device = self.adapter.discover_device(lambda d: SERVICE_UUID in d.UUIDs, 5000)
+        device.connect()
+        received = []
+        threads = set()
+        done = threading.Event()
+        def on_batch(batch):
+            threads.add(threading.current_thread())
+            received.append(None if batch is None else [bytes(n) for n in batch])
+            if batch is None or sum(len(b) for b in received) >= 500:
+                done.set()
+
+        # When
+        try:
+            service = device.get_gattservice(SERVICE_UUID)
+            service.get_gattcharacteristic(CONFIG_UUID).WriteValue(struct.pack('HB', 0, 50))
+            with service.get_gattcharacteristic(DATA_UUID).fd_notify_callback(on_batch, slots=8):
+                completed = done.wait(5)
+            count = len(received)
+            time.sleep(0.1)
+        finally:
+            device.disconnect()
+
+        # Then
+        self.assertTrue(completed)
+        self.assertNotIn(None, received)
+        self.assertLessEqual(max(len(b) for b in received), 8)
+        self.assertEqual({n for b in received for n in b}, {bytes(range(50))})
+        self.assertEqual(len(received), count)
+        self.assertEqual(threads, {self.manager._mainloop})
+
+    def test_10_Snapshot(self):
+        # Given
+        device = self.adapter.discover_device(lambda d: SERVICE_UUID in d.UUIDs, 5000)
+        uuids = device.UUIDs
+        uuids.append('modified')
+
+        # When
+        before = {r.address: r for r in self.adapter.snapshot()}
+        device.connect()
+        try:
+            during = {r.address: r for r in self.adapter.snapshot(SERVICE_UUID)}
+        finally:
+            device.disconnect()
+
+        # Then
+        self.assertGreaterEqual(len(before), 5)
+        self.assertIn(device.Address, during)
+        self.assertEqual(set(during) - set(before), set())
+        self.assertFalse(before[device.Address].connected)
+        self.assertTrue(during[device.Address].connected)
+        self.assertFalse(device.Connected)
+        self.assertEqual(during[device.Address].uuids, device.UUIDs)
+        self.assertNotIn('modified', device.UUIDs)
+        self.assertEqual(self.adapter.device(during[device.Address]), device)
+
+    def test_11_Instrumentation(self):
+        # Given
+        device = self.adapter.discover_device(lambda d: SERVICE_UUID in d.UUIDs, 5000)
+        instrumentation = bluez.enable_instrumentation()
+
+        # When
+        try:
+            device.connect()
+            try:
+                service = device.get_gattservice(SERVICE_UUID)
+                configChar = service.get_gattcharacteristic(CONFIG_UUID)
+                configChar.WriteValue(struct.pack('HB', 0, 20))
+                for i in range(5):
+                    configChar.ReadValue()
+                dataChar = service.get_gattcharacteristic(DATA_UUID)
+                received = 0
+                with dataChar.fd_notify_batched() as q:
+                    while received < 100:
+                        with q.get(timeout=5) as batch:
+                            received += len(batch)
+            finally:
+                device.disconnect()
+        finally:
+            self.assertIs(bluez.disable_instrumentation(), instrumentation)
+        snapshot = instrumentation.snapshot()
+
+        # Then
+        self.assertEqual(snapshot['calls']['ReadValue']['count'], 5)
+        self.assertEqual({'Connect', 'Disconnect', 'WriteValue', 'AcquireNotify'} - set(snapshot['calls']), set())
+        self.assertGreaterEqual(snapshot['signals'][device._path]['PropertiesChanged'], 2)
+        self.assertGreaterEqual(snapshot['readers'][dataChar._path]['notifications'], 100)
+        self.assertGreater(len(instrumentation.report()), 3)
+
+    def test_12_ReceiveMultiFailedLink(self):
+        # Given
+        devices = self.adapter.discover_devices(lambda d: SERVICE_UUID in d.UUIDs, 2, 5000)
+        for d in devices:
+            d.connect()
+        chars = [d.get_gattservice(SERVICE_UUID).get_gattcharacteristics() for d in devices]
+        # The Config characteristic does not support AcquireNotify
+        links = {devices[0]: chars[0][DATA_UUID], devices[1]: chars[1][CONFIG_UUID]}
+
+        # When
+        try:
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                results = throughput_test.receive_multi(links, 50, 1, 20, timeout=2.0)
+                throughput_test.print_multi_summary(results)
+        finally:
+            for d in devices:
+                d.disconnect()
+
+        # Then
+        self.assertEqual(len(devices), 2)
+        self.assertGreaterEqual(results[0].notifications, 50)
+        self.assertIsNone(results[0].error)
+        self.assertIsNone(results[1].stats)
+        self.assertIsNotNone(results[1].error)
+        self.assertIn('over 1 of 2 links', out.getvalue())
+
+    def test_13_CollectWarmup(self):
+        # Given
+        device = self.adapter.discover_device(lambda d: SERVICE_UUID in d.UUIDs, 5000)
+        device.connect()
+
+        # When
+        try:
+            dataChar = device.get_gattservice(SERVICE_UUID).get_gattcharacteristic(DATA_UUID)
+            stats, checker = throughput_test.collect(dataChar, 25, 20, warmup=7, timeout=2.0)
+        finally:
+            device.disconnect()
+
+        # Then
+        self.assertEqual(len(stats), 25)
+        self.assertEqual(checker.notifications, 25)
+        self.assertEqual(checker.valid, 25)
+
+    def test_14_ConfigureAllExtended(self):
+        # Given
+        devices = self.adapter.discover_devices(lambda d: SERVICE_UUID in d.UUIDs, 2, 5000)
+
+        # When
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                chars = throughput_test.connect_all(devices)
+                links, configs = throughput_test.configure_all(chars, 10, 20, burst=4,
+                                                               flags=ThroughputConfig.FLAG_MTU_FIT)
+                results = throughput_test.receive_multi(links, 40, 10, 20, timeout=2.0, configs=configs)
+            written = [ThroughputConfig.unpack(chars[d][CONFIG_UUID].ReadValue()) for d in devices]
+            for d in devices:
+                write_config(chars[d][CONFIG_UUID], 1, 20)
+        finally:
+            for d in devices:
+                d.disconnect()
+
+        # Then
+        self.assertEqual(len(links), 2)
+        self.assertEqual([(c.version, c.burst, c.data_len) for c in configs.values()], [(1, 4, 244)] * 2)
+        self.assertEqual([(c.interval, c.burst, c.flags) for c in written], [(10, 4, 1)] * 2)
+        self.assertEqual([r.interval for r in results], [2.5, 2.5])
+        self.assertEqual([(r.checker.notifications, r.checker.valid) for r in results], [(r.notifications,) * 2
+                                                                                           for r in results])
+
+    def test_15_SlabPoolExhausted(self):
+        # Given
+        device = self.adapter.discover_device(lambda d: SERVICE_UUID in d.UUIDs, 5000)
+        device.connect()
+
+        # When
+        try:
+            service = device.get_gattservice(SERVICE_UUID)
+            configChar = service.get_gattcharacteristic(CONFIG_UUID)
+            write_config(configChar, 1, 20, negotiate_config(configChar).version, max_notifications=100)
+            with service.get_gattcharacteristic(DATA_UUID).fd_notify_batched(slabs=2, slots=4) as q:
+                held = [q.get(timeout=2), q.get(timeout=2)]
+                # Both slabs are held, the reader waits for one and the notifications stay in the socket
+                with self.assertRaises(Empty):
+                    q.get(timeout=0.3)
+                received = sum(len(b) for b in held)
+                for batch in held:
+                    batch.release()
+                try:
+                    while True:
+                        with q.get(timeout=0.5) as batch:
+                            received += len(batch)
+                except Empty:
+                    pass
+            write_config(configChar, 1, 20)
+        finally:
+            device.disconnect()
+
+        # Then
+        self.assertEqual(received, 100)
+
+class TestCase02_ScopedManager(unittest.TestCase):
+    def test_01_DeviceScope(self):
+        # Given
+        with MockBluez(devices=0, cached_devices=3) as mock:
+            scope = '/org/bluez/hci0/dev_CA_CE_00_00_00_01'
+
+            # When
+            manager = bluez.Manager(bus_address=mock.address, scope=scope)
+            adapter = manager.get_adapter('hci0')
+            devices = adapter.get_devices()
+            address = devices[0].Address
+
+        # Then
+        self.assertEqual(len(devices), 1)
+        self.assertEqual(address, 'CA:CE:00:00:00:01')
+        self.assertEqual(sorted(manager._objects), ['/org/bluez/hci0', scope])
+
+class TestCase03_LatencyHistogram(unittest.TestCase):
+    def test_01_Percentiles(self):
+        # Given
+        histogram = bluez.LatencyHistogram()
+        other = bluez.LatencyHistogram()
+
+        # When
+        for us in range(1, 1001):
+            (histogram if us % 2 else other).record(us / 1e6)
+        histogram.merge(other)
+
+        # Then
+        self.assertEqual(histogram.count, 1000)
+        self.assertAlmostEqual(histogram.percentile(50), 500e-6, delta=500e-6 / 8)
+        self.assertAlmostEqual(histogram.percentile(99), 990e-6, delta=990e-6 / 8)
+        self.assertLessEqual(histogram.percentile(100), histogram.max)
+        self.assertEqual(histogram.max, 1000e-6)
+        self.assertIsNone(bluez.LatencyHistogram().percentile(50))
+
+class TestCase04_Soak(unittest.TestCase):
+    def test_01_Reconnect(self):
+        # Given
+        with MockBluez(devices=1, interval=5, data_len=20) as mock:
+            adapter = bluez.Manager(bus_address=mock.address).get_adapter('hci0')
+            drop = threading.Timer(1.0, mock.drop_link, kwargs={'outage_ms': 300})
+            drop.start()
+
+            # When
+            with contextlib.redirect_stdout(io.StringIO()):
+                rolling = throughput_test.soak(adapter, 5, 20, 3.0, window=0.5)
+            drop.join()
+
+        # Then
+        self.assertEqual(rolling.outages, 1)
+        self.assertGreater(rolling.outage_time, 0.3)
+        self.assertEqual(rolling.stalls, 0)
+        self.assertGreater(rolling.notifications, 200)
+        self.assertGreaterEqual(len(rolling.windows), 5)
+        self.assertGreater(rolling.windows[-1].notifications, 0)
+
+class TestCase05_GattSession(unittest.TestCase):
+    def reconnect(self, keep_gatt_cache):
+        with MockBluez(devices=1, interval=5, data_len=20, keep_gatt_cache=keep_gatt_cache) as mock:
+            adapter = bluez.Manager(bus_address=mock.address).get_adapter('hci0')
+            device = adapter.discover_device(lambda d: SERVICE_UUID in d.UUIDs, 5000)
+            session = bluez.GattSession(device, [DATA_UUID, CONFIG_UUID])
+            # Whether each connection waited for ServicesResolved in Device.connect and whether the services were
+            # resolved when it returned
+            waits = []
+            resolved = []
+            connect = device.connect
+            def record_wait(wait_for_services=True, **kwargs):
+                waits.append(wait_for_services)
+                return connect(wait_for_services=wait_for_services, **kwargs)
+            device.connect = record_wait
+            for i in range(3):
+                chars = session.connect()
+                resolved.append(device.ServicesResolved)
+                try:
+                    with chars[DATA_UUID].fd_notify_batched(tap=session.notify_tap()) as q:
+                        q.get(timeout=2).release()
+                finally:
+                    device.disconnect()
+            return session, chars, waits, resolved
+
+    def test_01_FastReconnect(self):
+        # When
+        session, chars, waits, resolved = self.reconnect(keep_gatt_cache=True)
+
+        # Then
+        self.assertEqual(sorted(chars), sorted([DATA_UUID, CONFIG_UUID]))
+        self.assertEqual((session.connects, session.fast_connects), (3, 2))
+        self.assertEqual(session.flags(DATA_UUID), ['notify'])
+        self.assertEqual(session.latency.count, 3)
+        # Only the first connection waits for the services to be resolved
+        self.assertEqual(waits, [True, False, False])
+        self.assertTrue(resolved[0])
+        self.assertLess(session.last_latency, session.latency.max + 1e-9)
+
+    def test_02_NoCache(self):
+        # When
+        session, chars, waits, resolved = self.reconnect(keep_gatt_cache=False)
+
+        # Then
+        self.assertEqual(sorted(chars), sorted([DATA_UUID, CONFIG_UUID]))
+        self.assertEqual((session.connects, session.fast_connects), (3, 0))
+        # The objects may still be exported when Connect is called, then the session waits after Connect returned
+        self.assertTrue(waits[0])
+        self.assertEqual(resolved, [True, True, True])
+        self.assertEqual(session.latency.count, 3)
+
+class TestCase06_ConnectionBenchmark(unittest.TestCase):
+    def test_01_Phases(self):
+        # Given
+        with MockBluez(devices=1, interval=5, data_len=20, discovery_delay_ms=100, connect_delay_ms=20,
+                       resolve_delay_ms=50) as mock:
+            adapter = bluez.Manager(bus_address=mock.address).get_adapter('hci0')
+
+            # When
+            with contextlib.redirect_stdout(io.StringIO()):
+                phases, errors, address = connection_benchmark.run(adapter, 3, 5, 20, 10)
+
+        # Then
+        self.assertEqual(errors, [])
+        self.assertEqual(address, 'C0:FF:EE:00:00:01')
+        self.assertEqual(list(phases), list(connection_benchmark.PHASES))
+        self.assertTrue(all(h.count == 3 for h in phases.values()))
+        # The device is removed after each cycle, so every cycle waits for the discovery delay of the mock
+        self.assertGreaterEqual(phases['discover'].percentile(50), 0.1 * 0.875)
+        self.assertGreaterEqual(phases['connect'].percentile(50), 0.02 * 0.875)
+        self.assertGreaterEqual(phases['resolve'].percentile(50), 0.05 * 0.875)
+        self.assertLess(phases['resolve'].percentile(50), 0.5)
+        self.assertGreaterEqual(phases['setup'].percentile(50), phases['resolve'].percentile(50))
+
+    def test_02_Compare(self):
+        # Given
+        baseline = {'phases': {'connect': {'p50_ms': 20.0, 'p95_ms': 30.0},
+                               'resolve': {'p50_ms': 50.0, 'p95_ms': 60.0},
+                               'configure': {'p50_ms': 0.5, 'p95_ms': 0.6}}}
+        phases = {'connect': {'p50_ms': 21.0, 'p95_ms': 40.0},
+                  'resolve': {'p50_ms': None, 'p95_ms': None},
+                  'configure': {'p50_ms': 1.0, 'p95_ms': 1.2},
+                  'disconnect': {'p50_ms': 5.0, 'p95_ms': 6.0}}
+
+        # When
+        regressions = connection_benchmark.compare(phases, baseline, 20.0, 1.0)
+
+        # Then
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith('connect p95'))
+
+    def test_03_Session(self):
+        for keep_gatt_cache, resolves in ((False, 3), (True, 2)):
+            with self.subTest(keep_gatt_cache=keep_gatt_cache):
+                # Given
+                with MockBluez(devices=1, interval=5, data_len=20, connect_delay_ms=20, resolve_delay_ms=50,
+                               keep_gatt_cache=keep_gatt_cache) as mock:
+                    adapter = bluez.Manager(bus_address=mock.address).get_adapter('hci0')
+
+                    # When
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        phases, errors, address = connection_benchmark.run(adapter, 3, 5, 20, 10, use_session=True)
+
+                # Then
+                self.assertEqual(errors, [])
+                self.assertEqual((phases['discover'].count, phases['connect'].count), (1, 3))
+                # The session is created by the first cycle and resolves the services on its first connection,
+                # later ones only without the GATT cache
+                self.assertEqual(phases['resolve'].count, resolves)
+                # The look up of the characteristics is timed on its own, so the resolve delay stays out of it
+                self.assertEqual(phases['lookup'].count, 3)
+                self.assertLess(phases['lookup'].percentile(50), 0.05 * 0.875)
+                self.assertGreaterEqual(phases['connect'].percentile(50), 0.02 * 0.875)
+                self.assertLess(phases['connect'].percentile(50), 0.05 * 0.875)
+
+class TestCase07_Manager(unittest.TestCase):
+    def test_01_NoBluez(self):
+        # Given
+        daemon = subprocess.Popen([shutil.which('dbus-daemon'), '--session', '--nofork', '--print-address=1'],
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        try:
+            address = daemon.stdout.readline().strip()
+
+            # When / Then
+            with self.assertRaises(GLib.Error):
+                bluez.Manager(bus_address=address)
+        finally:
+            daemon.terminate()
+            daemon.wait()
+            daemon.stdout.close()
+
+class TestCase08_AsyncAPI(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.mock = MockBluez(devices=1, interval=1, data_len=20)
+        cls.mock.start()
+        cls.manager = bluez.AsyncManager(bus_address=cls.mock.address)
+        cls.adapter = cls.manager.get_adapter('hci0')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.mock.stop()
+
+    def test_01_DiscoverConnectReadWrite(self):
+        async def run():
+            # Given
+            device = await self.adapter.discover_device(lambda d: SERVICE_UUID in d.UUIDs, 5000)
+            self.assertIsInstance(device, bluez.AsyncDevice)
+
+            # When
+            await device.connect()
+            try:
+                configChar = device.get_gattservice(SERVICE_UUID).get_gattcharacteristic(CONFIG_UUID)
+                await configChar.WriteValue(struct.pack('<HB', 5, 30))
+                written = await configChar.ReadValue()
+                await configChar.WriteValue(struct.pack('<HB', 1, 20))
+                resolved = device.ServicesResolved
+            finally:
+                await device.disconnect()
+
+            # Then
+            self.assertIsInstance(configChar, bluez.AsyncGattCharacteristic)
+            self.assertTrue(resolved)
+            self.assertEqual(bytes(written), struct.pack('<HB', 5, 30))
+            self.assertFalse(device.Connected)
+        asyncio.run(run())
+
+    def test_02_NotificationsEndOnDisconnect(self):
+        async def run():
+            # Given
+            device = await self.adapter.discover_device(lambda d: SERVICE_UUID in d.UUIDs, 5000)
+            await device.connect()
+            dataChar = device.get_gattservice(SERVICE_UUID).get_gattcharacteristic(DATA_UUID)
+
+            # When
+            lengths = []
+            async with dataChar.fd_notify(max_pending=8, max_reads=4) as notifications:
+                async for n in notifications:
+                    lengths.append(len(n))
+                    if len(lengths) == 20:
+                        break
+                # The consumer falls behind, reading pauses at max_pending
+                await asyncio.sleep(0.2)
+                pending = len(notifications._pending)
+                await device.disconnect()
+                # The iteration drains the socket and ends with the end of file of the disconnection
+                async def drain():
+                    async for n in notifications:
+                        lengths.append(len(n))
+                await asyncio.wait_for(drain(), 2)
+
+            # Then
+            self.assertGreaterEqual(pending, 8)
+            self.assertLess(pending, 8 + 4)
+            self.assertGreater(len(lengths), 20 + pending)
+            self.assertEqual(set(lengths), {20})
+        asyncio.run(run())
+
+class TestCase09_Waiters(unittest.TestCase):
+    def test_01_ConcurrentWaiters(self):
+        # Given
+        with MockBluez(devices=1, connect_delay_ms=20, resolve_delay_ms=50) as mock:
+            manager = bluez.Manager(bus_address=mock.address)
+            device = manager.get_adapter('hci0').discover_device(lambda d: SERVICE_UUID in d.UUIDs, 5000)
+            checks = [lambda d: d.Connected] * 3 + [lambda d: d.ServicesResolved] * 2
+            errors = []
+            def wait(check):
+                try:
+                    device._wait_property_change(check, 5000)
+                except Exception as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=wait, args=(c,)) for c in checks]
+            for t in threads:
+                t.start()
+            deadline = time.monotonic() + 5
+            while len(manager._waiters._waiters.get(device.path, ())) < len(checks) and time.monotonic() < deadline:
+                time.sleep(0.005)
+
+            # When
+            device.connect()
+            for t in threads:
+                t.join(5)
+            alive = [t for t in threads if t.is_alive()]
+            device.disconnect()
+
+        # Then
+        self.assertEqual(alive, [])
+        self.assertEqual(errors, [])
+
+    def test_02_AlreadyTrue(self):
+        # Given
+        with MockBluez(devices=1) as mock:
+            manager = bluez.Manager(bus_address=mock.address)
+            device = manager.get_adapter('hci0').discover_device(lambda d: SERVICE_UUID in d.UUIDs, 5000)
+            device.connect()
+
+            # When / Then: a timeout of 0 raises unless the check passes before blocking
+            try:
+                device._wait_property_change(lambda d: d.Connected and d.ServicesResolved, 0)
+            finally:
+                device.disconnect()
+            self.assertEqual(manager._waiters._waiters, {})
+
+if __name__ == '__main__':
+    unittest.main()
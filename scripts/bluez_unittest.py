@@ -1,6 +1,7 @@
 # Copyright (c) 2021 Martin Roesch
 # SPDX-License-Identifier: Apache-2.0
 
+import asyncio
 import unittest
 import time
 import struct
@@ -86,6 +87,16 @@ class TestCase02_AdapterClass(unittest.TestCase):
         # Then
         self.assertTrue(device is None, 'Devices advertising UUID {} discovered within {} milliseconds.'.format(service_uuid, timeout))
         self.assertFalse(a.Discovering)
+    
+    def test_07_IdentityMap(self):
+        # Given
+        a = self.manager.get_adapter()
+        
+        # When
+        b = self.manager.get_adapter()
+        
+        # Then
+        self.assertIs(a, b)
 
 class TestCase03_DeviceClass(unittest.TestCase):
     @classmethod
@@ -153,6 +164,57 @@ class TestCase03_DeviceClass(unittest.TestCase):
         # Then
         self.assertFalse(self.device.Connected)
     
+    def test_04_LookupByAddressAndUUID(self):
+        # Given
+        if not self.device.Connected:
+            self.device.connect()
+        
+        # When
+        device = self.adapter.get_device(self.device.Address)
+        devices = self.adapter.get_devices(self.service_uuid)
+        service = self.device.get_gattservice(self.service_uuid)
+        
+        # Then
+        self.assertEqual(device._proxy.get_object_path(), self.device._proxy.get_object_path())
+        self.assertIn(device._proxy.get_object_path(), [d._proxy.get_object_path() for d in devices])
+        self.assertIsNotNone(service)
+        self.assertEqual(service.UUID, self.service_uuid)
+        self.assertIsNone(self.device.get_gattservice('12345678-1234-5678-1234-56789abcdef0'))
+        
+        # When
+        self.device.disconnect()
+        
+        # Then
+        self.assertFalse(self.device.Connected)
+    
+
+class TestCase04_AsyncAPI(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.manager = bluez.AsyncManager()
+        cls.adapter = cls.manager.get_adapter()
+        cls.service_uuid = 'abcdef00-f5bf-58d5-9d17-172177d1316a'
+    
+    def test_01_DiscoverConnectDisconnect(self):
+        async def run():
+            # Given
+            device = await self.adapter.discover_device(lambda d: self.service_uuid in d.UUIDs, 5000)
+            self.assertIsInstance(device, bluez.AsyncDevice)
+            
+            # When
+            await device.connect()
+            
+            # Then
+            self.assertTrue(device.Connected)
+            self.assertTrue(device.ServicesResolved)
+            
+            # When
+            await device.disconnect()
+            
+            # Then
+            self.assertFalse(device.Connected)
+        asyncio.run(run())
+    
 
 if __name__ == "__main__":
     import logging
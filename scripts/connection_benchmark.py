@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2021 Martin Roesch
+# SPDX-License-Identifier: Apache-2.0
+
+"""Latency benchmark of the connection lifecycle of the throughput peripheral.
+
+Runs `--cycles` discover / connect / configure / stream / disconnect cycles and records the latency of every phase
+of each cycle:
+
+- `discover`: `discover_device` until the peripheral matched
+- `connect`: `Connect` until `Connected`
+- `resolve`: `Connected` until `ServicesResolved`
+- `lookup`: look up of the characteristics of the throughput service
+- `configure`: write of the Config characteristic
+- `acquire_notify`: `AcquireNotify` until the reader of the notify file descriptor is running
+- `first_notification`: reader running until the first notification arrived
+- `setup`: `Connect` until the first notification arrived
+- `stream`: first until the `--num`th notification
+- `disconnect`: `Disconnect` until not `Connected`
+
+The peripheral is removed from BlueZ after each cycle, so every cycle discovers it from scratch, unless
+`--keep-device` is given. With `--session` the cycles reconnect through a `bluez.GattSession`, which skips
+`resolve` while BlueZ keeps the GATT objects cached. `--mock` runs the cycles against `bluez_mock.MockBluez`.
+
+The p50/p95/p99 of every phase are printed and with `--json` written in a stable layout: all phases are always
+present, in the order above, with `null` percentiles for phases without samples. With `--baseline` the results
+are compared with a previous JSON result and the script exits with status 1 if the p50 or p95 of a phase grew by
+more than `--threshold` percent and `--floor` milliseconds.
+"""
+
+import argparse
+import json
+import logging
+import sys
+import time
+from queue import Empty
+
+from bluez import GattSession, LatencyHistogram, Manager
+import throughput_test
+
+log = logging.getLogger('Connection')
+
+RESULT_VERSION = 2
+
+PHASES = ('discover', 'connect', 'resolve', 'lookup', 'configure', 'acquire_notify', 'first_notification', 'setup',
+          'stream', 'disconnect')
+PERCENTILES = (50, 95, 99)
+
+def run_cycle(a, phases, interval, data_len, num, timeout=5.0, keep_device=False, session=None):
+    """Run one discover / connect / configure / stream / disconnect cycle and record its phases in `phases`.
+
+    :Parameters:
+        `phases` : { str: bluez.LatencyHistogram }
+        `session` : bluez.GattSession
+            Reconnect through this session, its device is not discovered again
+
+    :Returns: `(device, address)` the `bluez.Device` and its address, which is kept when the device is removed
+    :Raises `Exception`: if a phase failed
+    """
+    timeout_ms = int(timeout * 1000)
+    t = time.monotonic()
+    if session is None:
+        device = a.discover_device(throughput_test.check_device, timeout_ms,
+                                   discovery_filter=throughput_test.discoveryFilter)
+        if device is None:
+            raise Exception('No device hosting the throughput service found')
+        phases['discover'].record(time.monotonic() - t)
+    else:
+        device = session.device
+    address = device.Address
+    try:
+        start = t = time.monotonic()
+        device.connect(wait_for_services=False, timeout_ms=timeout_ms)
+        t = lap(phases, 'connect', t)
+        if session is None or not session.cached:
+            device.wait_services_resolved(timeout_ms)
+            t = lap(phases, 'resolve', t)
+        if session is None:
+            service = device.get_gattservice(throughput_test.serviceUUID)
+            chars = service.get_gattcharacteristics() if service else None
+        else:
+            # The device is connected already, so the session only looks up its characteristics
+            chars = session.connect(timeout_ms)
+        t = lap(phases, 'lookup', t)
+        if not chars or throughput_test.configCharUUID not in chars or throughput_test.dataCharUUID not in chars:
+            raise Exception(f'Throughput service not found on {device}')
+        throughput_test.write_config(chars[throughput_test.configCharUUID], interval, data_len)
+        t = lap(phases, 'configure', t)
+        with chars[throughput_test.dataCharUUID].fd_notify_batched() as q:
+            t = lap(phases, 'acquire_notify', t)
+            received = 0
+            first = None
+            while received < num:
+                batch = q.get(timeout=timeout)
+                if batch is None:
+                    raise Exception('Notifications stopped')
+                with batch:
+                    if first is None:
+                        first = batch.timestamp
+                        phases['first_notification'].record(first - t)
+                        phases['setup'].record(first - start)
+                    received += len(batch)
+                    last = batch.timestamp
+            phases['stream'].record(last - first)
+    except Empty:
+        raise Exception('No notification received') from None
+    finally:
+        # Errors of the clean up are only logged, so they do not replace the error of a failed phase
+        t = time.monotonic()
+        connected = device.Connected
+        try:
+            device.disconnect(timeout_ms)
+            if connected:
+                phases['disconnect'].record(time.monotonic() - t)
+        except Exception as e:
+            log.error(f'Disconnect from {address} failed: {e}')
+        if not keep_device and session is None:
+            try:
+                a.remove_device(device, timeout_ms)
+            except Exception as e:
+                log.error(f'Removing {address} failed: {e}')
+    return device, address
+
+def lap(phases, phase, t):
+    now = time.monotonic()
+    phases[phase].record(now - t)
+    return now
+
+def run(a, cycles, interval, data_len, num, timeout=5.0, keep_device=False, use_session=False):
+    """Run `cycles` cycles, see `run_cycle`.
+
+    :Returns: `(phases, errors, address)` with a `bluez.LatencyHistogram` per phase, the errors of the failed
+        cycles and the address of the peripheral
+    """
+    phases = {p: LatencyHistogram() for p in PHASES}
+    errors = []
+    session = None
+    address = None
+    for i in range(cycles):
+        setup = phases['setup'].total
+        try:
+            device, address = run_cycle(a, phases, interval, data_len, num, timeout, keep_device or use_session,
+                                        session)
+        except Exception as e:
+            print(f'[{i+1}/{cycles}] Failed: {e}')
+            errors.append(str(e))
+            continue
+        if use_session and session is None:
+            session = GattSession(device, [throughput_test.configCharUUID, throughput_test.dataCharUUID])
+        print(f'[{i+1}/{cycles}] Connect to first notification: {(phases["setup"].total - setup) * 1000:.1f} ms')
+    return phases, errors, address
+
+def phase_summary(h):
+    """Returns the JSON serializable summary of the `bluez.LatencyHistogram` of a phase, in milliseconds."""
+    ms = lambda v: None if v is None else round(v * 1000, 3)
+    return {
+        'count': h.count,
+        'mean_ms': ms(h.total / h.count) if h.count else None,
+        **{f'p{q}_ms': ms(h.percentile(q)) for q in PERCENTILES},
+        'max_ms': ms(h.max) if h.count else None,
+    }
+
+def compare(phases, baseline, threshold, floor):
+    """Compare the phase summaries with the phases of a baseline result.
+
+    :Returns: `[ str ]` descriptions of the percentiles that grew by more than `threshold` percent and more than
+        `floor` milliseconds
+    """
+    regressions = []
+    for phase, s in phases.items():
+        b = baseline['phases'].get(phase)
+        if b is None:
+            continue
+        for key in ('p50_ms', 'p95_ms'):
+            if s[key] is None or not b[key]:
+                continue
+            growth = (s[key] - b[key]) * 100 / b[key]
+            if growth > threshold and s[key] - b[key] > floor:
+                regressions.append(f'{phase} {key[:-3]}: {s[key]:.3f} ms, {growth:.1f} % above baseline '
+                                   f'{b[key]:.3f} ms')
+    return regressions
+
+def print_phases(phases):
+    print(f'{"Phase":<20} {"count":>6} {"p50":>10} {"p95":>10} {"p99":>10} {"max":>10}')
+    fmt = lambda v: f'{"-":>7}   ' if v is None else f'{v:>7.1f} ms'
+    for phase, s in phases.items():
+        print(f'{phase:<20} {s["count"]:>6} {fmt(s["p50_ms"])} {fmt(s["p95_ms"])} {fmt(s["p99_ms"])} '
+              f'{fmt(s["max_ms"])}')
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+
+    parser = argparse.ArgumentParser(description='Connection lifecycle latency benchmark.')
+    parser.add_argument('-c', '--cycles', type=int, default=20, help='Number of cycles')
+    parser.add_argument('-i', '--interval', type=int, default=throughput_test.configInterval,
+                        help='Notification interval in milliseconds')
+    parser.add_argument('-l', '--length', type=int, default=throughput_test.configDataLen,
+                        help='Notification data size in bytes')
+    parser.add_argument('-n', '--num', type=int, default=10, help='Number of notifications to receive per cycle')
+    parser.add_argument('-t', '--timeout', type=float, default=10.0, help='Seconds to wait for each phase')
+    parser.add_argument('--adapter', default='hci0', help='Bluetooth adapter')
+    parser.add_argument('--keep-device', action='store_true',
+                        help='Do not remove the peripheral from BlueZ after each cycle')
+    parser.add_argument('--session', action='store_true', help='Reconnect through a bluez.GattSession')
+    parser.add_argument('--mock', action='store_true', help='Run against the mock of the BlueZ D-Bus API')
+    parser.add_argument('--keep-gatt-cache', action='store_true', help='Keep the GATT objects of the mock')
+    parser.add_argument('--json', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON result of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=20.0,
+                        help='Maximum growth of the p50 and p95 of a phase against the baseline in percent')
+    parser.add_argument('--floor', type=float, default=1.0,
+                        help='Growth in milliseconds below which a phase is not counted as regression')
+    args = parser.parse_args()
+
+    mock = None
+    if args.mock:
+        from bluez_mock import MockBluez
+        mock = MockBluez(devices=1, interval=args.interval, data_len=args.length,
+                         keep_gatt_cache=args.keep_gatt_cache)
+        mock.start()
+    try:
+        a = Manager(bus_address=mock.address if mock else None).get_adapter(args.adapter)
+        print(f'Using {a}, {args.cycles} cycles')
+        histograms, errors, address = run(a, args.cycles, args.interval, args.length, args.num, args.timeout,
+                                          args.keep_device, args.session)
+    finally:
+        if mock:
+            mock.stop()
+
+    phases = {p: phase_summary(histograms[p]) for p in PHASES}
+    print_phases(phases)
+    print(f'Failed cycles: {len(errors)} of {args.cycles}')
+    result = {
+        'version': RESULT_VERSION,
+        'timestamp': time.time(),
+        'device': address,
+        'parameters': {k: getattr(args, k) for k in ('cycles', 'interval', 'length', 'num', 'keep_device',
+                                                       'session', 'mock')},
+        'failures': len(errors),
+        'errors': errors,
+        'phases': phases,
+    }
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(phases, baseline, args.threshold, args.floor)
+        for r in regressions:
+            print(f'Regression: {r}')
+        if regressions:
+            return 1
+        print(f'No phase latency growth above {args.threshold} % against {args.baseline}.')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2021 Martin Roesch
+# SPDX-License-Identifier: Apache-2.0
+
+"""Startup benchmark of the bluez module.
+
+Starts a `bluez_mock.MockBluez` with a populated object tree (`--cached` known devices) and measures in fresh
+interpreters the time to `import bluez`, to create the `Manager` and to the first `get_adapter()`, with all
+objects indexed and with the Manager scoped to a single device.
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+from bluez_mock import MockBluez, ADAPTER_PATH
+
+PROBE = '''
+import json, sys, time
+t0 = time.perf_counter()
+import bluez
+t1 = time.perf_counter()
+manager = bluez.Manager(bus_address=sys.argv[1], scope=sys.argv[2] or None)
+t2 = time.perf_counter()
+adapter = manager.get_adapter()
+t3 = time.perf_counter()
+print(json.dumps({'import': t1 - t0, 'manager': t2 - t1, 'get_adapter': t3 - t2, 'total': t3 - t0,
+                  'objects': len(manager._objects)}))
+'''
+
+def measure(address, scope, repeat):
+    runs = []
+    for i in range(repeat):
+        out = subprocess.run([sys.executable, '-c', PROBE, address, scope or ''], check=True, capture_output=True,
+                             text=True).stdout
+        runs.append(json.loads(out))
+    return {k: statistics.median(r[k] for r in runs) for k in runs[0]}
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup benchmark of the bluez module.')
+    parser.add_argument('-c', '--cached', type=int, default=2000, help='Number of devices known to the mock')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Number of runs per mode')
+    args = parser.parse_args()
+
+    with MockBluez(devices=0, cached_devices=args.cached) as mock:
+        device = f'{ADAPTER_PATH}/dev_CA_CE_00_00_00_00'
+        print(f'Object tree: 1 adapter, {args.cached} devices')
+        print(f'{"Mode":<10} {"objects":>8} {"import":>10} {"Manager":>10} {"get_adapter":>12} {"total":>10}')
+        for mode, scope in (('all', None), ('adapter', 'hci0'), ('device', device)):
+            r = measure(mock.address, scope, args.repeat)
+            print(f'{mode:<10} {r["objects"]:>8} {r["import"] * 1000:>7.1f} ms {r["manager"] * 1000:>7.1f} ms '
+                  f'{r["get_adapter"] * 1000:>9.1f} ms {r["total"] * 1000:>7.1f} ms')
+
+if __name__ == '__main__':
+    main()
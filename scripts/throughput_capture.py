@@ -0,0 +1,308 @@
+# Copyright (c) 2021 Martin Roesch
+# SPDX-License-Identifier: Apache-2.0
+
+"""Capture of notification streams to disk and replay of captures.
+
+A capture file starts with a header (magic, format version, start timestamp and JSON metadata) followed by one
+record per notification: the `time.monotonic()` timestamp of its reception as little endian double, its length as
+little endian unsigned short and its payload.
+
+`CaptureWriter` is passed as `tap` to `GattCharacteristic.fd_notify`, `fd_notify_batched` or `dbus_signal_notify`.
+The reader thread only appends the records to an in-memory buffer; full buffers are written by a separate writer
+thread, to a regular file or to a memory-mapped file that grows in `map_size` steps. At most `max_buffers` full
+buffers wait for the writer thread: if the disk is slower than the link, further buffers are dropped and counted
+instead of stalling the reader thread or growing the memory without bound.
+
+`CaptureReader` maps a capture file and yields its notifications as `CapturedBatch` items, which can be fed to
+`throughput_stats.NotificationStats.record_batch` and `throughput_integrity.IntegrityChecker.check_batch` like the
+batches of `fd_notify_batched`. `replay` yields them at the recorded pace or as fast as possible.
+"""
+
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from queue import Full, Queue
+
+MAGIC = b'TPCAP\0\0\0'
+VERSION = 1
+_HEADER = struct.Struct('<8sHdI')
+_RECORD = struct.Struct('<dH')
+
+class CaptureWriter:
+    """Binary log of notifications.
+
+    `record` and `record_batch` must be called from a single thread, usually the reader thread of the notification
+    context manager. `close` flushes the pending buffer and waits for the writer thread. `notifications` and
+    `bytes` count the notifications of the buffers handed to the writer thread, `dropped` and `dropped_bytes`
+    those of the buffers dropped because `max_buffers` buffers were waiting for it.
+
+    :Parameters:
+        `path` : str
+            File to write
+        `metadata` : dict
+            JSON serializable description of the run, e.g. interval and data length
+        `buffer_size` : int
+            Size in bytes of the in-memory buffer handed to the writer thread when full
+        `max_buffers` : int
+            Number of full buffers that may wait for the writer thread
+        `use_mmap` : bool
+            Write through a memory-mapped file instead of `write` calls
+        `map_size` : int
+            Size in bytes by which the memory-mapped file grows
+        `start` : float
+            `time.monotonic()` timestamp of the start of the stream, defaults to now
+    """
+    def __init__(self, path, metadata=None, buffer_size=1 << 20, max_buffers=64, use_mmap=False, map_size=64 << 20,
+                 start=None):
+        self.path = path
+        self.start = time.monotonic() if start is None else start
+        self.notifications = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.dropped_bytes = 0
+        self._buffer_size = buffer_size
+        self._buffer = bytearray()
+        self._buffer_notifications = 0
+        self._buffer_bytes = 0
+        self._queue = Queue(maxsize=max_buffers)
+        meta = json.dumps(metadata or {}).encode()
+        header = _HEADER.pack(MAGIC, VERSION, self.start, len(meta)) + meta
+        self._file = open(path, 'w+b' if use_mmap else 'wb', buffering=0)
+        self._sink = _MmapSink(self._file, map_size) if use_mmap else self._file
+        self._sink.write(header)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def record(self, data, timestamp):
+        """Append a notification received at `timestamp`."""
+        buf = self._buffer
+        buf += _RECORD.pack(timestamp, len(data))
+        buf += data
+        self._buffer_notifications += 1
+        self._buffer_bytes += len(data)
+        if len(buf) >= self._buffer_size:
+            self._hand_over()
+
+    def record_batch(self, batch):
+        """Append all notifications of a `bluez.NotificationBatch`."""
+        buf = self._buffer
+        pack = _RECORD.pack
+        timestamp = batch.timestamp
+        for n in batch:
+            buf += pack(timestamp, len(n))
+            buf += n
+            self._buffer_bytes += len(n)
+        self._buffer_notifications += len(batch)
+        if len(buf) >= self._buffer_size:
+            self._hand_over()
+
+    def _hand_over(self, block=False):
+        try:
+            self._queue.put(self._buffer, block)
+        except Full:
+            self.dropped += self._buffer_notifications
+            self.dropped_bytes += self._buffer_bytes
+        else:
+            self.notifications += self._buffer_notifications
+            self.bytes += self._buffer_bytes
+        self._buffer = bytearray()
+        self._buffer_notifications = 0
+        self._buffer_bytes = 0
+
+    def _run(self):
+        while True:
+            buf = self._queue.get()
+            if buf is None:
+                break
+            if self._error is None:
+                try:
+                    self._sink.write(buf)
+                except OSError as e:
+                    self._error = e
+
+    def close(self):
+        """Write the pending notifications and close the file.
+
+        :Raises `OSError`: if writing failed
+        """
+        if self._thread is None:
+            return
+        if self._buffer:
+            self._hand_over(block=True)
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        if self._sink is not self._file:
+            self._sink.close()
+        self._file.close()
+        if self._error is not None:
+            raise self._error
+
+class _MmapSink:
+    """Appends to a file through a memory map, growing the file by `map_size` bytes at a time."""
+    def __init__(self, file, map_size):
+        self._file = file
+        self._map_size = map_size
+        self._size = 0
+        self._offset = 0
+        self._map = None
+
+    def _grow(self, needed):
+        if self._map is not None:
+            self._map.close()
+        self._size += max(self._map_size, needed)
+        self._file.truncate(self._size)
+        self._map = mmap.mmap(self._file.fileno(), self._size)
+
+    def write(self, data):
+        end = self._offset + len(data)
+        if end > self._size:
+            self._grow(end - self._size)
+        self._map[self._offset:end] = data
+        self._offset = end
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self._file.truncate(self._offset)
+
+class CapturedBatch:
+    """Notifications of a capture that were received at the same time.
+
+    Provides the `lengths`, `timestamp`, `buffer`, `stride` and `nbytes` attributes, iteration and the context
+    manager protocol of `bluez.NotificationBatch`.
+    """
+    __slots__ = ('lengths', 'timestamp', 'buffer', 'stride')
+
+    def __init__(self, lengths, timestamp, buffer, stride):
+        self.lengths = lengths
+        self.timestamp = timestamp
+        self.buffer = buffer
+        self.stride = stride
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, index):
+        offset = index * self.stride
+        return memoryview(self.buffer)[offset:offset + self.lengths[index]]
+
+    def __iter__(self):
+        for i in range(len(self.lengths)):
+            yield self[i]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    @property
+    def nbytes(self):
+        return sum(self.lengths)
+
+    def release(self):
+        pass
+
+class CaptureReader:
+    """Read access to a capture file.
+
+    :Raises `ValueError`: if the file is not a capture or has an unsupported version
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+        if len(self._map) < _HEADER.size:
+            raise ValueError(f'{path}: Not a capture file')
+        magic, version, self.start, meta_len = _HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError(f'{path}: Not a capture file')
+        if version != VERSION:
+            raise ValueError(f'{path}: Unsupported capture version {version}')
+        self._data_offset = _HEADER.size + meta_len
+        self.metadata = json.loads(bytes(self._map[_HEADER.size:self._data_offset]))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            try:
+                self._map.close()
+            except BufferError:
+                # Views returned by records() are still referenced, the mapping is released with them
+                pass
+
+    def records(self):
+        """Yields `(timestamp, memoryview)` of every notification. A truncated last record is ignored.
+
+        The views point into the mapped file and should not be used after the reader is closed.
+        """
+        view = memoryview(self._map)
+        offset = self._data_offset
+        end = len(view)
+        try:
+            while offset + _RECORD.size <= end:
+                timestamp, n = _RECORD.unpack_from(view, offset)
+                offset += _RECORD.size
+                if offset + n > end:
+                    break
+                yield timestamp, view[offset:offset + n]
+                offset += n
+        finally:
+            view.release()
+
+    def batches(self, max_batch=32):
+        """Yields `CapturedBatch` items of up to `max_batch` consecutive notifications with the same timestamp."""
+        group = []
+        for timestamp, data in self.records():
+            if group and (timestamp != group[0][0] or len(group) == max_batch):
+                yield self._batch(group)
+                group = []
+            group.append((timestamp, data))
+        if group:
+            yield self._batch(group)
+
+    @staticmethod
+    def _batch(group):
+        stride = max(len(d) for _, d in group) or 1
+        buffer = bytearray(stride * len(group))
+        lengths = []
+        for i, (_, d) in enumerate(group):
+            buffer[i * stride:i * stride + len(d)] = d
+            lengths.append(len(d))
+        return CapturedBatch(lengths, group[0][0], buffer, stride)
+
+def replay(reader, speed=None, max_batch=32):
+    """Yields the batches of a capture.
+
+    :Parameters:
+        `reader` : CaptureReader
+        `speed` : float
+            Replay at `speed` times the recorded pace, `None` to replay as fast as possible. The timestamps of
+            the batches are the recorded ones in both cases.
+    """
+    origin = None
+    for batch in reader.batches(max_batch):
+        if speed:
+            now = time.monotonic()
+            if origin is None:
+                origin = now - (batch.timestamp - reader.start) / speed
+            delay = origin + (batch.timestamp - reader.start) / speed - now
+            if delay > 0:
+                time.sleep(delay)
+        yield batch
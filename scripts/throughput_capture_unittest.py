@@ -0,0 +1,148 @@
+# Copyright (c) 2021 Martin Roesch
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+import tempfile
+import threading
+import unittest
+
+from throughput_capture import CaptureReader, CaptureWriter, CapturedBatch, replay
+from throughput_integrity import IntegrityChecker, expected_pattern
+from throughput_stats import NotificationStats
+
+def make_batch(payloads, timestamp):
+    stride = max(len(p) for p in payloads)
+    buffer = bytearray(stride * len(payloads))
+    for i, p in enumerate(payloads):
+        buffer[i * stride:i * stride + len(p)] = p
+    return CapturedBatch([len(p) for p in payloads], timestamp, buffer, stride)
+
+class TestCase01_CaptureWriter(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_01_RoundTrip(self):
+        # Given
+        pattern = expected_pattern(20)
+        with CaptureWriter(self.path, {'interval_ms': 10, 'data_length': 20}, buffer_size=64, start=1.0) as w:
+            w.record(pattern, 1.5)
+            w.record_batch(make_batch([pattern, pattern[:5]], 2.0))
+
+        # When
+        with CaptureReader(self.path) as r:
+            records = [(t, bytes(d)) for t, d in r.records()]
+            metadata = r.metadata
+            start = r.start
+
+        # Then
+        self.assertEqual(start, 1.0)
+        self.assertEqual(metadata, {'interval_ms': 10, 'data_length': 20})
+        self.assertEqual(records, [(1.5, pattern), (2.0, pattern), (2.0, pattern[:5])])
+
+    def test_02_MemoryMapped(self):
+        # Given
+        pattern = expected_pattern(200)
+
+        # When
+        with CaptureWriter(self.path, buffer_size=1000, use_mmap=True, map_size=4096) as w:
+            for i in range(100):
+                w.record(pattern, float(i))
+        with CaptureReader(self.path) as r:
+            records = [(t, bytes(d)) for t, d in r.records()]
+
+        # Then
+        self.assertEqual(len(records), 100)
+        self.assertEqual(records[-1][0], 99.0)
+        self.assertEqual(records[-1][1], pattern)
+
+    def test_03_TruncatedRecordIgnored(self):
+        # Given
+        with CaptureWriter(self.path) as w:
+            w.record(b'abc', 1.0)
+            w.record(b'defgh', 2.0)
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 2)
+
+        # When
+        with CaptureReader(self.path) as r:
+            records = [bytes(d) for _, d in r.records()]
+
+        # Then
+        self.assertEqual(records, [b'abc'])
+
+    def test_04_InvalidFile(self):
+        # Given
+        with open(self.path, 'wb') as f:
+            f.write(b'x' * 100)
+
+        # When / Then
+        with self.assertRaises(ValueError):
+            CaptureReader(self.path)
+
+    def test_05_SlowDiskDropsBuffers(self):
+        # Given
+        pattern = expected_pattern(100)
+        w = CaptureWriter(self.path, buffer_size=100, max_buffers=2)
+        file = w._sink
+        writing = threading.Event()
+        disk = threading.Event()
+        class SlowSink:
+            def write(self, data):
+                writing.set()
+                disk.wait()
+                file.write(data)
+            def close(self):
+                pass
+        w._sink = SlowSink()
+
+        # When
+        with w:
+            w.record(pattern, 0.0)
+            writing.wait(5)
+            # The writer thread blocks on the first buffer, two more wait for it and the others are dropped
+            for i in range(1, 10):
+                w.record(pattern, float(i))
+            dropped = w.dropped
+            disk.set()
+        with CaptureReader(self.path) as r:
+            records = [t for t, _ in r.records()]
+
+        # Then
+        self.assertEqual((dropped, w.dropped, w.dropped_bytes), (7, 7, 700))
+        self.assertEqual((w.notifications, w.bytes), (3, 300))
+        self.assertEqual(records, [0.0, 1.0, 2.0])
+
+class TestCase02_Replay(unittest.TestCase):
+    def test_01_ReplayThroughPipeline(self):
+        # Given
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        pattern = expected_pattern(50)
+        with CaptureWriter(path, start=0.0) as w:
+            for i in range(10):
+                w.record_batch(make_batch([pattern] * 3, 0.01 * (i + 1)))
+            w.record(pattern[:10], 0.2)
+
+        # When
+        with CaptureReader(path) as r:
+            stats = NotificationStats(r.start)
+            checker = IntegrityChecker(50)
+            batches = list(replay(r, speed=10.0))
+            for b in batches:
+                checker.check_batch(b)
+                stats.record_batch(b.lengths, b.timestamp)
+        os.remove(path)
+
+        # Then
+        self.assertEqual(len(batches), 11)
+        self.assertEqual(len(stats), 31)
+        self.assertEqual(checker.valid, 30)
+        self.assertEqual(checker.short, 1)
+        self.assertEqual(stats.summary().bytes, 30 * 50 + 10)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,240 @@
+# Copyright (c) 2021 Martin Roesch
+# SPDX-License-Identifier: Apache-2.0
+
+"""Integrity and loss checks of the notifications of the Data characteristic.
+
+The firmware sends the first `data_length` bytes of the pattern `[0x00, 0x01, ... 0xFE]` in every notification.
+Batches are compared against that pattern in bulk: with NumPy the whole slab of a `bluez.NotificationBatch` is
+compared at once, without NumPy every notification is compared as a single `memoryview`.
+
+The Statistics characteristic reports how many notifications the firmware attempted and sent. `DeliveryReport`
+correlates these counters with the notifications received by the host to locate drops.
+"""
+
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def expected_pattern(data_length):
+    """The payload of a notification of `data_length` bytes as sent by the firmware."""
+    return bytes(i & 0xFF for i in range(data_length))
+
+class IntegrityChecker:
+    """Counts short and corrupt notifications.
+
+    A notification is short if it has fewer than `data_length` bytes. It is corrupt if its content does not
+    match the expected pattern or if it is longer than `data_length` bytes.
+    """
+    def __init__(self, data_length):
+        self.data_length = data_length
+        self.expected = expected_pattern(data_length)
+        self._expected_array = numpy.frombuffer(self.expected, dtype=numpy.uint8) if numpy is not None else None
+        self.notifications = 0
+        self.short = 0
+        self.corrupt = 0
+
+    @property
+    def valid(self):
+        return self.notifications - self.short - self.corrupt
+
+    def check(self, data):
+        """Check a single notification."""
+        self.notifications += 1
+        n = len(data)
+        if n < self.data_length:
+            self.short += 1
+        elif n > self.data_length or memoryview(data) != self.expected:
+            self.corrupt += 1
+
+    def check_batch(self, batch, first=0, count=None):
+        """Check the notifications of a `bluez.NotificationBatch` (anything with `buffer`, `stride` and `lengths`).
+
+        :Parameters:
+            `first` : int
+                Index of the first notification to check
+            `count` : int
+                Number of notifications to check, all from `first` on if `None`
+        """
+        lengths = batch.lengths[first:] if count is None else batch.lengths[first:first + count]
+        count = len(lengths)
+        if not count:
+            return
+        if self._expected_array is None or batch.stride < self.data_length:
+            for i, n in enumerate(lengths, first):
+                offset = i * batch.stride
+                self.check(batch.buffer[offset:offset + n])
+            return
+        lengths = numpy.fromiter(lengths, dtype=numpy.int32, count=count)
+        rows = numpy.frombuffer(batch.buffer, dtype=numpy.uint8, count=count * batch.stride,
+                                offset=first * batch.stride).reshape(count, batch.stride)
+        short = lengths < self.data_length
+        mismatch = (rows[:, :self.data_length] != self._expected_array).any(axis=1)
+        self.notifications += count
+        self.short += int(short.sum())
+        self.corrupt += int(((lengths > self.data_length) | (mismatch & ~short)).sum())
+
+    def as_dict(self):
+        return {
+            'notifications': self.notifications,
+            'valid': self.valid,
+            'short': self.short,
+            'corrupt': self.corrupt,
+        }
+
+class LossEstimate:
+    """Estimate of missed notifications from the notification timestamps and the configured interval.
+
+    Notifications are not received evenly spaced, since several of them are transferred per connection event.
+    The number of expected notifications is therefore derived from the time span of the whole stream, not from
+    single inter-arrival times. Gaps longer than `stall_intervals` intervals are counted as stalls.
+    """
+    def __init__(self, timestamps, interval_ms, stall_intervals=10):
+        self.interval = interval_ms / 1000
+        self.received = len(timestamps)
+        self.expected = self.received
+        self.stalls = 0
+        self.longest_gap = 0.0
+        if self.received < 2 or self.interval <= 0:
+            return
+        if numpy is not None:
+            t = numpy.asarray(timestamps, dtype=numpy.float64)
+            span = float(t[-1] - t[0])
+            gaps = numpy.diff(t)
+            self.longest_gap = float(gaps.max())
+            self.stalls = int((gaps > stall_intervals * self.interval).sum())
+        else:
+            span = timestamps[-1] - timestamps[0]
+            gaps = [b - a for a, b in zip(timestamps, timestamps[1:])]
+            self.longest_gap = max(gaps)
+            self.stalls = sum(1 for g in gaps if g > stall_intervals * self.interval)
+        self.expected = max(self.received, round(span / self.interval) + 1)
+
+    @property
+    def missed(self):
+        return self.expected - self.received
+
+    def as_dict(self):
+        return {
+            'interval_ms': self.interval * 1000,
+            'received': self.received,
+            'expected': self.expected,
+            'missed': self.missed,
+            'stalls': self.stalls,
+            'longest_gap_s': self.longest_gap,
+        }
+
+def format_report(checker, loss=None):
+    """Returns the human readable lines of an integrity check and an optional loss estimate."""
+    lines = [f'Integrity: {checker.valid} valid, {checker.short} short and {checker.corrupt} corrupt notifications '
+             f'of {checker.data_length} bytes.']
+    if loss is not None and loss.interval > 0:
+        lines.append(f'Loss: {loss.missed} of {loss.expected} notifications missed (estimated from '
+                     f'{loss.interval * 1000:g} ms interval), {loss.stalls} stalls, '
+                     f'longest gap: {loss.longest_gap * 1000:.3f} ms.')
+    return lines
+
+class PeripheralStatistics:
+    """Value of the Statistics characteristic of the firmware.
+
+    `attempted` notifications were passed to the Bluetooth stack, `sent` of them were transmitted by the
+    controller (`bytes` payload bytes). Failed attempts are counted by error: `err_nomem` (no TX buffer),
+    `err_notconn` (not connected or notifications disabled) and `err_other`. `mtu`, `conn_interval` (in units of
+    1.25 ms), `tx_phy` and `rx_phy` are the current link parameters.
+    """
+    FORMAT = struct.Struct('<6IHHBB')
+    COUNTERS = ('attempted', 'sent', 'bytes', 'err_nomem', 'err_notconn', 'err_other')
+    __slots__ = COUNTERS + ('mtu', 'conn_interval', 'tx_phy', 'rx_phy')
+
+    def __init__(self, attempted=0, sent=0, bytes=0, err_nomem=0, err_notconn=0, err_other=0, mtu=0,
+                 conn_interval=0, tx_phy=0, rx_phy=0):
+        self.attempted = attempted
+        self.sent = sent
+        self.bytes = bytes
+        self.err_nomem = err_nomem
+        self.err_notconn = err_notconn
+        self.err_other = err_other
+        self.mtu = mtu
+        self.conn_interval = conn_interval
+        self.tx_phy = tx_phy
+        self.rx_phy = rx_phy
+
+    @classmethod
+    def unpack(cls, data):
+        """Decode a value read or notified from the Statistics characteristic.
+
+        :Raises `ValueError`: if `data` has the wrong size
+        """
+        if len(data) != cls.FORMAT.size:
+            raise ValueError(f'Statistics value has {len(data)} bytes, expected {cls.FORMAT.size}')
+        return cls(*cls.FORMAT.unpack(data))
+
+    def __sub__(self, other):
+        """The counters accumulated since `other`, with the link parameters of `self`."""
+        values = {k: (getattr(self, k) - getattr(other, k)) & 0xFFFFFFFF for k in self.COUNTERS}
+        return PeripheralStatistics(mtu=self.mtu, conn_interval=self.conn_interval, tx_phy=self.tx_phy,
+                                    rx_phy=self.rx_phy, **values)
+
+    @property
+    def errors(self):
+        return self.err_nomem + self.err_notconn + self.err_other
+
+    @property
+    def queued(self):
+        """Attempted notifications that are neither sent nor failed, i.e. still in the TX queue of the stack."""
+        return max(0, self.attempted - self.sent - self.errors)
+
+    def as_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+class DeliveryReport:
+    """End-to-end delivery of the notifications of a run.
+
+    `before` and `after` are the `PeripheralStatistics` read before enabling and after disabling the
+    notifications, `received` is the number of notifications received by the host in between. Notifications the
+    stack failed to queue are dropped on the peripheral, notifications the controller sent but the host did not
+    receive are dropped on the link or in the host stack (BlueZ, D-Bus or the notification socket).
+    """
+    def __init__(self, before, after, received):
+        self.peripheral = after - before
+        self.received = received
+
+    @property
+    def attempted(self):
+        return self.peripheral.attempted
+
+    @property
+    def peripheral_dropped(self):
+        return self.peripheral.errors
+
+    @property
+    def host_dropped(self):
+        return max(0, self.peripheral.sent - self.received)
+
+    @property
+    def delivery_ratio(self):
+        return self.received / self.attempted if self.attempted else 0.0
+
+    def as_dict(self):
+        return {
+            'attempted': self.attempted,
+            'sent': self.peripheral.sent,
+            'received': self.received,
+            'peripheral_dropped': self.peripheral_dropped,
+            'host_dropped': self.host_dropped,
+            'delivery_ratio': self.delivery_ratio,
+            'peripheral': self.peripheral.as_dict(),
+        }
+
+def format_delivery(report):
+    """Returns the human readable lines of a `DeliveryReport`."""
+    p = report.peripheral
+    return [f'Delivery: {report.received} of {report.attempted} notifications received '
+            f'({report.delivery_ratio * 100:.2f} %).',
+            f'- Dropped on peripheral: {report.peripheral_dropped} (no buffer: {p.err_nomem}, not connected: '
+            f'{p.err_notconn}, other: {p.err_other}), still queued: {p.queued}',
+            f'- Dropped on link or host: {report.host_dropped} of {p.sent} sent',
+            f'- Link: MTU {p.mtu}, connection interval {p.conn_interval * 1.25:g} ms, '
+            f'PHY TX 0x{p.tx_phy:02X} RX 0x{p.rx_phy:02X}']
@@ -0,0 +1,150 @@
+# Copyright (c) 2021 Martin Roesch
+# SPDX-License-Identifier: Apache-2.0
+
+import unittest
+from array import array
+
+import throughput_integrity
+from throughput_integrity import DeliveryReport, IntegrityChecker, LossEstimate, PeripheralStatistics, expected_pattern
+
+class Batch:
+    """Stand-in for `bluez.NotificationBatch`."""
+    def __init__(self, packets, stride=247):
+        self.stride = stride
+        self.buffer = memoryview(bytearray(stride * len(packets)))
+        self.lengths = [len(p) for p in packets]
+        for i, p in enumerate(packets):
+            self.buffer[i*stride:i*stride + len(p)] = p
+
+class TestCase01_IntegrityChecker(unittest.TestCase):
+    def check_batch(self, numpy):
+        # Given
+        saved = throughput_integrity.numpy
+        throughput_integrity.numpy = numpy
+        try:
+            checker = IntegrityChecker(200)
+        finally:
+            throughput_integrity.numpy = saved
+        good = expected_pattern(200)
+        corrupt = bytearray(good)
+        corrupt[100] ^= 0xFF
+        batch = Batch([good, good[:150], bytes(corrupt), good + b'\x00', good])
+        
+        # When
+        checker.check_batch(batch)
+        
+        # Then
+        self.assertEqual(checker.notifications, 5)
+        self.assertEqual(checker.valid, 2)
+        self.assertEqual(checker.short, 1)
+        self.assertEqual(checker.corrupt, 2)
+    
+    def test_01_BatchWithoutNumPy(self):
+        self.check_batch(None)
+    
+    @unittest.skipIf(throughput_integrity.numpy is None, 'NumPy not installed')
+    def test_02_BatchWithNumPy(self):
+        self.check_batch(throughput_integrity.numpy)
+    
+    def test_03_Single(self):
+        # Given
+        checker = IntegrityChecker(10)
+        
+        # When
+        checker.check(bytes(range(10)))
+        checker.check(bytes(10))
+        
+        # Then
+        self.assertEqual(checker.valid, 1)
+        self.assertEqual(checker.corrupt, 1)
+    
+    def check_slice(self, numpy):
+        # Given
+        saved = throughput_integrity.numpy
+        throughput_integrity.numpy = numpy
+        try:
+            checker = IntegrityChecker(200)
+        finally:
+            throughput_integrity.numpy = saved
+        good = expected_pattern(200)
+        batch = Batch([good[:10], good, good[:150], good, bytes(200)])
+        
+        # When
+        checker.check_batch(batch, 1, 3)
+        
+        # Then
+        self.assertEqual(checker.notifications, 3)
+        self.assertEqual(checker.valid, 2)
+        self.assertEqual(checker.short, 1)
+        self.assertEqual(checker.corrupt, 0)
+    
+    def test_04_SliceWithoutNumPy(self):
+        self.check_slice(None)
+    
+    @unittest.skipIf(throughput_integrity.numpy is None, 'NumPy not installed')
+    def test_05_SliceWithNumPy(self):
+        self.check_slice(throughput_integrity.numpy)
+
+class TestCase02_LossEstimate(unittest.TestCase):
+    def test_01_NoLoss(self):
+        # Given
+        timestamps = array('d', [i * 0.01 for i in range(100)])
+        
+        # When
+        loss = LossEstimate(timestamps, 10)
+        
+        # Then
+        self.assertEqual(loss.missed, 0)
+        self.assertEqual(loss.stalls, 0)
+    
+    def test_02_Gap(self):
+        # Given
+        timestamps = array('d', [i * 0.01 for i in range(100) if not 40 <= i < 60])
+        
+        # When
+        loss = LossEstimate(timestamps, 10)
+        
+        # Then
+        self.assertEqual(loss.expected, 100)
+        self.assertEqual(loss.missed, 20)
+        self.assertEqual(loss.stalls, 1)
+        self.assertAlmostEqual(loss.longest_gap, 0.21)
+    
+    def test_03_NoInterval(self):
+        # When
+        loss = LossEstimate([0.0, 1.0], 0)
+        
+        # Then
+        self.assertEqual(loss.missed, 0)
+    
+class TestCase03_DeliveryReport(unittest.TestCase):
+    def test_01_Unpack(self):
+        # Given
+        data = PeripheralStatistics.FORMAT.pack(10, 8, 800, 1, 0, 0, 247, 6, 2, 2)
+        
+        # When
+        s = PeripheralStatistics.unpack(data)
+        
+        # Then
+        self.assertEqual((s.attempted, s.sent, s.bytes, s.errors, s.queued), (10, 8, 800, 1, 1))
+        self.assertEqual((s.mtu, s.conn_interval, s.tx_phy, s.rx_phy), (247, 6, 2, 2))
+        with self.assertRaises(ValueError):
+            PeripheralStatistics.unpack(data[:-1])
+    
+    def test_02_DropLocation(self):
+        # Given
+        before = PeripheralStatistics(attempted=0xFFFFFFF0, sent=0xFFFFFFF0, err_nomem=2)
+        after = PeripheralStatistics(attempted=90, sent=80, err_nomem=12, mtu=247)
+        
+        # When
+        report = DeliveryReport(before, after, 75)
+        
+        # Then
+        self.assertEqual(report.attempted, 106)
+        self.assertEqual(report.peripheral_dropped, 10)
+        self.assertEqual(report.host_dropped, 21)
+        self.assertAlmostEqual(report.delivery_ratio, 75 / 106)
+        self.assertEqual(report.peripheral.mtu, 247)
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2021 Martin Roesch
+# SPDX-License-Identifier: Apache-2.0
+
+"""Throughput test scaled out over several adapters, with one worker process per adapter.
+
+Every worker runs its own `bluez.Manager`, scoped to its adapter, in a separate interpreter, so the GLib main
+loop, the reader threads and the statistics of an adapter do not share the GIL with the other adapters. The
+peripherals are sharded by address: a peripheral is only connected through the adapter selected by the hash of
+its address, so no two adapters connect to the same peripheral.
+
+The workers connect and configure their peripherals, wait for each other and receive `--num` notifications per
+link. Every link is passed back to the main process as one binary `LinkRecord` with its counters, inter-arrival
+histogram and bytes per window, which are merged into the aggregate statistics.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+from multiprocessing.connection import wait
+
+from bluez import Manager
+import throughput_test
+from throughput_integrity import LossEstimate
+from throughput_stats import Histogram
+
+log = logging.getLogger('Scale')
+
+# Messages of the workers: a type byte followed by the payload
+MSG_LINK = b'L'
+MSG_ERROR = b'E'
+MSG_DONE = b'D'
+
+def shard_of(address, shards):
+    """Returns the index of the adapter that connects to the peripheral with `address`."""
+    return zlib.crc32(address.upper().encode()) % shards
+
+def _pack_counts(counts):
+    """Returns an `array('Q')` as little endian bytes."""
+    if sys.byteorder == 'big':
+        counts = array('Q', counts)
+        counts.byteswap()
+    return counts.tobytes()
+
+def _unpack_counts(data):
+    """Returns little endian unsigned 64 bit integers as `array('Q')`."""
+    counts = array('Q', data)
+    if sys.byteorder == 'big':
+        counts.byteswap()
+    return counts
+
+class LinkRecord:
+    """Result of one link, packed into a compact binary record.
+
+    The fixed part holds the adapter index, the address, the counters, the start and end of the reception, the
+    jitter and the inter-arrival histogram statistics (microseconds). It is followed by the counts of the histogram
+    buckets and the received bytes per window, as little endian unsigned 64 bit integers, so the whole record is
+    little endian. Windows are counted from the common `time.monotonic()` epoch of the run, which all processes of
+    the host share.
+    """
+    HEADER = struct.Struct('<B6sQQddIIIdBQQQQII')
+    __slots__ = ('adapter', 'address', 'notifications', 'bytes', 'start', 'end', 'short', 'corrupt', 'missed',
+                 'jitter', 'inter_arrival', 'window_bytes')
+
+    def __init__(self, adapter, address, notifications=0, bytes=0, start=0.0, end=0.0, short=0, corrupt=0,
+                 missed=0, jitter=0.0, inter_arrival=None, window_bytes=None):
+        self.adapter = adapter
+        self.address = address
+        self.notifications = notifications
+        self.bytes = bytes
+        self.start = start
+        self.end = end
+        self.short = short
+        self.corrupt = corrupt
+        self.missed = missed
+        self.jitter = jitter
+        self.inter_arrival = inter_arrival if inter_arrival is not None else Histogram()
+        self.window_bytes = window_bytes if window_bytes is not None else array('Q')
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    @property
+    def throughput(self):
+        """Throughput in kbits/sec"""
+        return self.bytes * 8 / self.duration / 1000 if self.duration > 0 else 0.0
+
+    def pack(self):
+        h = self.inter_arrival
+        counts = array('Q', h.counts)
+        header = self.HEADER.pack(self.adapter, bytes.fromhex(self.address.replace(':', '')), self.notifications,
+                                  self.bytes, self.start, self.end, self.short, self.corrupt, self.missed, self.jitter,
+                                  h.precision, h.count, h.total, h.min or 0, h.max or 0, len(counts),
+                                  len(self.window_bytes))
+        return header + _pack_counts(counts) + _pack_counts(array('Q', self.window_bytes))
+
+    @classmethod
+    def unpack(cls, data):
+        """Decode a packed record.
+
+        :Raises `ValueError`: if `data` is truncated
+        """
+        if len(data) < cls.HEADER.size:
+            raise ValueError(f'Link record of {len(data)} bytes is truncated')
+        (adapter, address, notifications, nbytes, start, end, short, corrupt, missed, jitter, precision, count, total,
+         vmin, vmax, ncounts, nwindows) = cls.HEADER.unpack_from(data)
+        if len(data) != cls.HEADER.size + 8 * (ncounts + nwindows):
+            raise ValueError(f'Link record of {len(data)} bytes is truncated')
+        h = Histogram(precision)
+        h.counts = _unpack_counts(data[cls.HEADER.size:cls.HEADER.size + 8 * ncounts])
+        h.count, h.total = count, total
+        h.min, h.max = (vmin, vmax) if count else (None, None)
+        windows = _unpack_counts(data[cls.HEADER.size + 8 * ncounts:])
+        return cls(adapter, ':'.join(f'{b:02X}' for b in address), notifications, nbytes, start, end, short, corrupt,
+                   missed, jitter, h, windows)
+
+    @classmethod
+    def from_result(cls, adapter, result, epoch, window):
+        """Create the record of a `throughput_test.LinkResult`."""
+        s = result.stats.summary()
+        timestamps, lengths = result.stats.snapshot()
+        windows = array('Q')
+        for t, n in zip(timestamps, lengths):
+            i = int((t - epoch) / window)
+            if i >= len(windows):
+                windows.extend([0] * (i + 1 - len(windows)))
+            windows[i] += n
+        return cls(adapter, result.device.Address, result.notifications, result.bytes, result.start, result.end,
+                   result.checker.short, result.checker.corrupt, LossEstimate(timestamps, result.interval).missed, s.jitter,
+                   s.inter_arrival, windows)
+
+def worker(index, name, shards, args, epoch, barrier, conn):
+    """Run the links of adapter `name` and send their `LinkRecord`s through `conn`."""
+    logging.basicConfig(level=logging.INFO)
+    prefix = f'[{name}] '
+    devices = []
+    waited = False
+    try:
+        a = Manager(scope=name).get_adapter(name)
+        check = lambda d: throughput_test.check_device(d) and shard_of(d.Address, shards) == index
+        print(f'{prefix}Discover {args.peripherals} devices of shard {index + 1}/{shards} for 10 seconds.')
+        devices = a.discover_devices(check, args.peripherals, discovery_filter=throughput_test.discoveryFilter)
+        print(f'{prefix}Found {len(devices)}.')
+        links, configs = {}, {}
+        if devices:
+            links, configs = throughput_test.configure_all(
+                throughput_test.connect_all(devices, prefix), args.interval, args.length, prefix, burst=args.burst,
+                flags=throughput_test.ThroughputConfig.FLAG_MTU_FIT if args.mtu_fit else 0)
+        waited = True
+        try:
+            barrier.wait(args.timeout)
+        except threading.BrokenBarrierError:
+            print(f'{prefix}Not all adapters are ready, start anyway.')
+        if links:
+            results = throughput_test.receive_multi(links, args.num, args.interval, args.length, configs=configs)
+            for r in results:
+                if r.stats is None:
+                    conn.send_bytes(MSG_ERROR + f'{prefix}[{r.device.Address}] {r.error}'.encode())
+                    continue
+                conn.send_bytes(MSG_LINK + LinkRecord.from_result(index, r, epoch, args.window).pack())
+    except BaseException as e:
+        if not waited:
+            barrier.abort()
+        conn.send_bytes(MSG_ERROR + f'{prefix}{e}'.encode())
+    finally:
+        for d in devices:
+            d.disconnect()
+        conn.send_bytes(MSG_DONE)
+        conn.close()
+
+def run(adapters, args, epoch):
+    """Start one worker process per adapter and collect the records of their links.
+
+    :Parameters:
+        `adapters` : [ str ]
+            Adapter names, e.g. `['hci0', 'hci1']`
+        `epoch` : float
+            `time.monotonic()` the windows of the records are counted from
+
+    :Returns: `([ LinkRecord ], [ str ])` the links and the errors reported by the workers
+    """
+    # Workers are spawned, forking a process that runs a GLib main loop thread is not safe
+    ctx = multiprocessing.get_context('spawn')
+    barrier = ctx.Barrier(len(adapters))
+    processes = []
+    pending = []
+    for i, name in enumerate(adapters):
+        receiver, sender = ctx.Pipe(duplex=False)
+        p = ctx.Process(target=worker, args=(i, name, len(adapters), args, epoch, barrier, sender), name=name)
+        p.start()
+        sender.close()
+        processes.append(p)
+        pending.append(receiver)
+    records = []
+    errors = []
+    while pending:
+        for conn in wait(pending):
+            try:
+                msg = conn.recv_bytes()
+            except EOFError:
+                msg = MSG_DONE
+            kind, payload = msg[:1], msg[1:]
+            if kind == MSG_LINK:
+                records.append(LinkRecord.unpack(payload))
+            elif kind == MSG_ERROR:
+                errors.append(payload.decode())
+            else:
+                pending.remove(conn)
+                conn.close()
+    for p in processes:
+        p.join()
+    return records, errors
+
+def merge(records, window, epoch):
+    """Merge the records of all links.
+
+    :Returns: `dict` with the aggregate counters, throughput and inter-arrival histogram, the per adapter
+        throughput and the aggregate throughput per window of the windows all links were receiving in
+    """
+    total = {'links': len(records), 'notifications': 0, 'bytes': 0, 'short': 0, 'corrupt': 0, 'missed': 0}
+    h = Histogram()
+    windows = array('Q')
+    adapters = {}
+    for r in records:
+        for k in ('notifications', 'bytes', 'short', 'corrupt', 'missed'):
+            total[k] += getattr(r, k)
+        h.merge(r.inter_arrival)
+        if len(r.window_bytes) > len(windows):
+            windows.extend([0] * (len(r.window_bytes) - len(windows)))
+        for i, n in enumerate(r.window_bytes):
+            windows[i] += n
+        adapters[r.adapter] = adapters.get(r.adapter, 0) + r.throughput
+    if records:
+        start = max(r.start for r in records)
+        end = min(r.end for r in records)
+        duration = max(r.end for r in records) - min(r.start for r in records)
+        total['duration_s'] = duration
+        total['throughput_kbps'] = total['bytes'] * 8 / duration / 1000 if duration > 0 else 0.0
+        # Only windows during which every link was receiving show the aggregate throughput
+        first = int((start - epoch) / window) + 1
+        last = int((end - epoch) / window)
+        total['window_throughput_kbps'] = [b * 8 / window / 1000 for b in windows[first:last]]
+    total['adapter_throughput_kbps'] = adapters
+    total['fairness'] = throughput_test.jain_fairness(r.throughput for r in records)
+    total['inter_arrival'] = h
+    return total
+
+def print_summary(records, errors, adapters, window, epoch):
+    for e in errors:
+        print(f'Error: {e}')
+    for r in sorted(records, key=lambda r: (r.adapter, r.address)):
+        print(f'{adapters[r.adapter]} {r.address}: Received {r.bytes} bytes in {r.notifications} notifications '
+              f'during {r.duration:.3f} seconds: {r.throughput:.3f} kbits/sec, {r.missed} missed, '
+              f'{r.short} short, {r.corrupt} corrupt.')
+    m = merge(records, window, epoch)
+    for i, t in sorted(m['adapter_throughput_kbps'].items()):
+        print(f'{adapters[i]}: {t:.3f} kbits/sec')
+    if not records:
+        print('No links.')
+        return m
+    print(f'Summary: Received {m["bytes"]} bytes over {m["links"]} links of {len(adapters)} adapters during '
+          f'{m["duration_s"]:.3f} seconds: {m["throughput_kbps"]:.3f} kbits/sec.')
+    w = m['window_throughput_kbps']
+    if w:
+        print(f'Aggregate throughput per {window:g} s window [kbits/sec]: min: {min(w):.3f}, '
+              f'mean: {sum(w) / len(w):.3f}, max: {max(w):.3f}')
+    h = m['inter_arrival']
+    if h.count:
+        print(f'Inter-arrival [ms]: p50: {h.percentile(50) / 1000:.3f}, p99: {h.percentile(99) / 1000:.3f}, '
+              f'max: {h.max / 1000:.3f}')
+    print(f'Fairness (Jain\'s index): {m["fairness"]:.3f}')
+    return m
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Throughput test over several adapters, one process per adapter.')
+    parser.add_argument('-a', '--adapters', help='Comma separated adapters to use, default: all')
+    parser.add_argument('-i', '--interval', type=int, default=throughput_test.configInterval,
+                        help='Notification interval in milliseconds')
+    parser.add_argument('-l', '--length', type=int, default=throughput_test.configDataLen,
+                        help='Notification data size in bytes')
+    parser.add_argument('-b', '--burst', type=int, default=1, help='Number of notifications per interval')
+    parser.add_argument('--mtu-fit', action='store_true',
+                        help='Size the notifications to the negotiated MTU instead of -l')
+    parser.add_argument('-n', '--num', type=int, default=1000, help='Number of notifications to receive per link')
+    parser.add_argument('-p', '--peripherals', type=int, default=1, help='Number of peripherals per adapter')
+    parser.add_argument('-w', '--window', type=float, default=1.0, help='Window of the aggregate throughput in seconds')
+    parser.add_argument('-t', '--timeout', type=float, default=60.0,
+                        help='Seconds to wait for the other adapters before receiving')
+    parser.add_argument('--json', help='Write the merged results to this file')
+    args = parser.parse_args()
+
+    if args.adapters:
+        adapters = args.adapters.split(',')
+    else:
+        adapters = [a.path.rpartition('/')[2] for a in Manager().get_adapters()]
+    if not adapters:
+        print('No bluetooth adapter found.')
+        return
+    print(f'Using {len(adapters)} adapters: {", ".join(adapters)}')
+    epoch = time.monotonic()
+    records, errors = run(adapters, args, epoch)
+    m = print_summary(records, errors, adapters, args.window, epoch)
+    if args.json:
+        m['inter_arrival'] = {'p50': m['inter_arrival'].percentile(50), 'p99': m['inter_arrival'].percentile(99)}
+        m['adapter_throughput_kbps'] = {adapters[i]: t for i, t in m['adapter_throughput_kbps'].items()}
+        with open(args.json, 'w') as f:
+            json.dump(m, f, indent=2)
+
+if __name__ == '__main__':
+    main()
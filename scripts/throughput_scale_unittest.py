@@ -0,0 +1,86 @@
+# Copyright (c) 2021 Martin Roesch
+# SPDX-License-Identifier: Apache-2.0
+
+import unittest
+from array import array
+
+from throughput_scale import LinkRecord, merge, shard_of
+from throughput_stats import Histogram
+
+def make_record(adapter, address, start, end, window_bytes, inter_arrival=()):
+    h = Histogram()
+    h.record_many(inter_arrival)
+    return LinkRecord(adapter, address, notifications=sum(window_bytes) // 100, bytes=sum(window_bytes),
+                      start=start, end=end, jitter=1.5, inter_arrival=h, window_bytes=array('Q', window_bytes))
+
+class TestCase01_LinkRecord(unittest.TestCase):
+    def test_01_RoundTrip(self):
+        # Given
+        r = make_record(1, 'C0:FF:EE:00:00:0A', 10.0, 12.0, [0, 1000, 500], [10000, 10200, 250000])
+        r.short, r.corrupt, r.missed = 1, 2, 3
+
+        # When
+        u = LinkRecord.unpack(r.pack())
+
+        # Then
+        self.assertEqual((u.adapter, u.address, u.notifications, u.bytes), (1, 'C0:FF:EE:00:00:0A', 15, 1500))
+        self.assertEqual((u.start, u.end, u.short, u.corrupt, u.missed, u.jitter), (10.0, 12.0, 1, 2, 3, 1.5))
+        self.assertEqual(list(u.window_bytes), [0, 1000, 500])
+        self.assertEqual(u.inter_arrival.buckets(), r.inter_arrival.buckets())
+        self.assertEqual((u.inter_arrival.min, u.inter_arrival.max), (10000, 250000))
+
+    def test_02_Truncated(self):
+        # Given
+        data = make_record(0, 'C0:FF:EE:00:00:01', 0.0, 1.0, [100]).pack()
+
+        # When / Then
+        with self.assertRaises(ValueError):
+            LinkRecord.unpack(data[:-1])
+
+    def test_03_EmptyHistogram(self):
+        # When
+        u = LinkRecord.unpack(make_record(0, 'C0:FF:EE:00:00:01', 0.0, 1.0, []).pack())
+
+        # Then
+        self.assertEqual(u.inter_arrival.count, 0)
+        self.assertIsNone(u.inter_arrival.min)
+
+    def test_04_LittleEndian(self):
+        # When
+        data = make_record(0, 'C0:FF:EE:00:00:01', 0.0, 1.0, [1, 0x0102], [5]).pack()
+
+        # Then
+        self.assertEqual(data[-16:], (1).to_bytes(8, 'little') + (0x0102).to_bytes(8, 'little'))
+        self.assertEqual(data[LinkRecord.HEADER.size + 40:LinkRecord.HEADER.size + 48], (1).to_bytes(8, 'little'))
+
+class TestCase02_Merge(unittest.TestCase):
+    def test_01_Aggregate(self):
+        # Given
+        records = [make_record(0, 'C0:FF:EE:00:00:01', 100.5, 104.5, [0, 500, 1000, 1000, 1000, 500], [10000]),
+                   make_record(1, 'C0:FF:EE:00:00:02', 101.0, 104.0, [0, 0, 1000, 1000, 1000], [20000, 30000])]
+
+        # When
+        m = merge(records, 1.0, 99.0)
+
+        # Then
+        self.assertEqual((m['links'], m['bytes']), (2, 7000))
+        self.assertAlmostEqual(m['duration_s'], 4.0)
+        self.assertAlmostEqual(m['throughput_kbps'], 7000 * 8 / 4.0 / 1000)
+        # Windows 3 and 4 are the only ones both links were receiving in for the whole window
+        self.assertEqual(m['window_throughput_kbps'], [16.0, 16.0])
+        self.assertEqual(m['inter_arrival'].count, 3)
+        self.assertEqual(sorted(m['adapter_throughput_kbps']), [0, 1])
+
+    def test_02_Shards(self):
+        # Given
+        addresses = [f'C0:FF:EE:00:00:{i:02X}' for i in range(64)]
+
+        # When
+        shards = [shard_of(a, 3) for a in addresses]
+
+        # Then
+        self.assertEqual(set(shards), {0, 1, 2})
+        self.assertEqual(shards, [shard_of(a.lower(), 3) for a in addresses])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,482 @@
+# Copyright (c) 2021 Martin Roesch
+# SPDX-License-Identifier: Apache-2.0
+
+"""Statistics of notification streams.
+
+The receive loop only appends monotonic timestamps and lengths to compact arrays (`NotificationStats.record`),
+everything else is computed after the run or from a side thread (`NotificationStats.summary`).
+NumPy is used for the analysis when it is installed.
+
+For runs of hours or days, `RollingStats` keeps constant memory: it only accumulates the current window and keeps
+a bounded number of closed windows.
+"""
+
+import collections
+import math
+import threading
+import time
+from array import array
+from bisect import bisect_right
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class Histogram:
+    """HDR-style log-linear histogram of non-negative integer values.
+
+    Values below `2**precision` are counted exactly. Larger values are counted in buckets whose width grows
+    with the magnitude of the value, so the relative error of a reported value is below `2**(1-precision)`.
+    """
+    def __init__(self, precision=7):
+        self.precision = precision
+        self._sub = 1 << precision
+        self._half = self._sub >> 1
+        self.counts = array('Q')
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        shift = value.bit_length() - self.precision
+        if shift <= 0:
+            return value
+        return self._sub + (shift - 1) * self._half + (value >> shift) - self._half
+
+    def _value(self, index):
+        """Returns the midpoint of the values counted in bucket `index`."""
+        if index < self._sub:
+            return index
+        shift = (index - self._sub) // self._half + 1
+        low = (self._half + (index - self._sub) % self._half) << shift
+        return low + ((1 << shift) >> 1)
+
+    def _grow(self, index):
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+
+    def record(self, value, count=1):
+        value = int(value)
+        if value < 0:
+            raise ValueError(f'Negative value: {value}')
+        index = self._index(value)
+        self._grow(index)
+        self.counts[index] += count
+        self.count += count
+        self.total += value * count
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def record_many(self, values):
+        """Record a sequence of values, vectorized when NumPy is available."""
+        if numpy is None:
+            for v in values:
+                self.record(v)
+            return
+        values = numpy.asarray(values, dtype=numpy.int64)
+        if not len(values):
+            return
+        if values.min() < 0:
+            raise ValueError(f'Negative value: {values.min()}')
+        _, exponent = numpy.frexp(values.astype(numpy.float64))
+        shift = numpy.maximum(exponent - self.precision, 0)
+        indices = numpy.where(shift == 0, values,
+                              self._sub + (shift - 1) * self._half + (values >> shift) - self._half)
+        counts = numpy.bincount(indices)
+        self._grow(len(counts) - 1)
+        for index in numpy.flatnonzero(counts):
+            self.counts[index] += int(counts[index])
+        self.count += len(values)
+        self.total += int(values.sum())
+        vmin, vmax = int(values.min()), int(values.max())
+        self.min = vmin if self.min is None else min(self.min, vmin)
+        self.max = vmax if self.max is None else max(self.max, vmax)
+
+    def merge(self, other):
+        """Add the counts of another histogram with the same precision."""
+        if other.precision != self.precision:
+            raise ValueError('Histograms with different precision')
+        self._grow(len(other.counts) - 1)
+        for index, c in enumerate(other.counts):
+            if c:
+                self.counts[index] += c
+        self.count += other.count
+        self.total += other.total
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, q):
+        """Returns the value below which `q` percent of the recorded values are."""
+        if not self.count:
+            return 0
+        rank = max(1, math.ceil(round(self.count * q / 100, 9)))
+        seen = 0
+        for index, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return min(max(self._value(index), self.min), self.max)
+        return self.max
+
+    def buckets(self):
+        """Returns `[(value, count)]` of all non-empty buckets."""
+        return [(self._value(i), c) for i, c in enumerate(self.counts) if c]
+
+class StatsSummary:
+    """Result of `NotificationStats.summary`. Times are in seconds, inter-arrival values in microseconds."""
+    PERCENTILES = (50, 90, 99, 99.9)
+
+    def __init__(self):
+        self.notifications = 0
+        self.bytes = 0
+        self.duration = 0.0
+        self.first_latency = None
+        self.throughput = 0.0
+        self.inter_arrival = Histogram()
+        self.jitter = 0.0
+        self.window = 0.0
+        self.window_throughput = []
+
+    def as_dict(self):
+        """Plain, JSON serializable representation."""
+        h = self.inter_arrival
+        return {
+            'notifications': self.notifications,
+            'bytes': self.bytes,
+            'duration_s': self.duration,
+            'first_latency_s': self.first_latency,
+            'throughput_kbps': self.throughput,
+            'inter_arrival_us': {
+                'min': h.min or 0,
+                'mean': h.mean,
+                'max': h.max or 0,
+                **{f'p{q:g}': h.percentile(q) for q in self.PERCENTILES},
+            },
+            'jitter_us': self.jitter,
+            'window_s': self.window,
+            'window_throughput_kbps': list(self.window_throughput),
+        }
+
+class NotificationStats:
+    """Recorder of notification timestamps and lengths.
+
+    `record` only appends to two arrays and can be called on the hot path. `summary` works on a copy of what
+    was recorded so far and can be called from another thread while recording continues.
+
+    :Parameters:
+        `start` : float
+            The `time.monotonic()` timestamp the stream was started at, e.g. when notifications got enabled.
+            Used to report the latency of the first notification; the first notification does not contribute
+            an inter-arrival time since its predecessor is the start of the stream.
+    """
+    def __init__(self, start=None):
+        self.start = time.monotonic() if start is None else start
+        self._timestamps = array('d')
+        self._lengths = array('H')
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._timestamps)
+
+    def record(self, length, timestamp=None):
+        with self._lock:
+            self._timestamps.append(time.monotonic() if timestamp is None else timestamp)
+            self._lengths.append(length)
+
+    def record_batch(self, lengths, timestamp):
+        """Record notifications that were received together, e.g. a `bluez.NotificationBatch`."""
+        with self._lock:
+            self._timestamps.extend([timestamp] * len(lengths))
+            self._lengths.extend(lengths)
+
+    def snapshot(self):
+        """Returns copies of the timestamp and length arrays."""
+        with self._lock:
+            return self._timestamps[:], self._lengths[:]
+
+    def summary(self, window=1.0, end=None):
+        """Compute the statistics of everything recorded so far.
+
+        :Parameters:
+            `window` : float
+                Window size in seconds for the windowed throughput
+            `end` : float
+                End of the measurement, defaults to the last notification
+
+        :Returns: a `StatsSummary`
+        """
+        timestamps, lengths = self.snapshot()
+        s = StatsSummary()
+        s.window = window
+        s.notifications = len(timestamps)
+        if not timestamps:
+            return s
+        end = timestamps[-1] if end is None else end
+        s.duration = end - self.start
+        s.first_latency = timestamps[0] - self.start
+        if numpy is not None:
+            self._analyse_numpy(s, numpy.frombuffer(timestamps, dtype=numpy.float64),
+                                numpy.frombuffer(lengths, dtype=numpy.uint16), end)
+        else:
+            self._analyse(s, timestamps, lengths, end)
+        if s.duration > 0:
+            s.throughput = s.bytes * 8 / s.duration / 1000
+        return s
+
+    def _analyse(self, s, timestamps, lengths, end):
+        s.bytes = sum(lengths)
+        dts = [round((b - a) * 1e6) for a, b in zip(timestamps, timestamps[1:])]
+        s.inter_arrival.record_many(dts)
+        if len(dts) > 1:
+            mean = sum(dts) / len(dts)
+            s.jitter = math.sqrt(sum((d - mean) ** 2 for d in dts) / len(dts))
+        edges = self._window_edges(s.window, end)
+        totals = [0] * (len(edges) - 1)
+        for t, n in zip(timestamps, lengths):
+            totals[min(bisect_right(edges, t) - 1, len(totals) - 1)] += n
+        s.window_throughput = self._window_throughput(totals, s.window, edges, end)
+
+    def _analyse_numpy(self, s, timestamps, lengths, end):
+        s.bytes = int(lengths.sum(dtype=numpy.int64))
+        dts = numpy.rint(numpy.diff(timestamps) * 1e6).astype(numpy.int64)
+        s.inter_arrival.record_many(dts)
+        if len(dts) > 1:
+            s.jitter = float(dts.std())
+        edges = self._window_edges(s.window, end)
+        totals, _ = numpy.histogram(timestamps, bins=edges, weights=lengths)
+        s.window_throughput = self._window_throughput([float(b) for b in totals], s.window, edges, end)
+
+    def _window_edges(self, window, end):
+        # The tolerance keeps rounding errors from adding an empty window when the run ends on a window edge
+        count = max(1, math.ceil((end - self.start) / window - 1e-9))
+        edges = [self.start + i * window for i in range(count + 1)]
+        edges[-1] = max(edges[-1], end)
+        return edges
+
+    @staticmethod
+    def _window_throughput(totals, window, edges, end):
+        """Returns the throughput of each window in kbits/sec. The last window ends at `end`, so a partial window
+        is divided by the time it actually covers."""
+        spans = [window] * len(totals)
+        last = end - edges[-2]
+        if last < window * (1 - 1e-9):
+            spans[-1] = last
+        return [b * 8 / span / 1000 if span > 0 else 0.0 for b, span in zip(totals, spans)]
+
+class WindowStats:
+    """Statistics of one window of `RollingStats`. Times are in seconds, inter-arrival values in microseconds."""
+    __slots__ = ('start', 'end', 'notifications', 'bytes', 'p50', 'p99', 'jitter', 'max_gap', 'stalls', 'outages',
+                 'outage_time')
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.notifications = 0
+        self.bytes = 0
+        self.p50 = 0
+        self.p99 = 0
+        self.jitter = 0.0
+        self.max_gap = 0
+        self.stalls = 0
+        self.outages = 0
+        self.outage_time = 0.0
+
+    @property
+    def throughput(self):
+        """Throughput in kbits/sec."""
+        duration = self.end - self.start
+        return self.bytes * 8 / duration / 1000 if duration > 0 else 0.0
+
+    def as_dict(self):
+        d = {k: getattr(self, k) for k in self.__slots__}
+        d['throughput_kbps'] = self.throughput
+        return d
+
+class RollingStats:
+    """Statistics of a notification stream over consecutive windows, with constant memory.
+
+    Notifications are accumulated into the current window; when a timestamp passes the end of the window it is
+    closed into a `WindowStats` and kept in `windows`, a ring buffer of the last `windows` windows. Totals and the
+    inter-arrival histogram are kept over the whole run.
+
+    A stall is a gap of more than `stall` seconds between two notifications or since the last notification. It is
+    counted once, in the window in which the gap exceeded `stall`. Gaps caused by a link outage are not counted
+    as stalls: call `interrupt` when the link dropped and `record_outage` once the stream was restarted.
+
+    `record`, `record_batch`, `roll` and `record_outage` must be called from a single thread.
+
+    :Parameters:
+        `window` : float
+            Window size in seconds
+        `windows` : int
+            Number of closed windows to keep
+        `stall` : float
+            Gap in seconds that is counted as stall
+        `start` : float
+            `time.monotonic()` timestamp of the start of the first window, defaults to now
+    """
+    def __init__(self, window=10.0, windows=360, stall=1.0, start=None):
+        self.window = window
+        self.stall = stall
+        self.start = time.monotonic() if start is None else start
+        self.windows = collections.deque(maxlen=windows)
+        self.notifications = 0
+        self.bytes = 0
+        self.stalls = 0
+        self.outages = 0
+        self.outage_time = 0.0
+        self.inter_arrival = Histogram()
+        self._last = None
+        self._stalled = False
+        self._open(self.start)
+
+    def _open(self, start):
+        self._current = WindowStats(start, start + self.window)
+        self._histogram = Histogram()
+        self._sum = 0
+        self._sum_sq = 0
+
+    def _close(self):
+        w = self._current
+        h = self._histogram
+        if h.count:
+            w.p50 = h.percentile(50)
+            w.p99 = h.percentile(99)
+            mean = self._sum / h.count
+            w.jitter = math.sqrt(max(0.0, self._sum_sq / h.count - mean * mean))
+            self.inter_arrival.merge(h)
+        self.windows.append(w)
+        self._open(w.end)
+        return w
+
+    @property
+    def window_end(self):
+        """End of the current window."""
+        return self._current.end
+
+    def roll(self, now):
+        """Close all windows that ended before `now` and check for an ongoing stall.
+
+        :Returns: `[WindowStats]` the windows closed by this call
+        """
+        stall_at = None
+        if self._last is not None and not self._stalled and now - self._last > self.stall:
+            self._stalled = True
+            stall_at = self._last + self.stall
+        closed = []
+        while now >= self._current.end:
+            if stall_at is not None and stall_at < self._current.end:
+                self._count_stall()
+                stall_at = None
+            closed.append(self._close())
+        if stall_at is not None:
+            self._count_stall()
+        return closed
+
+    def _count_stall(self):
+        self._current.stalls += 1
+        self.stalls += 1
+
+    def record(self, length, timestamp):
+        """Record a notification.
+
+        :Returns: `[WindowStats]` the windows closed before it, see `roll`
+        """
+        return self.record_batch((length,), timestamp)
+
+    def record_batch(self, lengths, timestamp):
+        """Record notifications that were received together, e.g. a `bluez.NotificationBatch`.
+
+        :Returns: `[WindowStats]` the windows closed before them, see `roll`
+        """
+        closed = self.roll(timestamp)
+        if not lengths:
+            return closed
+        w = self._current
+        if self._last is not None:
+            gap = round((timestamp - self._last) * 1e6)
+            self._histogram.record(gap)
+            self._sum += gap
+            self._sum_sq += gap * gap
+            w.max_gap = max(w.max_gap, gap)
+        if len(lengths) > 1:
+            # The notifications of a batch arrived together
+            self._histogram.record(0, len(lengths) - 1)
+        self._stalled = False
+        self._last = timestamp
+        count = len(lengths)
+        nbytes = sum(lengths)
+        w.notifications += count
+        w.bytes += nbytes
+        self.notifications += count
+        self.bytes += nbytes
+        return closed
+
+    def interrupt(self):
+        """Mark the stream as interrupted, e.g. by a link drop.
+
+        The gap to the next notification is not counted as inter-arrival time or stall.
+        """
+        self._last = None
+        self._stalled = False
+
+    def record_outage(self, duration):
+        """Record that the stream was interrupted for `duration` seconds, see `interrupt`."""
+        self.interrupt()
+        self._current.outages += 1
+        self._current.outage_time += duration
+        self.outages += 1
+        self.outage_time += duration
+
+    def summary(self, last=None):
+        """Aggregate the last `last` closed windows, all kept windows if `None`.
+
+        :Returns: `dict` with the number of windows, their notifications, bytes, stalls, outages and the minimum,
+            mean and maximum throughput in kbits/sec, empty if no window was closed yet
+        """
+        windows = list(self.windows)[-last:] if last else list(self.windows)
+        if not windows:
+            return {}
+        throughput = [w.throughput for w in windows]
+        return {
+            'windows': len(windows),
+            'duration_s': windows[-1].end - windows[0].start,
+            'notifications': sum(w.notifications for w in windows),
+            'bytes': sum(w.bytes for w in windows),
+            'stalls': sum(w.stalls for w in windows),
+            'outages': sum(w.outages for w in windows),
+            'throughput_kbps': {'min': min(throughput), 'mean': sum(throughput) / len(throughput),
+                                'max': max(throughput)},
+        }
+
+def format_window(w, origin=0.0):
+    """Returns the human readable line of a `WindowStats`, with times relative to `origin`."""
+    line = (f'[{w.start - origin:8.0f} s] {w.throughput:10.3f} kbits/sec, {w.notifications} notifications, '
+            f'inter-arrival p50: {w.p50 / 1000:.3f} ms, p99: {w.p99 / 1000:.3f} ms, jitter: {w.jitter / 1000:.3f} ms, '
+            f'max gap: {w.max_gap / 1000:.3f} ms, stalls: {w.stalls}')
+    if w.outages:
+        line += f', outages: {w.outages} ({w.outage_time:.3f} s)'
+    return line
+
+def format_summary(s):
+    """Returns the human readable lines of a `StatsSummary`."""
+    h = s.inter_arrival
+    lines = [f'Summary: Received {s.bytes} bytes in {s.notifications} notifications '
+             f'during {s.duration:.3f} seconds: {s.throughput:.3f} kbits/sec.']
+    if s.first_latency is not None:
+        lines.append(f'First notification after {s.first_latency * 1000:.3f} ms.')
+    if h.count:
+        percentiles = ', '.join(f'p{q:g}: {h.percentile(q) / 1000:.3f}' for q in StatsSummary.PERCENTILES)
+        lines.append(f'Inter-arrival [ms]: min: {h.min / 1000:.3f}, mean: {h.mean / 1000:.3f}, {percentiles}, '
+                     f'max: {h.max / 1000:.3f}, jitter: {s.jitter / 1000:.3f}')
+    if s.window_throughput:
+        w = s.window_throughput
+        lines.append(f'Throughput per {s.window:g} s window [kbits/sec]: min: {min(w):.3f}, '
+                     f'mean: {sum(w) / len(w):.3f}, max: {max(w):.3f}')
+    return lines
@@ -0,0 +1,181 @@
+# Copyright (c) 2021 Martin Roesch
+# SPDX-License-Identifier: Apache-2.0
+
+import unittest
+
+import throughput_stats
+from throughput_stats import Histogram, NotificationStats, RollingStats
+
+class TestCase01_Histogram(unittest.TestCase):
+    def test_01_ExactBelowPrecision(self):
+        # Given
+        h = Histogram(precision=7)
+        
+        # When
+        h.record_many(range(1, 101))
+        
+        # Then
+        self.assertEqual(h.count, 100)
+        self.assertEqual(h.percentile(50), 50)
+        self.assertEqual(h.percentile(99), 99)
+        self.assertEqual(h.percentile(100), 100)
+        self.assertEqual(h.min, 1)
+        self.assertEqual(h.max, 100)
+    
+    def test_02_RelativeError(self):
+        # Given
+        h = Histogram(precision=7)
+        values = [7 ** i for i in range(1, 12)]
+        
+        # When
+        for v in values:
+            h.record(v)
+        
+        # Then
+        for i, v in enumerate(values):
+            reported = h.percentile((i + 1) * 100 / len(values))
+            self.assertLessEqual(abs(reported - v) / v, 2 ** -6)
+    
+    def test_03_Merge(self):
+        # Given
+        a = Histogram()
+        b = Histogram()
+        a.record_many([10, 20, 30])
+        b.record_many([1000, 2000])
+        
+        # When
+        a.merge(b)
+        
+        # Then
+        self.assertEqual(a.count, 5)
+        self.assertEqual(a.min, 10)
+        self.assertEqual(a.max, 2000)
+        self.assertEqual(a.total, 3060)
+    
+    def test_04_Negative(self):
+        with self.assertRaises(ValueError):
+            Histogram().record(-1)
+
+class TestCase02_NotificationStats(unittest.TestCase):
+    def test_01_Summary(self):
+        # Given
+        stats = NotificationStats(start=100.0)
+        
+        # When
+        for i in range(1, 11):
+            stats.record(200, 100.0 + i * 0.01)
+        s = stats.summary(window=0.05)
+        
+        # Then
+        self.assertEqual(s.notifications, 10)
+        self.assertEqual(s.bytes, 2000)
+        self.assertAlmostEqual(s.duration, 0.1)
+        self.assertAlmostEqual(s.first_latency, 0.01)
+        self.assertAlmostEqual(s.throughput, 160.0)
+        self.assertEqual(s.inter_arrival.count, 9)
+        self.assertAlmostEqual(s.inter_arrival.percentile(50), 10000, delta=10000 * 2 ** -6)
+        self.assertAlmostEqual(s.jitter, 0.0, places=3)
+        self.assertEqual(len(s.window_throughput), 2)
+        self.assertEqual(sum(s.window_throughput) * 0.05 / 8 * 1000, 2000)
+    
+    def test_02_Batch(self):
+        # Given
+        stats = NotificationStats(start=0.0)
+        
+        # When
+        stats.record_batch([100, 100, 50], 1.0)
+        stats.record_batch([100], 2.0)
+        s = stats.summary()
+        
+        # Then
+        self.assertEqual(s.notifications, 4)
+        self.assertEqual(s.bytes, 350)
+        self.assertEqual(s.inter_arrival.max, 1000000)
+        self.assertEqual(s.inter_arrival.min, 0)
+    
+    def test_03_Empty(self):
+        # When
+        s = NotificationStats().summary()
+        
+        # Then
+        self.assertEqual(s.notifications, 0)
+        self.assertEqual(s.throughput, 0.0)
+        self.assertTrue(throughput_stats.format_summary(s))
+    
+    def test_04_AsDict(self):
+        # Given
+        stats = NotificationStats(start=0.0)
+        stats.record(10, 0.5)
+        stats.record(10, 1.0)
+        
+        # When
+        d = stats.summary().as_dict()
+        
+        # Then
+        self.assertEqual(d['bytes'], 20)
+        self.assertIn('p99', d['inter_arrival_us'])
+    
+    def test_05_PartialWindow(self):
+        # Given
+        stats = NotificationStats(start=0.0)
+        for i in range(1, 16):
+            stats.record(100, i * 0.1)
+        
+        # When
+        s = stats.summary(window=1.0)
+        
+        # Then
+        self.assertEqual(len(s.window_throughput), 2)
+        self.assertAlmostEqual(s.window_throughput[0], 9 * 100 * 8 / 1000)
+        # The last window covers 0.5 seconds only
+        self.assertAlmostEqual(s.window_throughput[1], 6 * 100 * 8 / 0.5 / 1000)
+    
+class TestCase03_RollingStats(unittest.TestCase):
+    def test_01_Windows(self):
+        # Given
+        rolling = RollingStats(window=1.0, windows=3, stall=0.5, start=0.0)
+        
+        # When
+        closed = []
+        for i in range(1, 100):
+            closed += rolling.record(100, i * 0.01)
+        closed += rolling.roll(1.7)
+        closed += rolling.record_batch([100, 100], 2.5)
+        for i in range(5):
+            closed += rolling.record(100, 3.5 + i * 0.1)
+        closed += rolling.roll(6.0)
+        
+        # Then
+        self.assertEqual([w.notifications for w in closed], [99, 0, 2, 5, 0, 0])
+        self.assertEqual([w.stalls for w in closed], [0, 1, 0, 1, 1, 0])
+        self.assertAlmostEqual(closed[0].throughput, 79.2)
+        self.assertAlmostEqual(closed[0].p50, 10000, delta=10000 * 2 ** -6)
+        self.assertEqual(closed[3].max_gap, 1000000)
+        self.assertEqual(len(rolling.windows), 3)
+        self.assertEqual(rolling.notifications, 106)
+        self.assertEqual(rolling.stalls, 3)
+        self.assertEqual(rolling.summary()['windows'], 3)
+    
+    def test_02_Outage(self):
+        # Given
+        rolling = RollingStats(window=1.0, stall=0.5, start=0.0)
+        rolling.record(100, 0.1)
+        
+        # When
+        rolling.interrupt()
+        rolling.roll(0.9)
+        rolling.record_outage(0.8)
+        rolling.record(100, 1.6)
+        closed = rolling.roll(2.0)
+        
+        # Then
+        self.assertEqual(rolling.stalls, 0)
+        self.assertEqual(rolling.outages, 1)
+        self.assertEqual([w.outages for w in rolling.windows], [1, 0])
+        self.assertAlmostEqual(rolling.windows[0].outage_time, 0.8)
+        self.assertEqual(closed[0].notifications, 1)
+        self.assertEqual(rolling.inter_arrival.count, 0)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
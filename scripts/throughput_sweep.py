@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2021 Martin Roesch
+# SPDX-License-Identifier: Apache-2.0
+
+"""Throughput sweep over a grid of `interval_ms` x `data_length` x `burst` configurations.
+
+The peripheral is discovered and connected once. For every point of the grid the Config characteristic is
+written, notifications are enabled, `--warmup` notifications are skipped and `--num` notifications are measured,
+`--repeat` times. The results are written as JSON and/or CSV. With `--baseline` the results are compared with a
+previous JSON result and the script exits with status 1 if the throughput of a point dropped by more than
+`--threshold` percent. Bursts of more than one notification per interval need a peripheral supporting the extended
+config layout.
+"""
+
+import argparse
+import csv
+import json
+import logging
+import statistics
+import sys
+import time
+
+from bluez import Manager
+import throughput_test
+from throughput_integrity import LossEstimate
+
+log = logging.getLogger('Sweep')
+
+RESULT_VERSION = 1
+
+def parse_list(text):
+    """Parse `10,20,50` or a range `start:stop:step` (inclusive) into a list of ints."""
+    if ':' in text:
+        start, stop, *step = (int(v) for v in text.split(':'))
+        return list(range(start, stop + 1, step[0] if step else 1))
+    return [int(v) for v in text.split(',')]
+
+def offered_load(interval, data_len, burst=1):
+    """Throughput in kbits/sec the peripheral tries to send with the given configuration, `None` for the
+    saturation mode (interval 0), which sends as fast as the link allows."""
+    return burst * data_len * 8 / interval if interval > 0 else None
+
+def measure_point(configChar, dataChar, interval, data_len, num, warmup, repeat, timeout, burst=1, version=0):
+    if version:
+        throughput_test.write_config(configChar, interval, data_len, version, burst=burst)
+    else:
+        throughput_test.write_config(configChar, interval, data_len)
+    runs = []
+    for r in range(repeat):
+        stats, checker = throughput_test.collect(dataChar, num, data_len, warmup, timeout)
+        s = stats.summary()
+        loss = LossEstimate(stats.snapshot()[0], interval / burst)
+        runs.append({
+            'throughput_kbps': s.throughput,
+            'notifications': s.notifications,
+            'duration_s': s.duration,
+            'p50_inter_arrival_us': s.inter_arrival.percentile(50),
+            'p99_inter_arrival_us': s.inter_arrival.percentile(99),
+            'jitter_us': s.jitter,
+            'missed': loss.missed,
+            'short': checker.short,
+            'corrupt': checker.corrupt,
+        })
+    throughputs = [r['throughput_kbps'] for r in runs]
+    return {
+        'interval_ms': interval,
+        'data_length': data_len,
+        'burst': burst,
+        'offered_kbps': offered_load(interval, data_len, burst),
+        'throughput_kbps': statistics.median(throughputs),
+        'throughput_min_kbps': min(throughputs),
+        'throughput_max_kbps': max(throughputs),
+        'runs': runs,
+    }
+
+def find_saturation(points, ratio=0.9):
+    """Find the point where the throughput stops following the offered load.
+
+    The points are ordered by offered load. The saturation point is the first one whose median throughput is
+    below `ratio` times its offered load. Points of the saturation mode have no offered load and are skipped.
+
+    :Returns: `dict` with the saturation point and the maximum measured throughput or `None`
+    """
+    if not points:
+        return None
+    best = max(points, key=lambda p: p['throughput_kbps'])
+    ordered = sorted((p for p in points if p['offered_kbps'] is not None),
+                     key=lambda p: (p['offered_kbps'], p['throughput_kbps']))
+    for p in ordered:
+        if p['throughput_kbps'] < ratio * p['offered_kbps']:
+            return {
+                'interval_ms': p['interval_ms'],
+                'data_length': p['data_length'],
+                'burst': p.get('burst', 1),
+                'offered_kbps': p['offered_kbps'],
+                'throughput_kbps': p['throughput_kbps'],
+                'max_throughput_kbps': best['throughput_kbps'],
+            }
+    return None
+
+def compare(points, baseline, threshold):
+    """Compare the points with the points of a baseline result.
+
+    :Returns: `[ str ]` descriptions of the points whose throughput dropped by more than `threshold` percent
+    """
+    base = {(p['interval_ms'], p['data_length'], p.get('burst', 1)): p for p in baseline['points']}
+    regressions = []
+    for p in points:
+        b = base.get((p['interval_ms'], p['data_length'], p.get('burst', 1)))
+        if b is None or b['throughput_kbps'] <= 0:
+            continue
+        drop = (b['throughput_kbps'] - p['throughput_kbps']) * 100 / b['throughput_kbps']
+        if drop > threshold:
+            regressions.append(f'interval {p["interval_ms"]} ms, length {p["data_length"]} bytes, '
+                               f'burst {p.get("burst", 1)}: '
+                               f'{p["throughput_kbps"]:.3f} kbits/sec, {drop:.1f} % below baseline '
+                               f'{b["throughput_kbps"]:.3f} kbits/sec')
+    return regressions
+
+def write_csv(path, points):
+    fields = ['interval_ms', 'data_length', 'burst', 'offered_kbps', 'throughput_kbps', 'throughput_min_kbps',
+              'throughput_max_kbps', 'p99_inter_arrival_us', 'missed', 'short', 'corrupt']
+    with open(path, 'w', newline='') as f:
+        w = csv.DictWriter(f, fieldnames=fields)
+        w.writeheader()
+        for p in points:
+            runs = p['runs']
+            w.writerow({
+                **{k: p[k] for k in fields[:7] if k != 'burst'},
+                'burst': p.get('burst', 1),
+                'p99_inter_arrival_us': max(r['p99_inter_arrival_us'] for r in runs),
+                'missed': sum(r['missed'] for r in runs),
+                'short': sum(r['short'] for r in runs),
+                'corrupt': sum(r['corrupt'] for r in runs),
+            })
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Throughput sweep.')
+    parser.add_argument('-i', '--intervals', type=parse_list, default=[100, 50, 20, 10, 5, 2, 1],
+                        help='Notification intervals in milliseconds, e.g. 10,20,50 or 1:10:1')
+    parser.add_argument('-l', '--lengths', type=parse_list, default=[20, 50, 100, 150, 200, 244],
+                        help='Notification data sizes in bytes, e.g. 20,100,244 or 20:240:20')
+    parser.add_argument('-b', '--bursts', type=parse_list, default=[1],
+                        help='Notifications per interval, e.g. 1,2,4 or 1:8:1')
+    parser.add_argument('-n', '--num', type=int, default=200, help='Number of notifications to measure per run')
+    parser.add_argument('-w', '--warmup', type=int, default=10, help='Number of notifications to skip per run')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of runs per point')
+    parser.add_argument('-t', '--timeout', type=float, default=5.0, help='Seconds to wait for a notification')
+    parser.add_argument('--adapter', default='hci0', help='Bluetooth adapter')
+    parser.add_argument('--json', help='Write the results to this JSON file')
+    parser.add_argument('--csv', help='Write the results to this CSV file')
+    parser.add_argument('--saturation-ratio', type=float, default=0.9,
+                        help='Throughput / offered load ratio below which a point is saturated')
+    parser.add_argument('--baseline', help='JSON result of a previous sweep to compare with')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='Maximum throughput drop against the baseline in percent')
+    args = parser.parse_args()
+
+    mgr = Manager()
+    a = mgr.get_adapter(args.adapter)
+    print(f'Using {a}')
+    device = a.discover_device(throughput_test.check_device, discovery_filter=throughput_test.discoveryFilter)
+    if not device:
+        print('No device hosting the throughput service found.')
+        return 2
+    print(f'Found {device}')
+    points = []
+    try:
+        chars = throughput_test.connect(device)
+        if chars is None:
+            return 2
+        configChar = chars[throughput_test.configCharUUID]
+        dataChar = chars[throughput_test.dataCharUUID]
+        version = throughput_test.negotiate_config(configChar).version
+        if args.bursts != [1] and not version:
+            print('The peripheral only supports the legacy config without bursts.')
+            return 2
+        total = len(args.intervals) * len(args.lengths) * len(args.bursts)
+        for interval in args.intervals:
+            for data_len in args.lengths:
+                for burst in args.bursts:
+                    print(f'[{len(points)+1}/{total}] interval: {interval} ms, data_len: {data_len} bytes, '
+                          f'burst: {burst}')
+                    p = measure_point(configChar, dataChar, interval, data_len, args.num, args.warmup, args.repeat,
+                                      args.timeout, burst, version)
+                    offered = 'saturation mode' if p['offered_kbps'] is None else \
+                        f'offered {p["offered_kbps"]:.3f} kbits/sec'
+                    print(f'  -> {p["throughput_kbps"]:.3f} kbits/sec ({offered})')
+                    points.append(p)
+    finally:
+        device.disconnect()
+
+    result = {
+        'version': RESULT_VERSION,
+        'timestamp': time.time(),
+        'device': device.Address,
+        'parameters': {k: getattr(args, k) for k in ('intervals', 'lengths', 'bursts', 'num', 'warmup', 'repeat')},
+        'points': points,
+        'saturation': find_saturation(points, args.saturation_ratio),
+    }
+    sat = result['saturation']
+    if sat:
+        print(f'Saturation at interval {sat["interval_ms"]} ms, length {sat["data_length"]} bytes, '
+              f'burst {sat["burst"]}: {sat["throughput_kbps"]:.3f} of {sat["offered_kbps"]:.3f} kbits/sec offered, '
+              f'maximum {sat["max_throughput_kbps"]:.3f} kbits/sec.')
+    else:
+        print('No saturation within the sweep.')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.csv:
+        write_csv(args.csv, points)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(points, baseline, args.threshold)
+        for r in regressions:
+            print(f'Regression: {r}')
+        if regressions:
+            return 1
+        print(f'No throughput drop above {args.threshold} % against {args.baseline}.')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
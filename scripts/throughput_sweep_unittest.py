@@ -0,0 +1,129 @@
+# Copyright (c) 2021 Martin Roesch
+# SPDX-License-Identifier: Apache-2.0
+
+import csv
+import json
+import os
+import tempfile
+import unittest
+
+from throughput_sweep import compare, find_saturation, offered_load, parse_list, write_csv
+
+def make_point(interval, data_len, throughput, burst=1):
+    run = {'p99_inter_arrival_us': 1000, 'missed': 1, 'short': 0, 'corrupt': 2}
+    return {
+        'interval_ms': interval,
+        'data_length': data_len,
+        'burst': burst,
+        'offered_kbps': offered_load(interval, data_len, burst),
+        'throughput_kbps': throughput,
+        'throughput_min_kbps': throughput,
+        'throughput_max_kbps': throughput,
+        'runs': [run, dict(run, p99_inter_arrival_us=2000)],
+    }
+
+class TestCase01_ParseList(unittest.TestCase):
+    def test_01_List(self):
+        self.assertEqual(parse_list('10,20,50'), [10, 20, 50])
+        self.assertEqual(parse_list('5'), [5])
+
+    def test_02_Range(self):
+        self.assertEqual(parse_list('50:250:50'), [50, 100, 150, 200, 250])
+        self.assertEqual(parse_list('1:3'), [1, 2, 3])
+
+    def test_03_Invalid(self):
+        with self.assertRaises(ValueError):
+            parse_list('10,abc')
+
+class TestCase02_FindSaturation(unittest.TestCase):
+    def test_01_Saturation(self):
+        # Given
+        points = [make_point(10, 100, 80.0), make_point(5, 100, 155.0), make_point(2, 100, 250.0),
+                  make_point(1, 100, 260.0)]
+
+        # When
+        sat = find_saturation(points)
+
+        # Then
+        self.assertEqual((sat['interval_ms'], sat['data_length']), (2, 100))
+        self.assertEqual(sat['offered_kbps'], 400.0)
+        self.assertEqual(sat['max_throughput_kbps'], 260.0)
+
+    def test_02_NoSaturation(self):
+        self.assertIsNone(find_saturation([make_point(10, 100, 80.0), make_point(5, 100, 159.0)]))
+        self.assertIsNone(find_saturation([]))
+
+    def test_03_SaturationMode(self):
+        # Given
+        points = [make_point(10, 100, 80.0), make_point(0, 100, 700.0)]
+
+        # When
+        sat = find_saturation(points)
+
+        # Then
+        self.assertIsNone(points[1]['offered_kbps'])
+        self.assertIsNone(sat)
+        self.assertEqual(json.loads(json.dumps(points))[1]['offered_kbps'], None)
+
+class TestCase03_Compare(unittest.TestCase):
+    def test_01_Regression(self):
+        # Given
+        baseline = {'points': [make_point(10, 100, 80.0), make_point(5, 100, 160.0), make_point(2, 100, 300.0)]}
+        points = [make_point(10, 100, 75.0), make_point(5, 100, 120.0), make_point(1, 100, 10.0)]
+
+        # When
+        regressions = compare(points, baseline, 10.0)
+
+        # Then
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith('interval 5 ms, length 100 bytes, burst 1'))
+
+    def test_02_LegacyBaseline(self):
+        # Given
+        old = make_point(10, 100, 80.0)
+        del old['burst']
+
+        # When
+        regressions = compare([make_point(10, 100, 40.0), make_point(10, 100, 40.0, burst=2)], {'points': [old]}, 10.0)
+
+        # Then
+        self.assertEqual(len(regressions), 1)
+
+class TestCase04_WriteCsv(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_01_Rows(self):
+        # Given
+        legacy = make_point(10, 100, 80.0)
+        del legacy['burst']
+
+        # When
+        write_csv(self.path, [legacy, make_point(0, 100, 700.0, burst=2)])
+        with open(self.path, newline='') as f:
+            rows = list(csv.DictReader(f))
+
+        # Then
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0]['burst'], '1')
+        self.assertEqual(rows[0]['offered_kbps'], '80.0')
+        self.assertEqual(rows[0]['p99_inter_arrival_us'], '2000')
+        self.assertEqual((rows[0]['missed'], rows[0]['corrupt']), ('2', '4'))
+        self.assertEqual(rows[1]['burst'], '2')
+        self.assertEqual(rows[1]['offered_kbps'], '')
+
+    def test_02_MissingColumn(self):
+        # Given
+        point = make_point(10, 100, 80.0)
+        del point['throughput_min_kbps']
+
+        # When / Then
+        with self.assertRaises(KeyError):
+            write_csv(self.path, [point])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,122 +4,879 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import logging
+import os
 import struct
+import threading
 import time
 import argparse
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from queue import Empty
 
-from bluez import Manager
+from bluez import CallBatch, GattSession, Manager, enable_instrumentation
+from throughput_capture import CaptureReader, CaptureWriter, replay
+from throughput_integrity import (DeliveryReport, IntegrityChecker, LossEstimate, PeripheralStatistics,
+                                  expected_pattern, format_delivery, format_report)
+from throughput_stats import NotificationStats, RollingStats, format_summary, format_window
 
-# Setup logging
-logging.basicConfig(level=logging.INFO) # Set to DEBUG for debug logs of bluez module
 log = logging.getLogger('Throughput')
-log.setLevel(logging.INFO) # Set to DEBUG for debug logs of this script
+
+# Throughput service
+serviceUUID = 'abcdef00-f5bf-58d5-9d17-172177d1316a'
+configCharUUID = 'abcdef01-f5bf-58d5-9d17-172177d1316a'
+dataCharUUID = 'abcdef02-f5bf-58d5-9d17-172177d1316a'
+statisticsCharUUID = 'abcdef03-f5bf-58d5-9d17-172177d1316a'
+sinkCharUUID = 'abcdef04-f5bf-58d5-9d17-172177d1316a'
+configFormat = 'HB' # Legacy layout of the config characteristic, see ThroughputConfig
+sinkFormat = '<II'
 
 # Test parameters
 configInterval = 100 # Notification interval in milliseconds
+saturationInterval = 0 # Interval selecting the flow controlled saturation mode of the firmware
 configDataLen = 200 # Notification data size in bytes
 numDataNotifications = 10 # Number of notifications to receive from the data characteristic
+numPeripherals = 1 # Number of peripherals to receive from concurrently
+soakWindow = 10.0 # Reporting window of the soak mode in seconds
+reconnectBackoff = (1.0, 30.0) # First and maximum delay between reconnection attempts in seconds
+
+# Only report LE devices advertising the throughput service, without duplicate advertisements
+discoveryFilter = {'UUIDs': [serviceUUID], 'Transport': 'le', 'DuplicateData': False}
+
+def check_device(device):
+    """Discovery check for peripherals advertising the throughput service."""
+    uuids = device.UUIDs
+    log.debug(f'Check UUIDs: {uuids}')
+    return serviceUUID in uuids
+
+class ThroughputConfig:
+    """Value of the config characteristic.
+
+    Version 0 is the legacy layout `{uint16 interval_ms, uint8 data_length}`. Version 1 appends `{uint8 version,
+    uint8 burst, uint8 flags, uint32 max_notifications, uint32 duration_ms}`: `burst` notifications are sent per
+    interval, with `FLAG_MTU_FIT` the notifications are sized to the negotiated MTU and the peripheral stops after
+    `max_notifications` notifications or `duration_ms` milliseconds (0 for no limit).
+    """
+    LEGACY = struct.Struct('<HB')
+    EXTENDED = struct.Struct('<HBBBBII')
+    VERSION = 1
+    FLAG_MTU_FIT = 0x01
+
+    def __init__(self, interval=configInterval, data_len=configDataLen, burst=1, flags=0, max_notifications=0,
+                 duration_ms=0, version=VERSION):
+        self.interval = interval
+        self.data_len = data_len
+        self.burst = burst
+        self.flags = flags
+        self.max_notifications = max_notifications
+        self.duration_ms = duration_ms
+        self.version = version
+
+    @classmethod
+    def unpack(cls, data):
+        """Decode a value read from the config characteristic.
+
+        :Raises `ValueError`: if `data` has neither layout
+        """
+        data = bytes(data)
+        if len(data) == cls.LEGACY.size:
+            return cls(*cls.LEGACY.unpack(data), version=0)
+        if len(data) == cls.EXTENDED.size:
+            interval, data_len, version, burst, flags, max_notifications, duration_ms = cls.EXTENDED.unpack(data)
+            return cls(interval, data_len, burst, flags, max_notifications, duration_ms, version)
+        raise ValueError(f'Config value has {len(data)} bytes')
+
+    def pack(self):
+        if self.version == 0:
+            return self.LEGACY.pack(self.interval, self.data_len)
+        return self.EXTENDED.pack(self.interval, self.data_len, self.version, self.burst, self.flags,
+                                  self.max_notifications, self.duration_ms)
+
+    @property
+    def extended(self):
+        """`True` if any parameter needs the extended layout."""
+        return self.burst != 1 or self.flags or self.max_notifications or self.duration_ms
+
+    def describe(self, prefix=''):
+        lines = [f'{prefix}- interval: {format_interval(self.interval)}',
+                 f'{prefix}- data_len: {self.data_len} bytes']
+        if self.version:
+            lines += [f'{prefix}- burst: {self.burst} notifications per interval',
+                      f'{prefix}- mtu_fit: {bool(self.flags & self.FLAG_MTU_FIT)}',
+                      f'{prefix}- max_notifications: {self.max_notifications or "unlimited"}',
+                      f'{prefix}- duration: {f"{self.duration_ms} ms" if self.duration_ms else "unlimited"}']
+        return lines
+
+def negotiate_config(configChar):
+    """Find the layout of the config characteristic the peripheral supports.
+
+    A peripheral returns the legacy layout until the extended layout has been written on the connection. The
+    current parameters are therefore written back in the extended layout, which firmware that only knows the
+    legacy layout rejects.
+
+    :Returns: a `ThroughputConfig` with the current parameters and the supported `version`
+    """
+    config = ThroughputConfig.unpack(configChar.ReadValue())
+    if config.version >= ThroughputConfig.VERSION:
+        return config
+    config.version = ThroughputConfig.VERSION
+    try:
+        configChar.WriteValue(config.pack())
+    except Exception as e:
+        log.debug(f'Extended config rejected: {e}')
+        config.version = 0
+    return config
+
+def configure(configChar, interval, data_len, prefix='', **extended):
+    """Print the current parameters of the config characteristic and write the new ones.
+
+    :Parameters:
+        `extended` : dict
+            `burst`, `flags`, `max_notifications` and `duration_ms` of the extended layout, ignored with a
+            warning if the peripheral only supports the legacy layout
+
+    :Returns: the written `ThroughputConfig`
+    """
+    print(f'{prefix}Read config characteristic {configCharUUID} parameters:')
+    current = negotiate_config(configChar)
+    log.debug(f'-> version {current.version}')
+    for line in current.describe(prefix):
+        print(line)
+
+    if not current.version:
+        if ThroughputConfig(**extended).extended:
+            print(f'{prefix}Peripheral only supports the legacy config, ignoring burst, MTU fit and limits.')
+        extended = {}
+    config = ThroughputConfig(interval, data_len, version=current.version, **extended)
+    print(f'{prefix}Set config characteristic {configCharUUID} parameters:')
+    for line in config.describe(prefix):
+        print(line)
+    write_config(configChar, interval, data_len, current.version, **extended)
+    print(f'{prefix}Done.')
+    return config
+
+def format_interval(interval):
+    if interval == saturationInterval:
+        return '0 (saturation: as fast as the TX buffers of the peripheral get free)'
+    return f'{interval} ms'
+
+def write_config(configChar, interval, data_len, version=0, **extended):
+    """Write the config characteristic in the legacy layout or, with `version` 1, in the extended layout with the
+    `burst`, `flags`, `max_notifications` and `duration_ms` parameters of `ThroughputConfig`."""
+    data = ThroughputConfig(interval, data_len, version=version, **extended).pack()
+    log.debug(f'Write to {configCharUUID}: {data}')
+    ret = configChar.WriteValue(data)
+    log.debug(f'-> {ret}')
+
+def setup(device, interval, data_len, prefix='', **extended):
+    """Connect to `device`, resolve the throughput service and configure it, see `configure`.
+
+    :Returns: `{ str: bluez.GattCharacteristic }` the characteristics of the throughput service or `None` if the
+        device does not host it
+    """
+    chars = connect(device, prefix)
+    if chars is None:
+        return None
+    configChar = chars.get(configCharUUID)
+    if configChar:
+        configure(configChar, interval, data_len, prefix, **extended)
+    return chars
+
+def connect(device, prefix=''):
+    """Connect to `device` and resolve the throughput service.
+
+    :Returns: `{ str: bluez.GattCharacteristic }` the characteristics of the throughput service or `None`
+    """
+    print(f'{prefix}Connect to {device}')
+    device.connect()
+    print(f'{prefix}Done.')
+
+    services = device.get_gattservices();
+    log.debug(f'GATT services: {services}')
+    print(f'{prefix}Check for throughput service {serviceUUID}')
+    if serviceUUID not in services.keys():
+        print(f'{prefix}Throughput service {serviceUUID} not found on {device}')
+        return None
+    service = services[serviceUUID]
+    print(f'{prefix}Found.')
+
+    chars = service.get_gattcharacteristics()
+    log.debug(f'GATT characteristics: {chars!r}')
+    return chars
+
+def receive(dataChar, num, interval, data_len, verbose=False, capture=None, statsChar=None, monitor=False):
+    """Receive `num` notifications from the data characteristic and print a summary.
+
+    Only the timestamps and lengths of the notifications are recorded and the content of each batch of
+    notifications is checked while receiving, the statistics and the optional per notification output are
+    computed afterwards.
+
+    :Parameters:
+        `capture` : str
+            File to capture the notifications to, see `throughput_capture`
+        `statsChar` : bluez.GattCharacteristic
+            The statistics characteristic, read before and after the run to report where notifications were
+            dropped
+        `monitor` : bool
+            Print the periodic notifications of the statistics characteristic while receiving
+
+    :Returns: a `throughput_stats.NotificationStats`
+    """
+    before = read_statistics(statsChar) if statsChar else None
+    print(f'Receive {num} notifications from data characteristic {dataCharUUID}')
+    with monitor_statistics(statsChar if monitor else None):
+        if capture:
+            print(f'Capture notifications to {capture}')
+            with CaptureWriter(capture, {'interval_ms': interval, 'data_length': data_len}) as tap:
+                stats, checker = collect(dataChar, num, data_len, tap=tap)
+            if tap.dropped:
+                print(f'Capture dropped {tap.dropped} notifications, the disk did not keep up.')
+        else:
+            stats, checker = collect(dataChar, num, data_len)
+    print_results(stats, checker, interval, verbose)
+    if before is not None:
+        # Notifications are disabled by now, the counters only change by the notifications still queued
+        report = DeliveryReport(before, read_statistics(statsChar), checker.notifications)
+        for line in format_delivery(report):
+            print(line)
+    return stats
+
+def read_statistics(statsChar):
+    """Read and decode the statistics characteristic.
+
+    :Returns: a `throughput_integrity.PeripheralStatistics`
+    """
+    return PeripheralStatistics.unpack(bytes(statsChar.ReadValue()))
+
+@contextmanager
+def monitor_statistics(statsChar, prefix=''):
+    """Print the periodic notifications of the statistics characteristic from a background thread while the
+    context is active. Does nothing if `statsChar` is `None`."""
+    if statsChar is None:
+        yield
+        return
+    stop = threading.Event()
+    def run():
+        with statsChar.dbus_signal_notify() as q:
+            last = None
+            while not stop.is_set():
+                try:
+                    s = PeripheralStatistics.unpack(q.get(timeout=0.1))
+                except Empty:
+                    continue
+                except ValueError as e:
+                    log.error(f'Statistics: {e}')
+                    continue
+                d = s - last if last is not None else s
+                print(f'{prefix}Peripheral: {d.sent} of {d.attempted} notifications sent ({d.bytes} bytes), '
+                      f'{d.err_nomem} out of buffers, {s.queued} queued, MTU {s.mtu}')
+                last = s
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+def print_results(stats, checker, interval, verbose=False):
+    if verbose:
+        print_notifications(stats)
+    for line in format_summary(stats.summary()):
+        print(line)
+    for line in format_report(checker, LossEstimate(stats.snapshot()[0], interval)):
+        print(line)
+
+def replay_capture(path, speed=None, verbose=False):
+    """Feed a capture through the statistics and integrity checks and print the results.
+
+    :Parameters:
+        `speed` : float
+            Replay at `speed` times the recorded pace, `None` to replay as fast as possible
+    """
+    with CaptureReader(path) as reader:
+        interval = reader.metadata.get('interval_ms', 0)
+        data_len = reader.metadata.get('data_length', 0)
+        print(f'Replay {path}: interval: {format_interval(interval)}, data_len: {data_len} bytes')
+        stats = NotificationStats(reader.start)
+        checker = IntegrityChecker(data_len)
+        for batch in replay(reader, speed):
+            checker.check_batch(batch)
+            stats.record_batch(batch.lengths, batch.timestamp)
+    print_results(stats, checker, interval, verbose)
+    return stats
+
+def collect(dataChar, num, data_len, warmup=0, timeout=None, tap=None):
+    """Enable notifications of the data characteristic, skip `warmup` notifications and record `num`.
+
+    :Parameters:
+        `timeout` : float
+            Seconds to wait for the next notification, `None` to wait forever
+        `tap` : object
+            Passed to `GattCharacteristic.fd_notify_batched`, e.g. a `throughput_capture.CaptureWriter`
+
+    :Returns: `(throughput_stats.NotificationStats, throughput_integrity.IntegrityChecker)`
+    """
+    checker = IntegrityChecker(data_len)
+    stats = None
+    with dataChar.fd_notify_batched(tap=tap) as q:
+        skip = warmup
+        if not skip:
+            stats = NotificationStats()
+        while stats is None or len(stats) < num:
+            try:
+                batch = q.get(timeout=timeout)
+            except Empty:
+                print(f'No notification within {timeout} seconds.')
+                break
+            if batch is None:
+                print('Notifications stopped.')
+                break
+            with batch:
+                lengths = batch.lengths
+                first = 0
+                if stats is None:
+                    if skip >= len(lengths):
+                        skip -= len(lengths)
+                        continue
+                    first = skip
+                    skip = 0
+                    stats = NotificationStats(batch.timestamp)
+                # Only the recorded notifications are checked, not the warm-up or those beyond `num`
+                count = min(len(lengths) - first, num - len(stats))
+                checker.check_batch(batch, first, count)
+                stats.record_batch(lengths[first:first + count], batch.timestamp)
+    return stats or NotificationStats(), checker
+
+def upload(sinkChar, num, data_len):
+    """Write `num` packets of `data_len` bytes without response to the sink characteristic and print a summary.
+
+    The peripheral counts the received bytes and packets, the counters are read before and after the upload.
+    """
+    print(f'Upload {num} packets of {data_len} bytes to sink characteristic {sinkCharUUID}')
+    sent_bytes, sent_writes = struct.unpack(sinkFormat, sinkChar.ReadValue())
+    payload = expected_pattern(data_len)
+    with sinkChar.fd_write() as w:
+        if data_len > w.max_payload:
+            print(f'Packets are split to the maximum payload of {w.max_payload} bytes (MTU {w.mtu}).')
+        start = time.monotonic()
+        w.write_many(itertools.repeat(payload, num))
+        end = time.monotonic()
+    # Reading the counters is queued behind the pending write commands
+    received_bytes, received_writes = struct.unpack(sinkFormat, sinkChar.ReadValue())
+    received_bytes -= sent_bytes
+    received_writes -= sent_writes
+    duration = end - start
+    throughput = w.bytes * 8 / duration / 1000 if duration > 0 else 0.0
+    print(f'Summary: Wrote {w.bytes} bytes in {w.writes} packets during {duration:.3f} seconds: '
+          f'{throughput:.3f} kbits/sec, {w.stalls} stalls on a full socket.')
+    print(f'Peripheral received {received_bytes} bytes in {received_writes} packets.')
+    return w
+
+def print_notifications(stats):
+    timestamps, lengths = stats.snapshot()
+    last = stats.start
+    for i, (t, n) in enumerate(zip(timestamps, lengths)):
+        print(f'Notification {i+1:4}: {n:3} bytes, timestamp: {(t - stats.start):{7}.{3}} s, '
+              f'dt: {(t - last):{7}.{3}} s')
+        last = t
+
+class LinkResult:
+    """Received data of one link of a multi-peripheral run.
+
+    `interval` is the mean interval between the notifications of the link in milliseconds, the loss is estimated
+    from it.
+    """
+    def __init__(self, device, interval):
+        self.device = device
+        self.interval = interval
+        self.notifications = 0
+        self.bytes = 0
+        self.start = 0.0
+        self.end = 0.0
+        self.stats = None
+        self.checker = None
+        self.error = None
+
+    @property
+    def duration(self):
+        return self.end - self.start
 
-# Command line arguments
-parser = argparse.ArgumentParser(description='Throughput test.')
-parser.add_argument('-i', '--interval', type=int, help = 'Notification interval in milliseconds')
-parser.add_argument('-l', '--length', type=int, help = 'Notification data size in bytes')
-parser.add_argument('-n', '--num', type=int, help = 'Number of notifications to receive')
-args = parser.parse_args()
-if args.interval:
-    configInterval = args.interval
-if args.length:
-    configDataLen = args.length
-if args.num:
-    numDataNotifications = args.num
-
-try:
-    mgr = Manager();
-    a = mgr.get_adapter('hci0')
-    print(f'Using {a}')
-    
-    serviceUUID = 'abcdef00-f5bf-58d5-9d17-172177d1316a'
+    @property
+    def throughput(self):
+        """Throughput in kbits/sec"""
+        return self.bytes * 8 / self.duration / 1000 if self.duration > 0 else 0.0
+
+def jain_fairness(values):
+    """Jain's fairness index: 1.0 if all values are equal, 1/n if a single value dominates."""
+    values = list(values)
+    square_sum = sum(v * v for v in values)
+    if not square_sum:
+        return 0.0
+    return sum(values) ** 2 / (len(values) * square_sum)
+
+def receive_multi(links, num, interval, data_len, timeout=None, configs=None):
+    """Receive `num` notifications from each data characteristic in `links` concurrently.
+
+    The links start receiving together, once notifications are enabled on all of them. A link whose notifications
+    cannot be enabled does not hold up the others, it is returned with `error` set and without `stats`. A link stops
+    receiving when no notification arrived within `timeout`.
+
+    :Parameters:
+        `links` : { bluez.Device: bluez.GattCharacteristic }
+        `timeout` : float
+            Seconds to wait for the other links to start and for each notification, defaults to 10 intervals but
+            at least 5 seconds
+        `configs` : { bluez.Device: ThroughputConfig }
+            The configs written by `configure_all`, their burst and notification size replace `interval` and
+            `data_len` of the links
+
+    :Returns: `[ LinkResult ]`
+    """
+    if timeout is None:
+        timeout = max(5.0, 10 * interval / 1000)
+    configs = configs or {}
+    results = []
+    for device in links:
+        config = configs.get(device)
+        # Loss is estimated from the mean interval between the notifications of a burst
+        results.append(LinkResult(device, interval / config.burst if config else interval))
+    start = threading.Barrier(len(results))
+    def run(result, dataChar):
+        config = configs.get(result.device)
+        try:
+            with dataChar.fd_notify_batched() as q:
+                try:
+                    start.wait(timeout)
+                except threading.BrokenBarrierError:
+                    log.warning(f'{result.device}: Not all links started, start anyway.')
+                result.start = time.monotonic()
+                result.stats = NotificationStats(result.start)
+                result.checker = IntegrityChecker(config.data_len if config else data_len)
+                while result.notifications < num:
+                    try:
+                        batch = q.get(timeout=timeout)
+                    except Empty:
+                        log.error(f'{result.device}: No notification within {timeout:g} seconds.')
+                        break
+                    if batch is None:
+                        log.error(f'{result.device}: Notifications stopped.')
+                        break
+                    with batch:
+                        result.checker.check_batch(batch)
+                        result.stats.record_batch(batch.lengths, batch.timestamp)
+                        result.notifications += len(batch)
+                        result.bytes += batch.nbytes
+                result.end = time.monotonic()
+        except Exception as e:
+            start.abort()
+            result.error = e
+            if result.stats is not None and not result.end:
+                result.end = time.monotonic()
+            log.error(f'{result.device}: Receive failed: {e}')
+    threads = [threading.Thread(target=run, args=(r, links[r.device])) for r in results]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+def print_multi_summary(results):
+    for i, r in enumerate(results):
+        if r.stats is None:
+            print(f'Link {i+1} ({r.device.Address}): Failed: {r.error}')
+            continue
+        print(f'Link {i+1} ({r.device.Address}): Received {r.bytes} bytes in {r.notifications} notifications '
+              f'during {r.duration:.3f} seconds: {r.throughput:.3f} kbits/sec.')
+        h = r.stats.summary().inter_arrival
+        print(f'  Inter-arrival [ms]: p50: {h.percentile(50) / 1000:.3f}, p99: {h.percentile(99) / 1000:.3f}, '
+              f'max: {(h.max or 0) / 1000:.3f}')
+        for line in format_report(r.checker, LossEstimate(r.stats.snapshot()[0], r.interval)):
+            print(f'  {line}')
+    received = [r for r in results if r.stats is not None]
+    if not received:
+        print('Summary: No link received notifications.')
+        return
+    total = sum(r.bytes for r in received)
+    duration = max(r.end for r in received) - min(r.start for r in received)
+    throughput = total * 8 / duration / 1000 if duration > 0 else 0.0
+    print(f'Summary: Received {total} bytes over {len(received)} of {len(results)} links during {duration:.3f} '
+          f'seconds: {throughput:.3f} kbits/sec.')
+    print(f'Fairness (Jain\'s index): {jain_fairness(r.throughput for r in received):.3f}')
+
+def run_single(a, interval, data_len, num, verbose=False, capture=None, monitor=False, **extended):
     print(f'Discover device hosting the throughput service {serviceUUID} for 10 seconds.')
-    def check(device):
-        uuids = device.UUIDs
-        log.debug(f'Check UUIDs: {uuids}')
-        return serviceUUID in uuids
-    device = a.discover_device(check)
-    if device:
-        print('Found.')
-        print(f'Connect to {device}')
-        device.connect()
+    device = a.discover_device(check_device, discovery_filter=discoveryFilter)
+    if not device:
+        print('Not found.')
+        return
+    print('Found.')
+    try:
+        chars = connect(device)
+        if not chars or configCharUUID not in chars or dataCharUUID not in chars:
+            return
+        config = configure(chars[configCharUUID], interval, data_len, **extended)
+        statsChar = chars.get(statisticsCharUUID)
+        if config.flags & ThroughputConfig.FLAG_MTU_FIT and statsChar:
+            data_len = read_statistics(statsChar).mtu - 3
+            print(f'Notifications are sized to the MTU: {data_len} bytes')
+        # Loss is estimated from the mean interval between the notifications of a burst
+        receive(chars[dataCharUUID], num, interval / config.burst, data_len, verbose, capture, statsChar, monitor)
+    finally:
+        print(f'Disconnect {device}')
+        device.disconnect()
         print('Done.')
-        
-        services = device.get_gattservices();
-        log.debug(f'GATT services: {services}')
-        print(f'Check for throughput service {serviceUUID}')
-        if serviceUUID in services.keys():
-            service = services[serviceUUID]
-            print('Found.')
-            
-            chars = service.get_gattcharacteristics()
-            log.debug(f'GATT characteristics: {chars!r}')
-            configCharUUID = 'abcdef01-f5bf-58d5-9d17-172177d1316a'
-            configChar = chars[configCharUUID]
-            if configChar:
-                configFormat = 'HB'
-                print(f'Read config characteristic {configCharUUID} parameters:')
-                data = configChar.ReadValue()
-                log.debug(f'-> {data}')
-                interval, data_len = struct.unpack(configFormat, data)
-                print(f'- interval: {interval} ms')
-                print(f'- data_len: {data_len} bytes')
-                
-                print(f'Set config characteristic {configCharUUID} parameters:')
-                print(f'- interval: {configInterval} ms')
-                print(f'- data_len: {configDataLen} bytes')
-                data = struct.pack(configFormat, configInterval, configDataLen)
-                log.debug(f'Write to {configCharUUID}: {data}')
-                ret = configChar.WriteValue(data)
-                log.debug(f'-> {ret}')
-                print('Done.')
-            
-            dataCharUUID = 'abcdef02-f5bf-58d5-9d17-172177d1316a'
-            dataChar = chars[dataCharUUID]
-            if dataChar:
-                with dataChar.fd_notify() as q:
-                    print(f'Receive {numDataNotifications} notifications from data characteristic {dataCharUUID}')
-                    startTime = time.time()
-                    lastNotificationTime = startTime
-                    notificationCount = 0
-                    dataSize = 0
-                    stats = {
-                        "dt_min": 1.0,
-                        "dt_max": 0.0
-                        }
-                    for i in range(numDataNotifications):
-                        n = q.get()
-                        notificationTime = time.time()
-                        notificationCount += 1
-                        dataSize += len(n)
-                        dt = notificationTime - lastNotificationTime
-                        if i > 1:
-                            if dt < stats["dt_min"]:
-                                stats["dt_min"] = dt
-                            if dt > stats["dt_max"]:
-                                stats["dt_max"] = dt
-                        print(f'Notification {i+1:4}: {len(n):3} bytes, timestamp: {(notificationTime - startTime):{7}.{3}} s, '
-                              f'dt: {(dt):{7}.{3}} s')
-                        lastNotificationTime = notificationTime
-                    endTime = time.time()
-                    throughput = dataSize * 8 / (endTime - startTime) / 1000
-                    print(f'Summary: Received {dataSize} bytes in {notificationCount} notificattions '
-                          f'during {endTime - startTime:.{3}} seconds: {throughput:.3f} kbits/sec.')
-                    print(f'min dt: {(stats["dt_min"]*1000):{7}.{3}} ms, max dt: {(stats["dt_max"]*1000):{7}.{3}} ms.')
-        else:
-            print(f'Throughput service {serviceUUID} not found on {device}')
+
+def resident_memory():
+    """Returns the resident set size of the process in bytes, `None` if it is not available."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+def soak_setup(session, interval, data_len, **extended):
+    """Connect to the device of `session` and configure it for the soak mode.
+
+    The `bluez.GattSession` reuses the characteristics resolved by the first connection, as long as BlueZ keeps
+    them cached.
+
+    :Returns: `(data characteristic, data length)` or `None` if the connection or configuration failed
+    """
+    try:
+        print(f'Connect to {session.device}')
+        fast = session.fast_connects
+        chars = session.connect()
+        print('Done, GATT objects cached.' if session.fast_connects > fast else 'Done.')
+        if configCharUUID not in chars or dataCharUUID not in chars:
+            print(f'Throughput service {serviceUUID} not found on {session.device}')
+            session.invalidate()
+            return None
+        config = configure(chars[configCharUUID], interval, data_len, **extended)
+        statsChar = chars.get(statisticsCharUUID)
+        if config.flags & ThroughputConfig.FLAG_MTU_FIT and statsChar:
+            data_len = read_statistics(statsChar).mtu - 3
+        return chars[dataCharUUID], data_len
+    except Exception as e:
+        print(f'Connection failed: {e}')
+        return None
+
+def soak_receive(device, dataChar, rolling, checker, end, silence, tap=None):
+    """Receive notifications into `rolling` until `end` and print every window as it closes.
+
+    :Parameters:
+        `silence` : float
+            Seconds without notification after which the link is checked
+        `tap` : object
+            Passed to `fd_notify_batched`, e.g. `bluez.GattSession.notify_tap()`
+
+    :Returns: `None` at the end, `'lost'` if the link dropped or `'silent'` if the link is up but no notification
+        was received for `silence` seconds
+    """
+    with dataChar.fd_notify_batched(tap=tap) as q:
+        last = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if now >= end:
+                return None
+            try:
+                batch = q.get(timeout=max(0, min(rolling.window_end, end) - now))
+            except Empty:
+                batch = False
+            if batch is None:
+                return 'lost'
+            if batch:
+                with batch:
+                    checker.check_batch(batch)
+                    closed = rolling.record_batch(batch.lengths, batch.timestamp)
+                    last = batch.timestamp
+            else:
+                now = time.monotonic()
+                closed = rolling.roll(now)
+                if now - last > silence:
+                    return 'silent' if device.Connected else 'lost'
+            print_windows(closed, rolling)
+
+def print_windows(windows, rolling):
+    rss = resident_memory()
+    for w in windows:
+        line = format_window(w, rolling.start)
+        print(line if rss is None else f'{line}, RSS: {rss / 1e6:.1f} MB')
+
+def soak(a, interval, data_len, duration, window=soakWindow, stall=None, **extended):
+    """Receive notifications for `duration` seconds with constant memory.
+
+    The notifications are accumulated into the windows of a `throughput_stats.RollingStats`, every window is
+    printed as it closes. When the link drops, the script reconnects with exponential backoff, configures the
+    peripheral and enables the notifications again, and logs how long the outage lasted.
+
+    :Parameters:
+        `stall` : float
+            Gap between notifications in seconds that is counted as stall, defaults to 10 intervals but at least
+            one second
+
+    :Returns: the `throughput_stats.RollingStats` or `None` if no device was found
+    """
+    print(f'Discover device hosting the throughput service {serviceUUID} for 10 seconds.')
+    device = a.discover_device(check_device, discovery_filter=discoveryFilter)
+    if not device:
+        print('Not found.')
+        return None
+    print('Found.')
+    session = GattSession(device, [configCharUUID, dataCharUUID, statisticsCharUUID])
+    stall = stall or max(1.0, 10 * interval / 1000)
+    rolling = RollingStats(window, stall=stall)
+    checker = None
+    end = rolling.start + duration
+    outages = []
+    lost = None
+    backoff = reconnectBackoff[0]
+    print(f'Soak for {duration:g} seconds, report every {window:g} seconds, stalls: gaps above {stall:g} seconds')
+    try:
+        while time.monotonic() < end:
+            setup = soak_setup(session, interval, data_len, **extended)
+            if setup is None:
+                print_windows(rolling.roll(time.monotonic()), rolling)
+                delay = min(backoff, max(0, end - time.monotonic()))
+                print(f'Retry in {delay:.1f} seconds.')
+                time.sleep(delay)
+                backoff = min(backoff * 2, reconnectBackoff[1])
+                continue
+            backoff = reconnectBackoff[0]
+            dataChar, length = setup
+            if checker is None or checker.data_length != length:
+                checker = IntegrityChecker(length)
+            if lost is not None:
+                now = time.monotonic()
+                print_windows(rolling.roll(now), rolling)
+                rolling.record_outage(now - lost)
+                outages.append(now - lost)
+                print(f'Link restored after {now - lost:.3f} seconds.')
+                lost = None
+            while True:
+                result = soak_receive(device, dataChar, rolling, checker, end, max(5.0, 5 * stall),
+                                      session.notify_tap())
+                if result != 'silent':
+                    break
+                print('No notifications although connected, enable notifications again.')
+            if result == 'lost':
+                rolling.interrupt()
+                lost = time.monotonic()
+                print(f'Link lost at {lost - rolling.start:.3f} seconds, reconnect.')
+        if lost is not None:
+            outages.append(time.monotonic() - lost)
+    finally:
         print(f'Disconnect {device}')
         device.disconnect()
         print('Done.')
+    print_soak_summary(rolling, checker, outages, session)
+    return rolling
+
+def print_soak_summary(rolling, checker, outages, session=None):
+    s = rolling.summary()
+    duration = time.monotonic() - rolling.start
+    h = rolling.inter_arrival
+    print(f'Summary: Received {rolling.bytes} bytes in {rolling.notifications} notifications during '
+          f'{duration:.3f} seconds: {rolling.bytes * 8 / duration / 1000:.3f} kbits/sec.')
+    if s:
+        t = s['throughput_kbps']
+        print(f'Throughput of the last {s["windows"]} windows [kbits/sec]: min: {t["min"]:.3f}, '
+              f'mean: {t["mean"]:.3f}, max: {t["max"]:.3f}, first: {rolling.windows[0].throughput:.3f}, '
+              f'last: {rolling.windows[-1].throughput:.3f}')
+    if h.count:
+        print(f'Inter-arrival [ms]: p50: {h.percentile(50) / 1000:.3f}, p99: {h.percentile(99) / 1000:.3f}, '
+              f'p99.9: {h.percentile(99.9) / 1000:.3f}, max: {h.max / 1000:.3f}')
+    print(f'Stalls: {rolling.stalls} gaps above {rolling.stall:g} seconds.')
+    if outages:
+        print(f'Outages: {len(outages)}, total: {sum(outages):.3f} seconds, longest: {max(outages):.3f} seconds.')
     else:
+        print('Outages: none.')
+    if session is not None and session.latency.count:
+        h = session.latency
+        print(f'Connect to first notification [ms]: p50: {h.percentile(50) * 1000:.1f}, '
+              f'p99: {h.percentile(99) * 1000:.1f}, max: {h.max * 1000:.1f} ({session.connects} connections, '
+              f'{session.fast_connects} from the GATT cache)')
+    if checker is not None:
+        for line in format_report(checker):
+            print(line)
+
+def run_upload(a, data_len, num):
+    print(f'Discover device hosting the throughput service {serviceUUID} for 10 seconds.')
+    device = a.discover_device(check_device, discovery_filter=discoveryFilter)
+    if not device:
         print('Not found.')
-except BaseException as e:
-    print(f'Caught exception: {e}')
-    raise e
-print('Exit')
+        return
+    print('Found.')
+    try:
+        chars = connect(device)
+        if chars is None:
+            return
+        sinkChar = chars.get(sinkCharUUID)
+        if sinkChar is None:
+            print(f'Sink characteristic {sinkCharUUID} not found on {device}')
+            return
+        upload(sinkChar, num, data_len)
+    finally:
+        print(f'Disconnect {device}')
+        device.disconnect()
+        print('Done.')
+
+def connect_all(devices, prefix=''):
+    """Connect to all `devices` in parallel and resolve their throughput service.
+
+    :Returns: `{ bluez.Device: { str: bluez.GattCharacteristic } }` the characteristics of the devices that host
+        the throughput service
+    """
+    with ThreadPoolExecutor(max_workers=len(devices)) as executor:
+        futures = {d: executor.submit(connect, d, f'{prefix}[{d.Address}] ') for d in devices}
+    chars = {}
+    for d, f in futures.items():
+        try:
+            c = f.result()
+        except BaseException as e:
+            print(f'{prefix}[{d.Address}] Setup failed: {e}')
+            continue
+        if c and configCharUUID in c and dataCharUUID in c:
+            chars[d] = c
+    return chars
+
+def configure_all(chars, interval, data_len, prefix='', **extended):
+    """Negotiate the config layout of every device and write the config characteristics of all devices at once.
+
+    :Parameters:
+        `chars` : { bluez.Device: { str: bluez.GattCharacteristic } }
+        `extended` : dict
+            `burst`, `flags`, `max_notifications` and `duration_ms` of the extended layout, ignored with a
+            warning on devices that only support the legacy layout, see `configure`
+
+    :Returns: `({ bluez.Device: bluez.GattCharacteristic }, { bluez.Device: ThroughputConfig })` the data
+        characteristics and the written configs of the configured devices. The `data_len` of a config is the size
+        of its notifications, i.e. the MTU of the link if the notifications are sized to it.
+    """
+    with ThreadPoolExecutor(max_workers=max(len(chars), 1)) as executor:
+        futures = {d: executor.submit(negotiate_config, c[configCharUUID]) for d, c in chars.items()}
+    configs = {}
+    for d, f in futures.items():
+        try:
+            current = f.result()
+        except BaseException as e:
+            print(f'{prefix}[{d.Address}] Configuration failed: {e}')
+            continue
+        if current.version:
+            configs[d] = ThroughputConfig(interval, data_len, version=current.version, **extended)
+        else:
+            if ThroughputConfig(**extended).extended:
+                print(f'{prefix}[{d.Address}] Peripheral only supports the legacy config, ignoring burst, MTU fit '
+                      f'and limits.')
+            configs[d] = ThroughputConfig(interval, data_len, version=0)
+    print(f'{prefix}Set config characteristic {configCharUUID} parameters of {len(configs)} devices:')
+    for line in ThroughputConfig(interval, data_len, **extended).describe(prefix):
+        print(line)
+    batch = CallBatch()
+    for d, config in configs.items():
+        batch.write(chars[d][configCharUUID], config.pack())
+    links = {}
+    for (d, config), result in zip(list(configs.items()), batch.wait(return_exceptions=True)):
+        if isinstance(result, Exception):
+            print(f'{prefix}[{d.Address}] Configuration failed: {result}')
+            del configs[d]
+            continue
+        statsChar = chars[d].get(statisticsCharUUID)
+        if config.flags & ThroughputConfig.FLAG_MTU_FIT and statsChar:
+            config.data_len = read_statistics(statsChar).mtu - 3
+            print(f'{prefix}[{d.Address}] Notifications are sized to the MTU: {config.data_len} bytes')
+        links[d] = chars[d][dataCharUUID]
+    print(f'{prefix}Done.')
+    return links, configs
+
+def run_multi(a, interval, data_len, num, peripherals, **extended):
+    print(f'Discover {peripherals} devices hosting the throughput service {serviceUUID} for 10 seconds.')
+    devices = a.discover_devices(check_device, peripherals, discovery_filter=discoveryFilter)
+    print(f'Found {len(devices)}.')
+    if not devices:
+        return
+    try:
+        links, configs = configure_all(connect_all(devices), interval, data_len, **extended)
+        if links:
+            print(f'Receive {num} notifications from data characteristic {dataCharUUID} of {len(links)} devices')
+            print_multi_summary(receive_multi(links, num, interval, data_len, configs=configs))
+    finally:
+        for d in devices:
+            print(f'Disconnect {d}')
+            d.disconnect()
+        print('Done.')
+
+def main():
+    # Setup logging
+    logging.basicConfig(level=logging.INFO) # Set to DEBUG for debug logs of bluez module
+    log.setLevel(logging.INFO) # Set to DEBUG for debug logs of this script
+
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Throughput test.')
+    parser.add_argument('-i', '--interval', type=int, default=configInterval, help = 'Notification interval in milliseconds')
+    parser.add_argument('-S', '--saturate', action='store_true',
+                        help = 'Let the peripheral send as fast as its TX buffers get free (interval 0) to measure '
+                               'the maximum sustained throughput')
+    parser.add_argument('-l', '--length', type=int, default=configDataLen, help = 'Notification data size in bytes')
+    parser.add_argument('-b', '--burst', type=int, default=1, help = 'Number of notifications per interval')
+    parser.add_argument('--mtu-fit', action='store_true',
+                        help = 'Size the notifications to the negotiated MTU instead of -l')
+    parser.add_argument('-n', '--num', type=int, default=numDataNotifications, help = 'Number of notifications to receive')
+    parser.add_argument('-p', '--peripherals', type=int, default=numPeripherals,
+                        help = 'Number of peripherals to receive from concurrently')
+    parser.add_argument('-v', '--verbose', action='store_true', help = 'Print every notification after the run')
+    parser.add_argument('-u', '--upload', action='store_true',
+                        help = 'Write -n packets of -l bytes without response to the sink characteristic instead')
+    parser.add_argument('-s', '--statistics', action='store_true',
+                        help = 'Print the periodic notifications of the statistics characteristic while receiving')
+    parser.add_argument('-c', '--capture', help = 'Capture the notifications to this file')
+    parser.add_argument('--replay', help = 'Analyse a capture file instead of running a test')
+    parser.add_argument('--speed', type=float, default=None,
+                        help = 'Replay at this multiple of the recorded pace, default: as fast as possible')
+    parser.add_argument('--trace', action='store_true',
+                        help = 'Print D-Bus call latencies, signal counts and reader wakeups after the run')
+    parser.add_argument('-d', '--duration', type=float,
+                        help = 'Soak mode: receive for this many seconds instead of -n notifications, reconnecting '
+                               'whenever the link drops')
+    parser.add_argument('-w', '--window', type=float, default=soakWindow,
+                        help = 'Reporting window of the soak mode in seconds')
+    args = parser.parse_args()
+
+    if args.saturate:
+        args.interval = saturationInterval
+    if args.peripherals > 1:
+        unsupported = [o for o, v in (('-v', args.verbose), ('-s', args.statistics), ('-c', args.capture)) if v]
+        if unsupported:
+            parser.error(f'{", ".join(unsupported)} not supported with several peripherals (-p)')
+
+    if args.replay:
+        replay_capture(args.replay, args.speed, args.verbose)
+        return
+
+    instrumentation = enable_instrumentation() if args.trace else None
+    try:
+        mgr = Manager();
+        a = mgr.get_adapter('hci0')
+        print(f'Using {a}')
+        if args.upload:
+            run_upload(a, args.length, args.num)
+        elif args.duration:
+            soak(a, args.interval, args.length, args.duration, args.window, burst=args.burst,
+                 flags=ThroughputConfig.FLAG_MTU_FIT if args.mtu_fit else 0)
+        elif args.peripherals > 1:
+            run_multi(a, args.interval, args.length, args.num, args.peripherals, burst=args.burst,
+                      flags=ThroughputConfig.FLAG_MTU_FIT if args.mtu_fit else 0)
+        else:
+            run_single(a, args.interval, args.length, args.num, args.verbose, args.capture, args.statistics,
+                       burst=args.burst, flags=ThroughputConfig.FLAG_MTU_FIT if args.mtu_fit else 0)
+    except BaseException as e:
+        print(f'Caught exception: {e}')
+        raise e
+    finally:
+        if instrumentation is not None:
+            for line in instrumentation.report():
+                print(line)
+    print('Exit')
+
+if __name__ == '__main__':
+    main()
@@ -24,6 +24,13 @@
 #define CONNECTION_LATENCY            0 //
 #define CONNECTION_TIMEOUT           40 // N * 10 ms => 400ms (100ms..32s)
 
+/* Interval of the "Statistics" Characteristic Notifications */
+#define STATISTICS_INTERVAL_MS     1000
+
+/* Saturation mode (interval_ms = 0): Maximum number of "Data" Characteristic Notifications in flight.
+ * Every notification takes an ATT and an L2CAP TX buffer until the controller has sent it. */
+#define SATURATION_CREDITS MIN(CONFIG_BT_CONN_TX_MAX, CONFIG_BT_L2CAP_TX_BUF_COUNT)
+
 /*******************************************************************************
  * Test Service UUID
  * abcdef00-f5bf-58d5-9d17-172177d1316a
@@ -37,6 +44,7 @@ static struct bt_uuid_128 service_uuid = BT_UUID_INIT_128(
  * Config    : ABCDEF01-f5bf-58d5-9d17-172177d1316a
  * Data      : ABCDEF02-f5bf-58d5-9d17-172177d1316a
  * Statistics: ABCDEF03-f5bf-58d5-9d17-172177d1316a
+ * Sink      : ABCDEF04-f5bf-58d5-9d17-172177d1316a
  ******************************************************************************/
 static const struct bt_uuid_128 config_uuid = BT_UUID_INIT_128(
     0x6a, 0x31, 0xd1, 0x77, 0x21, 0x17, 0x17, 0x9d,
@@ -50,18 +58,83 @@ static const struct bt_uuid_128 statistics_uuid = BT_UUID_INIT_128(
     0x6a, 0x31, 0xd1, 0x77, 0x21, 0x17, 0x17, 0x9d,
     0xd5, 0x58, 0xbf, 0xf5, 0x03, 0xef, 0xcd, 0xab);
 
+static const struct bt_uuid_128 sink_uuid = BT_UUID_INIT_128(
+    0x6a, 0x31, 0xd1, 0x77, 0x21, 0x17, 0x17, 0x9d,
+    0xd5, 0x58, 0xbf, 0xf5, 0x04, 0xef, 0xcd, 0xab);
+
+/* Layout of the "Config" Characteristic.
+ * Version 0 (legacy) only consists of interval_ms and data_length. Version 1 adds:
+ * - burst: Number of notifications sent per timer tick
+ * - flags: CONFIG_FLAG_MTU_FIT sends notifications of ATT MTU - 3 bytes instead of data_length
+ * - max_notifications: Stop after this number of notifications, 0 for no limit
+ * - duration_ms: Stop this long after notifications got enabled, 0 for no limit
+ * Reads return the layout of the last write on the connection, so hosts that only know version 0 keep working. */
+#define CONFIG_VERSION          1
+#define CONFIG_LEGACY_LENGTH    3
+#define CONFIG_FLAG_MTU_FIT     BIT(0)
+
 typedef struct {
     uint16_t interval_ms;
     uint8_t data_length;
+    uint8_t version;
+    uint8_t burst;
+    uint8_t flags;
+    uint32_t max_notifications;
+    uint32_t duration_ms;
 } __attribute__((packed)) config_t; // Pack it so it is byte aligned!;
 
 static config_t config = {
     .interval_ms = 100,
-    .data_length = 10
+    .data_length = 10,
+    .version = 0,
+    .burst = 1,
 };
 
+static uint16_t config_length = CONFIG_LEGACY_LENGTH;
+
+/* Notifications sent since notifications got enabled and the end of the duration limit */
+static uint32_t stream_count;
+static int64_t stream_end;
+
 static uint8_t data[256];
 
+typedef struct {
+    uint32_t bytes;
+    uint32_t writes;
+} __attribute__((packed)) sink_counter_t;
+
+static sink_counter_t sink_counter;
+
+/* Counters of the "Data" Characteristic Notifications and the current link parameters.
+ * A notification is attempted when bt_gatt_notify_cb is called and sent when its completion callback runs,
+ * i.e. when the controller has transmitted it. Attempted notifications that are neither sent nor counted as
+ * error are still queued in the stack. */
+typedef struct {
+    uint32_t attempted;
+    uint32_t sent;
+    uint32_t bytes;
+    uint32_t err_nomem;   // -ENOMEM: No TX buffer available
+    uint32_t err_notconn; // -ENOTCONN: Not connected or notifications not enabled
+    uint32_t err_other;
+    uint16_t mtu;
+    uint16_t conn_interval; // N * 1.25ms
+    uint8_t tx_phy;
+    uint8_t rx_phy;
+} __attribute__((packed)) statistics_t;
+
+static statistics_t statistics;
+
+/* Connection the Data and Statistics notifications are sent to and the counters and config belong to.
+ * With CONFIG_BT_MAX_CONN > 1 it is the first connection, a later central only takes over once it disconnected. */
+static struct bt_conn *current_conn;
+
+static void statistics_update_mtu(void)
+{
+    if (current_conn) {
+        statistics.mtu = bt_gatt_get_mtu(current_conn);
+    }
+}
+
 /**
  * @brief Callback triggered when the "Config" Characteristic gets read through BLE
  * @param conn Connection object.
@@ -74,7 +147,7 @@ static uint8_t data[256];
 static ssize_t config_read(struct bt_conn *conn, const struct bt_gatt_attr *attr, void *buf, uint16_t len,
                            uint16_t offset)
 {
-    return bt_gatt_attr_read(conn, attr, buf, len, offset, &config, sizeof(config));
+    return bt_gatt_attr_read(conn, attr, buf, len, offset, &config, config_length);
 }
 
 /**
@@ -91,21 +164,47 @@ static ssize_t config_write(struct bt_conn *conn, const struct bt_gatt_attr *att
                          uint16_t offset,
                          uint8_t flags)
 {
-    config_t *cfg = (config_t *)buf;
+    const config_t *cfg = (const config_t *)buf;
 
     if (flags & BT_GATT_WRITE_FLAG_PREPARE) {
         return 0;
     }
 
-    if (offset + len > sizeof(config_t)) {
+    if (conn != current_conn) {
+        /* Do not reconfigure the stream of another central */
+        return BT_GATT_ERR(BT_ATT_ERR_WRITE_NOT_PERMITTED);
+    }
+    if (offset != 0) {
         return BT_GATT_ERR(BT_ATT_ERR_INVALID_OFFSET);
     }
-    config = *cfg;
-    printk("Wrote config:\n"
+    if (len == CONFIG_LEGACY_LENGTH) {
+        /* Version 0: the fields of version 1 get their defaults */
+        memset(&config, 0, sizeof(config));
+        memcpy(&config, buf, CONFIG_LEGACY_LENGTH);
+        config.burst = 1;
+    } else if (len == sizeof(config_t) && cfg->version == CONFIG_VERSION) {
+        config = *cfg;
+        if (config.burst == 0) {
+            config.burst = 1;
+        }
+    } else {
+        return BT_GATT_ERR(BT_ATT_ERR_INVALID_ATTRIBUTE_LEN);
+    }
+    config_length = len;
+    printk("Wrote config (version %u):\n"
            "- interval_ms: %u\n"
-           "- data_length: %u\n",
+           "- data_length: %u\n"
+           "- burst: %u\n"
+           "- flags: 0x%02X\n"
+           "- max_notifications: %u\n"
+           "- duration_ms: %u\n",
+           config.version,
            config.interval_ms,
-           config.data_length);
+           config.data_length,
+           config.burst,
+           config.flags,
+           config.max_notifications,
+           config.duration_ms);
     return len;
 }
 
@@ -121,9 +220,21 @@ static ssize_t config_write(struct bt_conn *conn, const struct bt_gatt_attr *att
 static ssize_t statistics_read(struct bt_conn *conn, const struct bt_gatt_attr *attr, void *buf, uint16_t len,
                               uint16_t offset)
 {
-    return len;
+    statistics_update_mtu();
+    return bt_gatt_attr_read(conn, attr, buf, len, offset, &statistics, sizeof(statistics));
+}
+
+static void statistics_work_handler(struct k_work *work);
+
+K_WORK_DEFINE(statistics_work, statistics_work_handler);
+
+static void statistics_timer_handler(struct k_timer *dummy)
+{
+    k_work_submit(&statistics_work);
 }
 
+K_TIMER_DEFINE(statistics_timer, statistics_timer_handler, NULL);
+
 /**
  * @brief Callback triggered when the "Statistics" Characteristic Notifications get enabled/disabled through BLE
  * @param attr
@@ -134,13 +245,56 @@ static void statistics_ccc_changed(const struct bt_gatt_attr *attr, uint16_t val
     if (value == 1)
     {
         printk("\"Statistics\" Characteristic Notifications got enabled\n");
+        k_timer_start(&statistics_timer, K_MSEC(STATISTICS_INTERVAL_MS), K_MSEC(STATISTICS_INTERVAL_MS));
     }
     else
     {
         printk("\"Statistics\" Characteristic Notifications got disabled\n");
+        k_timer_stop(&statistics_timer);
     }
 }
 
+/**
+ * @brief Callback triggered when the "Sink" Characteristic gets read through BLE
+ * @param conn Connection object.
+ * @param attr Attribute to read.
+ * @param buf Buffer to store the value.
+ * @param len Buffer length.
+ * @param offset Start offset.
+ * @return number of bytes read in case of success or negative values in case of error.
+ */
+static ssize_t sink_read(struct bt_conn *conn, const struct bt_gatt_attr *attr, void *buf, uint16_t len,
+                         uint16_t offset)
+{
+    return bt_gatt_attr_read(conn, attr, buf, len, offset, &sink_counter, sizeof(sink_counter));
+}
+
+/**
+ * @brief Callback triggered when the "Sink" Characteristic gets written through BLE.
+ * The data is discarded, only the number of bytes and writes is counted.
+ * @param conn Connection object.
+ * @param attr Attribute to write.
+ * @param buf Buffer to store the value.
+ * @param len Buffer length.
+ * @param offset Start offset.
+ * @param flags Write flags.
+ * @return number of bytes written in case of success or negative values in case of error.
+ */
+static ssize_t sink_write(struct bt_conn *conn, const struct bt_gatt_attr *attr, const void *buf, uint16_t len,
+                          uint16_t offset,
+                          uint8_t flags)
+{
+    if (flags & BT_GATT_WRITE_FLAG_PREPARE) {
+        return 0;
+    }
+
+    if (conn == current_conn) {
+        sink_counter.bytes += len;
+        sink_counter.writes++;
+    }
+    return len;
+}
+
 static void data_work_handler(struct k_work *work);
 
 K_WORK_DEFINE(data_work, data_work_handler);
@@ -152,6 +306,12 @@ static void data_timer_handler(struct k_timer *dummy)
 
 K_TIMER_DEFINE(data_timer, data_timer_handler, NULL);
 
+/* Saturation mode: Notifications are queued as long as credits are available, every sent notification returns
+ * its credit and queues the next one. */
+K_SEM_DEFINE(data_credits, SATURATION_CREDITS, SATURATION_CREDITS);
+
+static bool saturation;
+
 /**
  * @brief Callback triggered when the "Data" Characteristic Notifications get enabled/disabled through BLE
  * @param attr
@@ -162,12 +322,27 @@ static void data_ccc_changed(const struct bt_gatt_attr *attr, uint16_t value)
     if (value == 1)
     {
         printk("\"Data\" Characteristic Notifications got enabled\n");
-        /* start periodic timer that expires once every second */
-        k_timer_start(&data_timer, K_MSEC(config.interval_ms), K_MSEC(config.interval_ms));
+        stream_count = 0;
+        stream_end = config.duration_ms ? k_uptime_get() + config.duration_ms : 0;
+        if (config.interval_ms == 0)
+        {
+            /* send as fast as the TX buffers get free */
+            printk("Saturation mode with %d notifications in flight\n", SATURATION_CREDITS);
+            /* credits of notifications lost on a previous connection are not returned */
+            k_sem_init(&data_credits, SATURATION_CREDITS, SATURATION_CREDITS);
+            saturation = true;
+            k_work_submit(&data_work);
+        }
+        else
+        {
+            /* start periodic timer that expires every interval_ms */
+            k_timer_start(&data_timer, K_MSEC(config.interval_ms), K_MSEC(config.interval_ms));
+        }
     }
     else
     {
         printk("\"Data\" Characteristic Notifications got disabled\n");
+        saturation = false;
         /* stop periodic timer */
         k_timer_stop(&data_timer);
     }
@@ -186,15 +361,117 @@ BT_GATT_SERVICE_DEFINE(
 
     /* Statistics Characteristic */
     BT_GATT_CHARACTERISTIC(&statistics_uuid.uuid, BT_GATT_CHRC_READ | BT_GATT_CHRC_NOTIFY, BT_GATT_PERM_READ, statistics_read, NULL, 0),
-    BT_GATT_CCC(statistics_ccc_changed, BT_GATT_PERM_READ | BT_GATT_PERM_WRITE)
+    BT_GATT_CCC(statistics_ccc_changed, BT_GATT_PERM_READ | BT_GATT_PERM_WRITE),
+
+    /* Sink Characteristic */
+    BT_GATT_CHARACTERISTIC(&sink_uuid.uuid, BT_GATT_CHRC_READ | BT_GATT_CHRC_WRITE_WITHOUT_RESP, BT_GATT_PERM_READ | BT_GATT_PERM_WRITE, sink_read, sink_write, 0)
     );
 
+/**
+ * @brief Callback triggered when a "Data" Characteristic Notification has been sent
+ * @param conn Connection object.
+ * @param user_data Length of the notification.
+ */
+static void data_sent(struct bt_conn *conn, void *user_data)
+{
+    statistics.sent++;
+    statistics.bytes += (uint32_t)(uintptr_t)user_data;
+    if (saturation) {
+        k_sem_give(&data_credits);
+        k_work_submit(&data_work);
+    }
+}
+
+/**
+ * @brief Queue one "Data" Characteristic Notification on the current connection
+ *
+ * Only the current connection is notified: with NULL every connected peer would be notified and each of the
+ * completion callbacks would count the notification and return a credit.
+ * @return 0 on success, -ENOTCONN without a current connection or the negative error of bt_gatt_notify_cb.
+ */
+static int data_notify(void)
+{
+    uint16_t len = config.data_length;
+    if ((config.flags & CONFIG_FLAG_MTU_FIT) && current_conn) {
+        len = MIN(bt_gatt_get_mtu(current_conn) - 3, sizeof(data));
+    }
+    struct bt_gatt_notify_params params = {
+        .attr = &service.attrs[3],
+        .data = data,
+        .len = len,
+        .func = data_sent,
+        .user_data = (void *)(uintptr_t)len,
+    };
+    int err = -ENOTCONN;
+
+    statistics.attempted++;
+    if (current_conn && bt_gatt_is_subscribed(current_conn, &service.attrs[3], BT_GATT_CCC_NOTIFY))
+        err = bt_gatt_notify_cb(current_conn, &params);
+    if (err == 0)
+        stream_count++;
+    else if (err == -ENOMEM)
+        statistics.err_nomem++;
+    else if (err == -ENOTCONN)
+        statistics.err_notconn++;
+    else if (err != 0) {
+        statistics.err_other++;
+        printk("data_notify: bt_gatt_notify_cb returned: %i\n", err);
+    }
+    return err;
+}
+
+/**
+ * @brief Check the notification and duration limits of the config and stop sending when one is reached
+ * @return true if sending has been stopped.
+ */
+static bool data_limit_reached(void)
+{
+    if ((config.max_notifications && stream_count >= config.max_notifications)
+        || (stream_end && k_uptime_get() >= stream_end)) {
+        saturation = false;
+        k_timer_stop(&data_timer);
+        return true;
+    }
+    return false;
+}
+
 static void data_work_handler(struct k_work *work)
+{
+    if (!saturation) {
+        for (uint8_t i = 0; i < config.burst && !data_limit_reached(); i++) {
+            if (data_notify() != 0) {
+                break;
+            }
+        }
+        return;
+    }
+
+    /* Fill the TX buffers, the completion callbacks return the credits and resubmit this work */
+    while (saturation && !data_limit_reached() && k_sem_take(&data_credits, K_NO_WAIT) == 0) {
+        int err = data_notify();
+        if (err != 0) {
+            k_sem_give(&data_credits);
+            if (err == -ENOMEM) {
+                /* The buffers are taken by other PDUs, retry even if no completion callback is pending */
+                k_timer_start(&data_timer, K_MSEC(1), K_NO_WAIT);
+            } else {
+                /* Not connected or not subscribed anymore */
+                saturation = false;
+            }
+            break;
+        }
+    }
+}
+
+static void statistics_work_handler(struct k_work *work)
 {
     int err = 0;
-    err = bt_gatt_notify(NULL, &service.attrs[3], data, config.data_length);
+    if (!current_conn || !bt_gatt_is_subscribed(current_conn, &service.attrs[6], BT_GATT_CCC_NOTIFY))
+        return;
+    statistics_update_mtu();
+    err = bt_gatt_notify(current_conn, &service.attrs[6], &statistics, sizeof(statistics));
     if (err != 0)
-        printk("data_work_handler: bt_gatt_notify returned: %i\n", err);
+        printk("statistics_work_handler: bt_gatt_notify returned: %i\n", err);
 }
 
 static const struct bt_data ad[] = {
@@ -236,6 +513,9 @@ static bool le_param_req(struct bt_conn *conn, struct bt_le_conn_param *param)
 static void le_param_updated(struct bt_conn *conn, uint16_t interval, uint16_t latency, uint16_t timeout)
 {
     printk("Connection parameters updated: interval: %d, latency: %d, timeout: %d\n", interval, latency, timeout);
+    if (conn == current_conn) {
+        statistics.conn_interval = interval;
+    }
 }
 
 static void print_conn_info(struct bt_conn *conn)
@@ -283,6 +563,34 @@ static void print_conn_info(struct bt_conn *conn)
     }
 }
 
+/**
+ * @brief Make @p conn the connection of the stream and reset the counters and the config layout
+ * @param conn Connection object, NULL if no central is connected.
+ */
+static void take_over(struct bt_conn *conn)
+{
+    if (current_conn) {
+        bt_conn_unref(current_conn);
+        current_conn = NULL;
+    }
+    memset(&sink_counter, 0, sizeof(sink_counter));
+    config_length = CONFIG_LEGACY_LENGTH;
+    memset(&statistics, 0, sizeof(statistics));
+    if (!conn) {
+        return;
+    }
+    current_conn = bt_conn_ref(conn);
+    struct bt_conn_info info;
+    if (!bt_conn_get_info(conn, &info)) {
+        statistics.conn_interval = info.le.interval;
+#if defined(CONFIG_BT_USER_PHY_UPDATE)
+        statistics.tx_phy = info.le.phy->tx_phy;
+        statistics.rx_phy = info.le.phy->rx_phy;
+#endif /* defined(CONFIG_BT_USER_PHY_UPDATE) */
+    }
+    statistics_update_mtu();
+}
+
 static void connected(struct bt_conn *conn, uint8_t err)
 {
     if (err)
@@ -293,6 +601,12 @@ static void connected(struct bt_conn *conn, uint8_t err)
     {
         printk("Connected\n");
         print_conn_info(conn);
+        if (current_conn) {
+            /* Keep the stream, counters and config of the central that is connected already */
+            printk("Another central is connected, notifications stay on its connection\n");
+        } else {
+            take_over(conn);
+        }
 
         /* Update the Data Length
          * See https://punchthrough.com/maximizing-ble-throughput-part-3-data-length-extension-dle-2
@@ -319,9 +633,27 @@ static void connected(struct bt_conn *conn, uint8_t err)
     }
 }
 
+/* bt_conn_foreach callback: stores the first connection other than current_conn in @p data */
+static void find_other_conn(struct bt_conn *conn, void *data)
+{
+    struct bt_conn **other = data;
+    if (conn != current_conn && !*other) {
+        *other = conn;
+    }
+}
+
 static void disconnected(struct bt_conn *conn, uint8_t reason)
 {
     printk("Disconnected (reason 0x%02x)\n", reason);
+    if (conn == current_conn) {
+        /* Hand the stream over to a central that is still connected */
+        struct bt_conn *other = NULL;
+        bt_conn_foreach(BT_CONN_TYPE_LE, find_other_conn, &other);
+        if (other) {
+            printk("Notifications continue on the other connection\n");
+        }
+        take_over(other);
+    }
 }
 
 #if defined(CONFIG_BT_USER_PHY_UPDATE)
@@ -341,6 +673,10 @@ void le_phy_updated(struct bt_conn *conn, struct bt_conn_le_phy_info *param)
      * };
      */
     printk("PHY updated: TX: 0x%02X, RX: 0x%02X\n", param->tx_phy, param->rx_phy);
+    if (conn == current_conn) {
+        statistics.tx_phy = param->tx_phy;
+        statistics.rx_phy = param->rx_phy;
+    }
 }
 #endif
 